@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Benchmark for broadcast fan-out.
+
+Compares the old broadcast path (frame and send to each recipient in the
+broadcasting thread) with fan_out (frame once, queue the shared bytes,
+writer threads coalesce pending frames into one sendmsg call) at several
+numbers of connected clients. Connections are local socket pairs and a
+single selector thread drains the client ends.
+"""
+
+import argparse
+import json
+import selectors
+import socket
+import threading
+import time
+
+from framing import encode_frame
+from outbound import OutboundQueue, fan_out
+from sessions import Session
+
+def drain(sockets, expected_bytes, done):
+    """Read from every client socket until expected_bytes have arrived"""
+    selector = selectors.DefaultSelector()
+    for sock in sockets:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+
+    received = 0
+    while received < expected_bytes:
+        for key, _ in selector.select(timeout=1.0):
+            try:
+                received += len(key.fileobj.recv(1 << 20))
+            except BlockingIOError:
+                pass
+    selector.close()
+    done.set()
+
+def build_payload(index):
+    """Build a typical broadcast payload"""
+    return json.dumps({
+        "type": "typing",
+        "username": f"user{index % 50}",
+        "isTyping": index % 2 == 0
+    }).encode('utf-8')
+
+def run_direct(clients, messages):
+    """Old path: frame and sendall to every recipient from the broadcasting thread"""
+    pairs = [socket.socketpair() for _ in range(clients)]
+    servers = [server for server, _ in pairs]
+    frame_size = len(encode_frame(build_payload(0)))
+    done = threading.Event()
+    reader = threading.Thread(target=drain, args=([c for _, c in pairs], frame_size * clients * messages, done))
+    reader.daemon = True
+    reader.start()
+
+    start = time.perf_counter()
+    for index in range(messages):
+        payload = build_payload(index)
+        for sock in servers:
+            sock.sendall(encode_frame(payload))
+    done.wait()
+    elapsed = time.perf_counter() - start
+
+    for server, client in pairs:
+        server.close()
+        client.close()
+    return elapsed, clients * messages
+
+def run_fan_out(clients, messages):
+    """New path: fan_out onto per-session queues drained by coalescing writers"""
+    pairs = [socket.socketpair() for _ in range(clients)]
+    sessions = [
+        Session(server, f"user{i}", framed=True,
+                outbound=OutboundQueue(server, f"user{i}", max_messages=messages + 1, max_bytes=1 << 30))
+        for i, (server, _) in enumerate(pairs)
+    ]
+    frame_size = len(encode_frame(build_payload(0)))
+    done = threading.Event()
+    reader = threading.Thread(target=drain, args=([c for _, c in pairs], frame_size * clients * messages, done))
+    reader.daemon = True
+    reader.start()
+
+    start = time.perf_counter()
+    for index in range(messages):
+        fan_out(sessions, build_payload(index))
+    done.wait()
+    elapsed = time.perf_counter() - start
+
+    write_calls = sum(session.outbound.write_calls for session in sessions)
+    for session in sessions:
+        session.outbound.close()
+    for server, client in pairs:
+        server.close()
+        client.close()
+    return elapsed, write_calls
+
+def main():
+    parser = argparse.ArgumentParser(description="Broadcast fan-out benchmark")
+    parser.add_argument("--clients", type=int, nargs="+", default=[100, 1000, 5000],
+                        help="Numbers of connected clients to test")
+    parser.add_argument("--messages", type=int, default=200, help="Broadcasts per run")
+    args = parser.parse_args()
+
+    print("{:<10} {:<10} {:>14} {:>18} {:>14}".format(
+        "Clients", "Path", "Messages/sec", "Deliveries/sec", "Write calls"))
+    print("-" * 70)
+
+    for clients in args.clients:
+        for name, run in (("direct", run_direct), ("fan-out", run_fan_out)):
+            elapsed, write_calls = run(clients, args.messages)
+            print("{:<10} {:<10} {:>14.0f} {:>18.0f} {:>14}".format(
+                clients,
+                name,
+                args.messages / elapsed,
+                args.messages * clients / elapsed,
+                write_calls
+            ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Benchmark for private message encryption.
+
+Encrypts and decrypts the same messages with each scheme a client can use
+and reports messages per second each way and the size of the resulting
+private_message frame:
+
+    rsa       per-message AES key wrapped with RSA-OAEP, AES-CFB (the original path)
+    x25519    per-message ephemeral X25519 agreement, AES-GCM
+    session   one X25519 agreement per session, then a symmetric ratchet and AES-GCM
+"""
+
+import argparse
+import json
+import time
+
+from keystore import Identity, PeerKey, encrypt_message, decrypt_message
+from ratchet import SessionStore
+
+def build_message(size, index):
+    return (f"message {index} " + "x" * size)[:size]
+
+def run(scheme, count, size):
+    """Return (encrypts/sec, decrypts/sec, average frame bytes) for count messages"""
+    key_type = "rsa" if scheme == "rsa" else "x25519"
+    recipient = Identity.generate(key_type)
+    if key_type == "rsa":
+        peer_key = PeerKey("rsa", recipient.rsa_key.public_key(), None)
+    else:
+        peer_key = PeerKey("x25519", recipient.x25519_key.public_key(), recipient.ed25519_key.public_key())
+    sender_sessions = SessionStore()
+    recipient_sessions = SessionStore(recipient)
+    messages = [build_message(size, index) for index in range(count)]
+
+    start = time.perf_counter()
+    if scheme == "session":
+        packages = [sender_sessions.encrypt("alice", "bob", peer_key, text) for text in messages]
+    else:
+        packages = [encrypt_message(peer_key, text) for text in messages]
+    encrypt_seconds = time.perf_counter() - start
+
+    frame_bytes = sum(len(json.dumps(dict(package, type="private_message", sender="alice", recipient="bob")))
+                      for package in packages)
+
+    start = time.perf_counter()
+    if scheme == "session":
+        decrypted = [recipient_sessions.decrypt("alice", "bob", package) for package in packages]
+    else:
+        decrypted = [decrypt_message(recipient, package) for package in packages]
+    decrypt_seconds = time.perf_counter() - start
+
+    assert decrypted == messages
+    return count / encrypt_seconds, count / decrypt_seconds, frame_bytes / count
+
+def main():
+    parser = argparse.ArgumentParser(description="Private message encryption benchmark")
+    parser.add_argument("--messages", type=int, default=2000, help="Messages per scheme")
+    parser.add_argument("--size", type=int, default=200, help="Characters per message")
+    parser.add_argument("--schemes", nargs="+", choices=["rsa", "x25519", "session"],
+                        default=["rsa", "x25519", "session"], help="Schemes to compare")
+    args = parser.parse_args()
+
+    print("{:<10} {:>16} {:>16} {:>14}".format("Scheme", "Encrypt msg/s", "Decrypt msg/s", "Frame bytes"))
+    print("-" * 60)
+    for scheme in args.schemes:
+        encrypts, decrypts, frame = run(scheme, args.messages, args.size)
+        print("{:<10} {:>16.0f} {:>16.0f} {:>14.0f}".format(scheme, encrypts, decrypts, frame))
+
+if __name__ == "__main__":
+    main()
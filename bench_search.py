@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmark for full-text message search.
+
+Fills a scratch copy of chat_messages with generated messages, then times
+the old ad-hoc search (ILIKE over message) against the indexed search
+(search_vector @@ query, ranked) for a few queries of different
+selectivity. The scratch table lives in the chat database and is dropped
+afterwards unless --keep is given.
+"""
+
+import argparse
+import time
+
+import psycopg2
+
+from db_management import DB_CONFIG
+from search import SEARCH_CONFIG, create_search_index
+
+TABLE = "bench_search_messages"
+
+# Words the generated messages are made of; the later ones are rarer
+WORDS = ["hello", "thanks", "meeting", "lunch", "today", "deploy", "server", "review",
+         "coffee", "release", "failed", "staging", "invoice", "kubernetes", "quarterly"]
+
+# (search query, equivalent ILIKE pattern)
+QUERIES = [
+    ("hello", "%hello%"),
+    ("deploy failed", "%deploy%failed%"),
+    ("quarterly invoice", "%quarterly%invoice%"),
+    ("zebra", "%zebra%"),
+]
+
+def populate(cursor, rows):
+    """Create the scratch table and fill it with rows generated messages"""
+    cursor.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    cursor.execute(f"""
+        CREATE TABLE {TABLE} (
+            id SERIAL PRIMARY KEY,
+            sender_id INTEGER,
+            message TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_private BOOLEAN DEFAULT FALSE
+        )
+    """)
+    # Six words per message, skewed towards the common ones; the subquery refers
+    # to n so it is evaluated for every row instead of once
+    cursor.execute(f"""
+        INSERT INTO {TABLE} (sender_id, message, timestamp)
+        SELECT n %% 1000,
+               (SELECT string_agg(
+                    (%s::text[])[1 + floor(power(random(), 2) * %s)::int], ' ')
+                FROM generate_series(1, 6) WHERE n > 0),
+               now() - (n || ' seconds')::interval
+        FROM generate_series(1, %s) n
+    """, (WORDS, len(WORDS), rows))
+    create_search_index(cursor, TABLE)
+    cursor.execute(f"ANALYZE {TABLE}")
+
+def time_query(cursor, sql, params, repeat):
+    """Return (best seconds, rows) over repeat runs of a query"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cursor.execute(sql, params)
+        found = cursor.fetchall()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(found)
+
+def main():
+    parser = argparse.ArgumentParser(description="Full-text search benchmark")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="Messages to generate")
+    parser.add_argument("--limit", type=int, default=20, help="Hits fetched per search")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per query; the best is reported")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch table (skips regenerating it)")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT to_regclass(%s)", (TABLE,))
+        if not (args.keep and cursor.fetchone()[0]):
+            print(f"Generating {args.rows} messages...")
+            start = time.perf_counter()
+            populate(cursor, args.rows)
+            conn.commit()
+            print(f"Generated and indexed in {time.perf_counter() - start:.1f} s")
+
+        print("\n{:<22} {:<8} {:>12} {:>8}".format("Query", "Path", "ms", "Hits"))
+        print("-" * 54)
+        for query, pattern in QUERIES:
+            like_seconds, like_hits = time_query(cursor, f"""
+                SELECT id, message, timestamp FROM {TABLE}
+                WHERE is_private = FALSE AND message ILIKE %s
+                ORDER BY id DESC LIMIT %s
+            """, (pattern, args.limit), args.repeat)
+            search_seconds, search_hits = time_query(cursor, f"""
+                SELECT id, message, timestamp, ts_rank(search_vector, q) AS rank
+                FROM {TABLE}, websearch_to_tsquery('{SEARCH_CONFIG}', %s) q
+                WHERE is_private = FALSE AND search_vector @@ q
+                ORDER BY rank DESC, id DESC LIMIT %s
+            """, (query, args.limit), args.repeat)
+            print("{:<22} {:<8} {:>12.1f} {:>8}".format(query, "ILIKE", like_seconds * 1000, like_hits))
+            print("{:<22} {:<8} {:>12.1f} {:>8}".format(query, "GIN", search_seconds * 1000, search_hits))
+        conn.rollback()
+    finally:
+        if not args.keep:
+            cursor.execute(f"DROP TABLE IF EXISTS {TABLE}")
+            conn.commit()
+        cursor.close()
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -2,21 +2,46 @@ import socket
 import threading
 import tkinter as tk
 import json
-import base64
 import os
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
+import time
+import collections
+import argparse
+from framing import FrameDecoder, encode_frame, build_handshake, SINCE_ID_OPTION, EPOCH_OPTION
+from scrollback import LineStore
+from keystore import (KEY_TYPES, DEFAULT_KEY_TYPE, KEYSTORE_PASSPHRASE_ENV, Identity, KeystoreError, KeyCache,
+                      choose_key_type, best_key, encrypt_message, decrypt_message,
+                      load_or_create_identity, save_identity)
+from keydir import key_fingerprint, format_fingerprint
+from ratchet import SESSION_SCHEME, SessionStore
 from tkinter import scrolledtext, messagebox, ttk, colorchooser, font, simpledialog
 
 # Connection settings
 host = '127.0.0.1'  # IPv4 localhost
 port = 5054  # Updated to match server's new port
 
-# Encryption settings
-RSA_KEY_SIZE = 2048
-AES_KEY_SIZE = 256
+# Messages fetched per "Load Older Messages" click
+HISTORY_PAGE_SIZE = 50
+
+# Seconds between TYPING: refreshes while the user keeps typing; the server
+# clears the indicator on its own if refreshes stop
+TYPING_REFRESH_INTERVAL = 1.0
+
+# The receive thread queues server messages; the Tk main loop applies them
+# every UI_FRAME_INTERVAL ms, spending at most UI_FRAME_BUDGET seconds per frame
+UI_FRAME_INTERVAL = 50
+UI_FRAME_BUDGET = 0.02
+
+# The chat widget holds at most SCROLLBACK_LINES lines and drops them
+# SCROLLBACK_TRIM at a time; dropped lines stay in a store of up to
+# SCROLLBACK_STORE_LINES and are shown again when scrolled back to
+SCROLLBACK_LINES = 2000
+SCROLLBACK_TRIM = 500
+SCROLLBACK_STORE_LINES = 50000
+
+# Users asked about per get_keys request, and the most online users whose keys
+# are fetched ahead of time; keys of the others are fetched when a chat starts
+KEYS_BATCH_SIZE = 500
+KEY_PREFETCH_MAX = 2000
 
 # Theme definitions
 THEMES = {
@@ -78,7 +103,7 @@ THEMES = {
 }
 
 class ChatClient:
-    def __init__(self, root, auto_username=None):
+    def __init__(self, root, auto_username=None, key_type=DEFAULT_KEY_TYPE, keystore_path=None, key_cache_path=None):
         self.root = root
         self.root.title("Chat Application")
         self.root.geometry("900x700")
@@ -92,17 +117,53 @@ class ChatClient:
         
         # Private messaging variables
         self.active_users = []
+        self.presence_version = None  # Version of the last user list or presence delta applied
         self.selected_user = None
         self.private_mode = False
-        
-        # Encryption keys
-        self.private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=RSA_KEY_SIZE,
-            backend=default_backend()
-        )
-        self.public_key = self.private_key.public_key()
-        self.user_public_keys = {}  # Store other users' public keys
+        self.history_cursor = None  # Where the next page of older messages starts; None for the newest
+        self.history_exhausted = False  # The first message of the conversation has been loaded
+        self.last_message_id = None  # Highest public message id seen, sent as SINCE_ID on reconnect
+        self.server_epoch = None  # Epoch of the server last_message_id came from, sent as EPOCH
+        
+        # UI update pipeline: filled by the receive thread, drained by the Tk main loop
+        self.ui_events = collections.deque()  # ("message", text) or ("lost", text)
+        self.pending_lines = collections.deque()  # Chat lines waiting for the next frame
+        
+        # Scrollback: every line shown this session, of which the widget holds [view_start, view_end)
+        self.scrollback = LineStore(SCROLLBACK_STORE_LINES)
+        self.view_start = 0
+        self.view_end = 0
+        self.scroll_update_pending = False
+        self.history_request_pending = False  # A history_request is waiting for its final page
+        
+        # UI counters
+        self.ui_started = time.monotonic()
+        self.ui_frames = 0
+        self.ui_events_handled = 0
+        self.ui_lines = 0
+        self.ui_frame_seconds = 0.0  # Total time spent applying updates
+        self.ui_max_frame_seconds = 0.0
+        
+        # Encryption keys, loaded or generated on a background thread
+        self.key_type = key_type
+        self.keystore_path = keystore_path
+        self.keystore_passphrase = None
+        self.identity = None
+        self.identity_busy = False  # A key thread is running
+        self.identity_seconds = None  # How long loading or generating the keys took
+        self.awaiting_identity = []  # Server messages that need keys we do not have yet
+        self.user_public_keys = {}  # Other users' PeerKeys
+        self.sessions = SessionStore()  # Private message sessions with X25519 peers
+        
+        # Peers' keys pinned by fingerprint, kept across runs when key_cache_path is given
+        try:
+            self.key_cache = KeyCache(key_cache_path)
+        except KeystoreError as e:
+            # Leave the unreadable file as it is and keep keys in memory only
+            self.update_chat_history(f"Starting with an empty key cache: {e}")
+            self.key_cache = KeyCache()
+        self.keys_requested = set()  # Users looked up in the server's key directory this connection
+        self.keys_wanted = set()  # Users whose key is needed for a private chat
         
         # Create menu bar
         self.menu_bar = tk.Menu(root)
@@ -130,6 +191,12 @@ class ChatClient:
             self.font_menu.add_command(label=str(size), 
                                       command=lambda s=size: self.change_font_size(s))
         
+        # UI statistics
+        self.settings_menu.add_command(label="UI Statistics", command=self.show_ui_stats)
+        
+        # Fingerprints of our keys and our peers' keys
+        self.settings_menu.add_command(label="Key Fingerprints", command=self.show_fingerprints)
+        
         # Main content frame with users list and chat
         self.content_frame = tk.Frame(root)
         self.content_frame.pack(pady=10, padx=10, fill=tk.BOTH, expand=True)
@@ -166,6 +233,11 @@ class ChatClient:
         self.public_chat_button.pack(fill=tk.X)
         self.public_chat_button.config(state=tk.DISABLED)  # Initially disabled
         
+        # Load older messages button
+        self.older_messages_button = tk.Button(self.users_frame, text="Load Older Messages", 
+                                             command=self.request_older_messages)
+        self.older_messages_button.pack(fill=tk.X, pady=5)
+        
         # Chat history display (right side)
         self.chat_frame = tk.Frame(self.content_frame)
         self.chat_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
@@ -176,6 +248,7 @@ class ChatClient:
         
         self.chat_history = scrolledtext.ScrolledText(self.chat_frame, wrap=tk.WORD, state='disabled')
         self.chat_history.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
+        self.chat_history.config(yscrollcommand=self.on_chat_scroll)
         
         # Typing indicator label
         self.typing_label = tk.Label(root, text="", fg="gray", anchor=tk.W)
@@ -213,10 +286,11 @@ class ChatClient:
         # Socket and connection status
         self.client_socket = None
         self.connected = False
+        self.send_lock = threading.Lock()  # Keeps frames from the UI and receive threads whole
         
         # Typing indicator variables
         self.is_typing = False
-        self.typing_timer = None
+        self.last_typing_sent = 0.0
         self.typing_users = set()
         
         # Apply default theme
@@ -228,6 +302,17 @@ class ChatClient:
         # Protocol for closing the window
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         
+        # Start applying queued server messages
+        self.root.after(UI_FRAME_INTERVAL, self.drain_ui_events)
+        
+        # Get the encryption keys ready without holding up the window
+        if self.keystore_path:
+            self.keystore_passphrase = os.environ.get(KEYSTORE_PASSPHRASE_ENV)
+            if self.keystore_passphrase is None:
+                self.keystore_passphrase = simpledialog.askstring(
+                    "Keystore", f"Passphrase for {self.keystore_path} (empty for none):", show='*', parent=self.root)
+        self.prepare_identity(self.key_type)
+        
         # Auto-connect if username is provided
         if self.auto_username:
             self.username_input.delete(0, tk.END)
@@ -252,41 +337,21 @@ class ChatClient:
             self.client_socket.connect((host, port))
             self.connected = True
             
-            # Send username to server
-            self.client_socket.send(f"USERNAME:{username}".encode('utf-8'))
+            # Send username to server and switch the connection to framed messages;
+            # after a reconnect ask only for the messages we missed
+            options = {}
+            if self.last_message_id is not None and self.server_epoch is not None:
+                options[SINCE_ID_OPTION] = self.last_message_id
+                options[EPOCH_OPTION] = self.server_epoch
+            self.client_socket.sendall(build_handshake(username, options))
             
             # Update UI
             self.connect_button.config(text="Disconnect", command=self.disconnect_from_server)
             self.update_chat_history(f"Connected to server at {host}:{port}")
             
-            # Start thread to receive messages
-            receive_thread = threading.Thread(target=self.receive_messages)
-            receive_thread.daemon = True
-            receive_thread.start()
-            
-        except Exception as e:
-            self.update_chat_history(f"Failed to connect: {str(e)}")
-            self.client_socket = None
-            return
-            
-        username = self.username_input.get().strip()
-        if not username:
-            messagebox.showerror("Error", "Please enter a username")
-            return
-            
-        # Create socket with IPv6 support
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        
-        try:
-            self.client_socket.connect((host, port))
-            self.connected = True
-            
-            # Send username to server
-            self.client_socket.send(f"USERNAME:{username}".encode('utf-8'))
-            
-            # Update UI
-            self.connect_button.config(text="Disconnect", command=self.disconnect_from_server)
-            self.update_chat_history(f"Connected to server at {host}:{port}")
+            # Put our keys in the server's directory; keys looked up before may have changed
+            self.keys_requested.clear()
+            self.publish_keys()
             
             # Start thread to receive messages
             receive_thread = threading.Thread(target=self.receive_messages)
@@ -297,6 +362,11 @@ class ChatClient:
             self.update_chat_history(f"Failed to connect: {str(e)}")
             self.client_socket = None
     
+    def send_to_server(self, data):
+        """Send one framed message to the server"""
+        with self.send_lock:
+            self.client_socket.sendall(encode_frame(data))
+    
     def disconnect_from_server(self):
         if self.client_socket:
             try:
@@ -323,38 +393,21 @@ class ChatClient:
                 if self.private_mode and self.selected_user:
                     # Encrypt the message for the selected user
                     if self.selected_user in self.user_public_keys:
-                        # Generate a random AES key for this message
-                        aes_key = os.urandom(AES_KEY_SIZE // 8)
-                        iv = os.urandom(16)  # 16 bytes for AES
-                        
-                        # Encrypt the message with AES
-                        cipher = Cipher(algorithms.AES(aes_key), modes.CFB(iv), backend=default_backend())
-                        encryptor = cipher.encryptor()
-                        encrypted_message = encryptor.update(message.encode('utf-8')) + encryptor.finalize()
-                        
-                        # Encrypt the AES key with recipient's public key
-                        recipient_public_key = self.user_public_keys[self.selected_user]
-                        encrypted_key = recipient_public_key.encrypt(
-                            aes_key,
-                            padding.OAEP(
-                                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                                algorithm=hashes.SHA256(),
-                                label=None
-                            )
-                        )
-                        
-                        # Prepare the message package
+                        # X25519 peers share a session with us; RSA peers only know per-message keys
+                        peer_key = self.user_public_keys[self.selected_user]
+                        if peer_key.key_type == "x25519":
+                            encrypted = self.sessions.encrypt(username, self.selected_user, peer_key, message)
+                        else:
+                            encrypted = encrypt_message(peer_key, message)
                         message_package = {
                             "type": "private_message",
                             "sender": username,
                             "recipient": self.selected_user,
-                            "encrypted_key": base64.b64encode(encrypted_key).decode('utf-8'),
-                            "iv": base64.b64encode(iv).decode('utf-8'),
-                            "encrypted_message": base64.b64encode(encrypted_message).decode('utf-8')
+                            **encrypted
                         }
                         
                         # Send the encrypted message
-                        self.client_socket.send(json.dumps(message_package).encode('utf-8'))
+                        self.send_to_server(json.dumps(message_package).encode('utf-8'))
                         
                         # Display in our own chat (unencrypted for us)
                         self.update_chat_history(f"[Private to {self.selected_user}] You: {message}")
@@ -364,19 +417,12 @@ class ChatClient:
                 else:
                     # Regular public message
                     full_message = f"{username}: {message}"
-                    self.client_socket.send(full_message.encode('utf-8'))
+                    self.send_to_server(full_message.encode('utf-8'))
                 
                 self.message_input.delete(0, tk.END)
                 
                 # Reset typing status when message is sent
-                if self.is_typing:
-                    self.is_typing = False
-                    self.send_typing_status(False)
-                    
-                # Cancel any pending typing timer
-                if self.typing_timer:
-                    self.root.after_cancel(self.typing_timer)
-                    self.typing_timer = None
+                self.reset_typing_status()
             except Exception as e:
                 self.update_chat_history(f"Failed to send message: {str(e)}")
                 self.disconnect_from_server()
@@ -403,9 +449,9 @@ class ChatClient:
             messagebox.showinfo("Private Chat", "Please select a user from the list first.")
             return
             
-        # Request the public key if we don't have it
+        # Find the public key if we don't have it
         if self.selected_user not in self.user_public_keys:
-            self.request_public_key(self.selected_user)
+            self.find_public_key(self.selected_user)
             
         # Update UI to show we're in private mode
         self.private_mode = True
@@ -414,11 +460,13 @@ class ChatClient:
         self.private_chat_button.config(state=tk.DISABLED)
         
         # Clear chat history for privacy
+        self.clear_scrollback()
         self.chat_history.config(state='normal')
         self.chat_history.delete(1.0, tk.END)
         self.chat_history.config(state='disabled')
         
         self.update_chat_history(f"Started private chat with {self.selected_user}. Messages are end-to-end encrypted.")
+        self.reset_history_paging()
     
     def return_to_public_chat(self):
         """Return to public chat mode"""
@@ -429,17 +477,190 @@ class ChatClient:
         self.private_chat_button.config(state=tk.NORMAL)
         
         # Clear chat history for privacy
+        self.clear_scrollback()
         self.chat_history.config(state='normal')
         self.chat_history.delete(1.0, tk.END)
         self.chat_history.config(state='disabled')
         
         self.update_chat_history("Returned to public chat.")
+        self.reset_history_paging()
+    
+    def reset_history_paging(self):
+        """Start paging older messages from the newest one again"""
+        self.history_cursor = None
+        self.history_exhausted = False
+        self.older_messages_button.config(state=tk.NORMAL)
+    
+    def request_older_messages(self):
+        """Ask the server for the page of messages before the oldest one shown"""
+        if not self.connected or self.history_exhausted:
+            return
+        
+        request = {
+            "type": "history_request",
+            "conversation": "private" if self.private_mode else "public",
+            "limit": HISTORY_PAGE_SIZE,
+            "before": self.history_cursor
+        }
+        if self.private_mode:
+            request["peer"] = self.selected_user
+        
+        try:
+            self.send_to_server(json.dumps(request).encode('utf-8'))
+            self.history_request_pending = True
+        except Exception as e:
+            self.update_chat_history(f"Failed to request older messages: {str(e)}")
+    
+    def show_history_page(self, data):
+        """Insert one history_page above the messages already shown"""
+        if data.get("error"):
+            self.history_request_pending = False
+            self.update_chat_history(f"Could not load older messages: {data['error']}")
+            return
+        
+        # Pages arrive newest first; show them oldest first at the top
+        lines = [f"| {msg['timestamp']} | {msg['username']}: {msg['message']}"
+                 for msg in reversed(data.get("messages", []))]
+        if lines:
+            # Older than anything stored; shown now if the widget starts at the oldest stored line
+            at_top = self.view_start == self.scrollback.start
+            self.scrollback.prepend(lines)
+            if at_top:
+                self.chat_history.config(state='normal')
+                self.chat_history.insert(1.0, "\n".join(lines) + "\n")
+                self.view_start = self.scrollback.start
+                self.trim_chat_bottom()
+                self.chat_history.see(1.0)
+                self.chat_history.config(state='disabled')
+        
+        if data.get("final"):
+            self.history_request_pending = False
+            self.history_cursor = data.get("next_cursor")
+            if self.history_cursor is None:
+                self.history_exhausted = True
+                self.older_messages_button.config(state=tk.DISABLED)
+    
+    def note_epoch(self, epoch):
+        """Forget the last message id if it came from another run of the server"""
+        if epoch != self.server_epoch:
+            self.server_epoch = epoch
+            self.last_message_id = None
+    
+    def note_message_id(self, message_id):
+        """Remember the highest public message id seen so far"""
+        if message_id is not None and (self.last_message_id is None or message_id > self.last_message_id):
+            self.last_message_id = message_id
     
     def update_users_list(self):
         """Update the list of active users"""
         self.users_listbox.delete(0, tk.END)
         for user in self.active_users:
             self.users_listbox.insert(tk.END, user)
+        self.fetch_keys(self.active_users[:KEY_PREFETCH_MAX])
+    
+    def apply_presence_delta(self, joined, left):
+        """Apply a presence delta to the list of active users without rebuilding it"""
+        for user in left:
+            if user in self.active_users:
+                index = self.active_users.index(user)
+                self.active_users.pop(index)
+                self.users_listbox.delete(index)
+        for user in joined:
+            if user not in self.active_users:
+                self.active_users.append(user)
+                self.users_listbox.insert(tk.END, user)
+        if len(self.keys_requested) < KEY_PREFETCH_MAX:
+            self.fetch_keys(joined)
+    
+    def publish_keys(self):
+        """Put our public keys in the server's key directory"""
+        if not self.connected or self.identity is None:
+            return
+        
+        request = {
+            "type": "publish_keys",
+            "keys": [self.identity.public_key_fields(key_type) for key_type in KEY_TYPES if self.identity.has(key_type)]
+        }
+        
+        try:
+            self.send_to_server(json.dumps(request).encode('utf-8'))
+        except Exception as e:
+            self.update_chat_history(f"Failed to publish public keys: {str(e)}")
+    
+    def fetch_keys(self, usernames):
+        """Look up the keys of users not looked up yet, KEYS_BATCH_SIZE per get_keys request"""
+        me = self.username_input.get().strip()
+        wanted = [user for user in dict.fromkeys(usernames) if user != me and user not in self.keys_requested]
+        if not wanted or not self.connected:
+            return
+        self.keys_requested.update(wanted)
+        
+        try:
+            for start in range(0, len(wanted), KEYS_BATCH_SIZE):
+                request = {"type": "get_keys", "usernames": wanted[start:start + KEYS_BATCH_SIZE]}
+                self.send_to_server(json.dumps(request).encode('utf-8'))
+        except Exception as e:
+            self.update_chat_history(f"Failed to request public keys: {str(e)}")
+    
+    def find_public_key(self, username):
+        """Get a peer's key from the key cache, else from the server's directory.
+        
+        A cached key is used right away and still looked up once per
+        connection, so a changed key is noticed. Users without a key in the
+        directory are asked for one directly.
+        """
+        try:
+            peer_key = self.key_cache.get(username)
+        except KeystoreError:
+            peer_key = None
+        if peer_key is not None:
+            self.user_public_keys[username] = peer_key
+            self.fetch_keys([username])
+            return
+        
+        self.keys_wanted.add(username)
+        if username in self.keys_requested:
+            # Looked up before and not found; the directory may have it by now
+            self.keys_requested.discard(username)
+        self.fetch_keys([username])
+    
+    def remember_peer_key(self, username, fields):
+        """Pin and use a peer's key; returns its PeerKey, or None if it does not verify"""
+        try:
+            peer_key, previous = self.key_cache.remember(username, fields)
+        except KeystoreError as e:
+            self.update_chat_history(f"Rejected encryption key from {username}: {e}")
+            return None
+        
+        self.user_public_keys[username] = peer_key
+        if previous is not None:
+            self.sessions.forget(username)
+            self.update_chat_history(
+                f"WARNING: the encryption key of {username} has changed. "
+                f"Was {format_fingerprint(previous)}, now {format_fingerprint(self.key_cache.fingerprint(username))}")
+        return peer_key
+    
+    def save_key_cache(self):
+        """Write newly pinned keys to the key cache file"""
+        try:
+            self.key_cache.save()
+        except OSError as e:
+            self.update_chat_history(f"Failed to save the key cache: {str(e)}")
+    
+    def show_fingerprints(self):
+        """Show the fingerprints of our keys and of the peers' keys in use"""
+        lines = []
+        if self.identity is None:
+            lines.append("Your keys are still being prepared")
+        else:
+            for key_type in KEY_TYPES:
+                if self.identity.has(key_type):
+                    fingerprint = key_fingerprint(self.identity.public_key_fields(key_type))
+                    lines.append(f"You ({key_type}): {format_fingerprint(fingerprint)}")
+        for username in sorted(self.user_public_keys):
+            lines.append(f"{username} ({self.user_public_keys[username].key_type}): "
+                         f"{format_fingerprint(self.key_cache.fingerprint(username))}")
+        messagebox.showinfo("Key Fingerprints", "\n".join(lines))
     
     def request_public_key(self, username):
         """Request the public key of another user"""
@@ -449,63 +670,105 @@ class ChatClient:
         request = {
             "type": "public_key_request",
             "requester": self.username_input.get().strip(),
-            "target": username
+            "target": username,
+            "key_types": list(KEY_TYPES)
         }
         
         try:
-            self.client_socket.send(json.dumps(request).encode('utf-8'))
+            self.send_to_server(json.dumps(request).encode('utf-8'))
             self.update_chat_history(f"Requesting encryption key from {username}...")
         except Exception as e:
             self.update_chat_history(f"Failed to request public key: {str(e)}")
     
-    def send_public_key(self, requester):
-        """Send our public key to another user who requested it"""
+    def send_public_key(self, requester, key_type):
+        """Send our public key of key_type to another user who requested it"""
         if not self.connected:
             return
             
-        # Serialize the public key to PEM format
-        pem = self.public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        ).decode('utf-8')
-        
         response = {
             "type": "public_key_response",
             "sender": self.username_input.get().strip(),
             "recipient": requester,
-            "public_key": pem
+            **self.identity.public_key_fields(key_type)
         }
         
         try:
-            self.client_socket.send(json.dumps(response).encode('utf-8'))
+            self.send_to_server(json.dumps(response).encode('utf-8'))
         except Exception as e:
             self.update_chat_history(f"Failed to send public key: {str(e)}")
     
+    def prepare_identity(self, key_type):
+        """Load or generate the keys of key_type on a background thread"""
+        if self.identity_busy:
+            return
+        self.identity_busy = True
+        threading.Thread(target=self.build_identity, args=(key_type,), daemon=True).start()
+    
+    def build_identity(self, key_type):
+        """Key thread: load, create or extend the identity, then hand it to the main loop.
+        
+        Without a keystore the keys only live as long as this client. If the
+        keystore cannot be read the client carries on with unsaved keys.
+        """
+        started = time.perf_counter()
+        identity = self.identity
+        notice = None
+        try:
+            if identity is None and self.keystore_path:
+                identity, created = load_or_create_identity(self.keystore_path, self.keystore_passphrase, key_type)
+                notice = f"Created {key_type} keys in {self.keystore_path}" if created else None
+            elif identity is None:
+                identity = Identity.generate(key_type)
+            elif identity.add_keys(key_type) and self.keystore_path:
+                save_identity(identity, self.keystore_path, self.keystore_passphrase)
+        except (KeystoreError, OSError) as e:
+            notice = f"Keystore unavailable ({e}); using keys for this session only"
+            identity = identity or Identity()
+            identity.add_keys(key_type)
+        self.ui_events.append(("identity", (identity, time.perf_counter() - started, notice)))
+    
+    def identity_ready(self, identity, seconds, notice):
+        """Main loop: take over the keys from the key thread and replay what waited for them"""
+        self.identity = identity
+        self.sessions.identity = identity
+        self.identity_busy = False
+        if self.identity_seconds is None:
+            self.identity_seconds = seconds
+        if notice:
+            self.update_chat_history(notice)
+        self.publish_keys()
+        waiting, self.awaiting_identity = self.awaiting_identity, []
+        for message in waiting:
+            self.handle_server_message(message)
+    
+    def wait_for_identity(self, message, key_type):
+        """Keep a server message until the keys of key_type exist"""
+        self.awaiting_identity.append(message)
+        self.prepare_identity(key_type)
+    
     def handle_typing(self, event=None):
         """Handle typing events to send typing indicators"""
         if not self.connected:
             return
             
-        # If user is typing and hasn't sent a typing indicator yet
-        if self.message_input.get() and not self.is_typing:
-            self.is_typing = True
-            self.send_typing_status(True)
-            
-            # Set a timer to reset typing status after 2 seconds of inactivity
-            if self.typing_timer:
-                self.root.after_cancel(self.typing_timer)
-            self.typing_timer = self.root.after(2000, self.reset_typing_status)
+        # If user is typing, send the indicator, refreshing it at most once per interval
+        # so the server does not let it expire
+        if self.message_input.get():
+            now = time.monotonic()
+            if not self.is_typing or now - self.last_typing_sent >= TYPING_REFRESH_INTERVAL:
+                self.is_typing = True
+                self.last_typing_sent = now
+                self.send_typing_status(True)
         
         # If input is empty, immediately reset typing status
-        elif not self.message_input.get() and self.is_typing:
+        elif self.is_typing:
             self.reset_typing_status()
             
     def reset_typing_status(self):
-        """Reset typing status after inactivity"""
+        """Tell the server the user stopped typing"""
         if self.is_typing:
             self.is_typing = False
             self.send_typing_status(False)
-        self.typing_timer = None
         
     def send_typing_status(self, is_typing):
         """Send typing status to server"""
@@ -515,139 +778,323 @@ class ChatClient:
         try:
             username = self.username_input.get().strip()
             if is_typing:
-                self.client_socket.send(f"TYPING:{username}".encode('utf-8'))
+                self.send_to_server(f"TYPING:{username}".encode('utf-8'))
             else:
-                self.client_socket.send(f"STOPPED_TYPING:{username}".encode('utf-8'))
+                self.send_to_server(f"STOPPED_TYPING:{username}".encode('utf-8'))
         except Exception as e:
             self.update_chat_history(f"Failed to send typing status: {str(e)}")
             self.disconnect_from_server()
     
     def receive_messages(self):
+        decoder = FrameDecoder()
         while self.connected:
             try:
-                message = self.client_socket.recv(4096).decode('utf-8')  # Increased buffer size for encrypted messages
-                if message:
-                    # Try to parse as JSON first (for chat history, typing indicators, or private messages)
-                    try:
-                        data = json.loads(message)
-                        message_type = data.get("type", "")
-                        
-                        if message_type == "history":
-                            self.update_chat_history("=== CHAT HISTORY BY USER ===")
-                            
-                            # Display messages grouped by user in a table-like format
-                            user_messages = data.get("userMessages", {})
-                            if not user_messages:
-                                self.update_chat_history("No chat history available.")
-                            
-                            for username, messages in user_messages.items():
-                                # Create a header for each user's messages
-                                self.update_chat_history(f"\n--- {username}'s Messages ---")
-                                self.update_chat_history("| Timestamp           | Message")
-                                self.update_chat_history("|--------------------|-----------------------")
-                                
-                                # Display each message in a table-like format
-                                for msg in messages:
-                                    formatted_msg = f"| {msg['timestamp']} | {msg['message']}"
-                                    self.update_chat_history(formatted_msg)
-                                
-                            self.update_chat_history("\n=== END OF CHAT HISTORY ===")
-                            
-                        elif message_type == "typing":
-                            # Handle typing indicator
-                            username = data.get("username")
-                            is_typing = data.get("isTyping", False)
-                            
-                            if is_typing:
-                                # Add user to typing users set
-                                self.typing_users.add(username)
-                            else:
-                                # Remove user from typing users set
-                                if username in self.typing_users:
-                                    self.typing_users.remove(username)
-                            
-                            # Update typing indicator display
-                            self.update_typing_indicator()
-                            
-                        elif message_type == "user_list":
-                            # Update the list of active users
-                            self.active_users = data.get("users", [])
-                            self.update_users_list()
-                            
-                        elif message_type == "public_key_request":
-                            # Someone is requesting our public key
-                            requester = data.get("requester")
-                            self.send_public_key(requester)
-                            
-                        elif message_type == "public_key_response":
-                            # Received someone's public key
-                            sender = data.get("sender")
-                            key_data = data.get("public_key")
-                            
-                            # Deserialize the public key
-                            public_key = serialization.load_pem_public_key(
-                                key_data.encode('utf-8'),
-                                backend=default_backend()
-                            )
-                            
-                            # Store the public key
-                            self.user_public_keys[sender] = public_key
-                            self.update_chat_history(f"Received encryption key from {sender}")
-                            
-                        elif message_type == "private_message":
-                            # Handle private encrypted message
-                            sender = data.get("sender")
-                            recipient = data.get("recipient")
-                            
-                            # Only process if we're the intended recipient
-                            if recipient == self.username_input.get().strip():
-                                try:
-                                    # Decrypt the AES key with our private key
-                                    encrypted_key = base64.b64decode(data.get("encrypted_key"))
-                                    iv = base64.b64decode(data.get("iv"))
-                                    encrypted_message = base64.b64decode(data.get("encrypted_message"))
-                                    
-                                    aes_key = self.private_key.decrypt(
-                                        encrypted_key,
-                                        padding.OAEP(
-                                            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                                            algorithm=hashes.SHA256(),
-                                            label=None
-                                        )
-                                    )
-                                    
-                                    # Decrypt the message with the AES key
-                                    cipher = Cipher(algorithms.AES(aes_key), modes.CFB(iv), backend=default_backend())
-                                    decryptor = cipher.decryptor()
-                                    decrypted_message = decryptor.update(encrypted_message) + decryptor.finalize()
-                                    
-                                    # Display the decrypted message
-                                    self.update_chat_history(f"[Private from {sender}] {decrypted_message.decode('utf-8')}")
-                                    
-                                    # If we're not already in a private chat with this sender, ask if we want to switch
-                                    if not (self.private_mode and self.selected_user == sender):
-                                        if messagebox.askyesno("Private Message", 
-                                                              f"You received a private message from {sender}. Switch to private chat with them?"):
-                                            self.selected_user = sender
-                                            self.start_private_chat()
-                                except Exception as e:
-                                    self.update_chat_history(f"Error decrypting private message: {str(e)}")
-                        else:
-                            # Unknown JSON message type
-                            self.update_chat_history(message)
-                    except json.JSONDecodeError:
-                        # Not JSON, treat as regular message
-                        self.update_chat_history(message)
+                received = decoder.recv_into(self.client_socket)
+                if received:
+                    # A single recv may hold several frames, or only part of one;
+                    # Tk is only touched from the main loop, so hand them over
+                    for frame in decoder.frames():
+                        self.ui_events.append(("message", frame.decode('utf-8')))
                 else:
                     # Empty message means server closed connection
-                    self.update_chat_history("Connection to server lost")
-                    self.disconnect_from_server()
+                    self.ui_events.append(("lost", "Connection to server lost"))
                     break
             except Exception as e:
                 if self.connected:  # Only show error if we haven't manually disconnected
-                    self.update_chat_history(f"Error receiving message: {str(e)}")
-                    self.disconnect_from_server()
+                    self.ui_events.append(("lost", f"Error receiving message: {str(e)}"))
                 break
+    
+    def drain_ui_events(self):
+        """Apply queued server messages on the Tk main loop, within one frame budget.
+        
+        All chat lines produced in the frame are inserted together, with one
+        state toggle and one scroll. Whatever does not fit in the budget is
+        left for the next frame, which then comes right away.
+        """
+        started = time.perf_counter()
+        deadline = started + UI_FRAME_BUDGET
+        handled = 0
+        while self.ui_events and time.perf_counter() < deadline:
+            kind, payload = self.ui_events.popleft()
+            if kind == "message":
+                self.handle_server_message(payload)
+            elif kind == "identity":
+                self.identity_ready(*payload)
+            else:
+                self.update_chat_history(payload)
+                self.disconnect_from_server()
+            handled += 1
+        self.flush_chat_lines()
+        
+        if handled:
+            elapsed = time.perf_counter() - started
+            self.ui_frames += 1
+            self.ui_events_handled += handled
+            self.ui_frame_seconds += elapsed
+            self.ui_max_frame_seconds = max(self.ui_max_frame_seconds, elapsed)
+        
+        self.root.after(1 if self.ui_events else UI_FRAME_INTERVAL, self.drain_ui_events)
+    
+    def flush_chat_lines(self):
+        """Store every pending chat line and insert them at once"""
+        if not self.pending_lines:
+            return
+        lines = []
+        for _ in range(len(self.pending_lines)):
+            lines.extend(self.pending_lines.popleft().split("\n"))
+        following = self.view_end == self.scrollback.end
+        self.scrollback.extend(lines)
+        self.ui_lines += len(lines)
+        if not following:
+            # The user is reading older lines; these are shown on scrolling back down
+            return
+        
+        self.chat_history.config(state='normal')
+        self.chat_history.insert(tk.END, "\n".join(lines) + "\n")
+        self.view_end = self.scrollback.end
+        self.trim_chat_top()
+        self.chat_history.see(tk.END)  # Scroll to the end
+        self.chat_history.config(state='disabled')
+    
+    def trim_chat_top(self):
+        """Drop the oldest widget lines, SCROLLBACK_TRIM at a time, down to SCROLLBACK_LINES"""
+        while self.view_end - self.view_start > SCROLLBACK_LINES:
+            self.chat_history.delete("1.0", f"{SCROLLBACK_TRIM + 1}.0")
+            self.view_start += SCROLLBACK_TRIM
+    
+    def trim_chat_bottom(self):
+        """Drop the newest widget lines, SCROLLBACK_TRIM at a time, down to SCROLLBACK_LINES"""
+        while self.view_end - self.view_start > SCROLLBACK_LINES:
+            keep = self.view_end - self.view_start - SCROLLBACK_TRIM
+            self.chat_history.delete(f"{keep + 1}.0", tk.END)
+            self.view_end -= SCROLLBACK_TRIM
+    
+    def clear_scrollback(self):
+        """Forget every line shown so far, e.g. when the chat is cleared"""
+        self.pending_lines.clear()
+        self.scrollback.clear()
+        self.view_start = self.view_end = self.scrollback.end
+    
+    def on_chat_scroll(self, first, last):
+        """Scrollbar callback; brings lines back when the view reaches either end of the widget"""
+        self.chat_history.vbar.set(first, last)
+        first, last = float(first), float(last)
+        at_top = first <= 0.0 and last < 1.0
+        at_bottom = last >= 1.0 and self.view_end < self.scrollback.end
+        if (at_top or at_bottom) and not self.scroll_update_pending:
+            # Not from inside the scroll callback, which runs while the widget updates
+            self.scroll_update_pending = True
+            self.root.after_idle(self.show_scrolled_lines)
+    
+    def show_scrolled_lines(self):
+        """Re-insert stored lines above or below the widget's window, whichever end is in view"""
+        self.scroll_update_pending = False
+        first, last = self.chat_history.yview()
+        top_line = int(self.chat_history.index("@0,0").split(".")[0])
+        
+        if first <= 0.0 and last < 1.0:
+            older = self.scrollback.lines(self.view_start - SCROLLBACK_TRIM, self.view_start)
+            if not older:
+                # Nothing older in memory; page it in from the server
+                if not self.history_request_pending:
+                    self.request_older_messages()
+                return
+            self.chat_history.config(state='normal')
+            self.chat_history.insert("1.0", "\n".join(older) + "\n")
+            self.view_start -= len(older)
+            self.trim_chat_bottom()
+            self.chat_history.config(state='disabled')
+            # Keep the line that was at the top in place
+            self.chat_history.yview(f"{top_line + len(older)}.0")
+        
+        elif last >= 1.0 and self.view_end < self.scrollback.end:
+            newer = self.scrollback.lines(self.view_end, self.view_end + SCROLLBACK_TRIM)
+            view_start = self.view_start
+            self.chat_history.config(state='normal')
+            self.chat_history.insert(tk.END, "\n".join(newer) + "\n")
+            self.view_end += len(newer)
+            self.trim_chat_top()
+            self.chat_history.config(state='disabled')
+            self.chat_history.yview(f"{max(top_line - (self.view_start - view_start), 1)}.0")
+    
+    def ui_stats(self):
+        """Return a snapshot of the UI update counters"""
+        uptime = max(time.monotonic() - self.ui_started, 1e-6)
+        return {
+            'queued': len(self.ui_events),
+            'events': self.ui_events_handled,
+            'lines': self.ui_lines,
+            'lines_per_sec': round(self.ui_lines / uptime, 1),
+            'frames': self.ui_frames,
+            'avg_frame_ms': round(self.ui_frame_seconds * 1000 / self.ui_frames, 2) if self.ui_frames else 0,
+            'max_frame_ms': round(self.ui_max_frame_seconds * 1000, 2),
+            'widget_lines': self.view_end - self.view_start,
+            'stored_lines': len(self.scrollback),
+            'key_ms': round(self.identity_seconds * 1000, 1) if self.identity_seconds is not None else None,
+            'private_sessions': self.sessions.stats(),
+        }
+    
+    def show_ui_stats(self):
+        """Show the UI update counters"""
+        messagebox.showinfo("UI Statistics", "\n".join(f"{key}: {value}" for key, value in self.ui_stats().items()))
+    
+    def handle_server_message(self, message):
+        """Handle one complete message received from the server"""
+        # Try to parse as JSON first (for chat history, typing indicators, or private messages)
+        try:
+            data = json.loads(message)
+            message_type = data.get("type", "")
+            
+            if message_type == "history":
+                self.note_epoch(data.get("epoch"))
+                self.update_chat_history("=== CHAT HISTORY BY USER ===")
+                
+                # Display messages grouped by user in a table-like format
+                user_messages = data.get("userMessages", {})
+                if not user_messages:
+                    self.update_chat_history("No chat history available.")
+                
+                for username, messages in user_messages.items():
+                    # Create a header for each user's messages
+                    self.update_chat_history(f"\n--- {username}'s Messages ---")
+                    self.update_chat_history("| Timestamp           | Message")
+                    self.update_chat_history("|--------------------|-----------------------")
+                    
+                    # Display each message in a table-like format
+                    for msg in messages:
+                        formatted_msg = f"| {msg['timestamp']} | {msg['message']}"
+                        self.update_chat_history(formatted_msg)
+                        self.note_message_id(msg.get("id"))
+                    
+                self.update_chat_history("\n=== END OF CHAT HISTORY ===")
+                
+            elif message_type == "history_delta":
+                # Messages we missed while disconnected
+                self.note_epoch(data.get("epoch"))
+                for msg in data.get("messages", []):
+                    self.update_chat_history(f"{msg['username']}: {msg['message']}")
+                    self.note_message_id(msg.get("id"))
+                
+            elif message_type == "chat":
+                # Public message from another user
+                self.update_chat_history(f"{data.get('username')}: {data.get('message')}")
+                self.note_message_id(data.get("id"))
+                
+            elif message_type == "chat_ack":
+                # Our own public message was given an id
+                self.note_message_id(data.get("id"))
+                
+            elif message_type == "typing":
+                # Handle typing indicator
+                username = data.get("username")
+                is_typing = data.get("isTyping", False)
+                
+                if is_typing:
+                    # Add user to typing users set
+                    self.typing_users.add(username)
+                else:
+                    # Remove user from typing users set
+                    if username in self.typing_users:
+                        self.typing_users.remove(username)
+                
+                # Update typing indicator display
+                self.update_typing_indicator()
+                
+            elif message_type == "typing_state":
+                # Everyone typing right now, including possibly ourselves
+                username = self.username_input.get().strip()
+                self.typing_users = set(data.get("typing", [])) - {username}
+                self.update_typing_indicator()
+                
+            elif message_type == "user_list":
+                # Full snapshot of the active users
+                self.active_users = data.get("users", [])
+                self.presence_version = data.get("version")
+                self.update_users_list()
+                
+            elif message_type == "presence_delta":
+                # Incremental change to the active users
+                if data.get("base_version") != self.presence_version:
+                    # Missed a delta; ask for a fresh snapshot
+                    self.send_to_server(json.dumps({"type": "presence_sync"}).encode('utf-8'))
+                else:
+                    self.apply_presence_delta(data.get("joined", []), data.get("left", []))
+                    self.presence_version = data.get("version")
+                
+            elif message_type == "history_page":
+                # A page of older messages we asked for
+                self.show_history_page(data)
+                
+            elif message_type == "public_key_request":
+                # Someone is requesting our public key; answer with the best type we share
+                requester = data.get("requester")
+                key_type = choose_key_type(data.get("key_types"))
+                if self.identity is None or not self.identity.has(key_type):
+                    self.wait_for_identity(message, key_type)
+                    return
+                self.send_public_key(requester, key_type)
+                
+            elif message_type == "public_key_response":
+                # Received someone's public key
+                sender = data.get("sender")
+                if self.remember_peer_key(sender, data):
+                    self.update_chat_history(f"Received encryption key from {sender}")
+                self.save_key_cache()
+                
+            elif message_type == "keys":
+                # Keys from the server's directory, for many users at once
+                for username, keys in data.get("keys", {}).items():
+                    fields = best_key(keys)
+                    if fields is not None and self.remember_peer_key(username, fields) and username in self.keys_wanted:
+                        self.keys_wanted.discard(username)
+                        self.update_chat_history(f"Received encryption key from {username}")
+                for username in data.get("missing", []):
+                    if username in self.keys_wanted:
+                        # Not in the directory, so ask the user itself
+                        self.keys_wanted.discard(username)
+                        self.request_public_key(username)
+                self.save_key_cache()
+                
+            elif message_type == "keys_published":
+                # Our keys are in the directory
+                pass
+                
+            elif message_type == "keys_error":
+                self.update_chat_history(f"Could not publish encryption keys: {data.get('error')}")
+                
+            elif message_type == "private_message":
+                # Handle private encrypted message
+                sender = data.get("sender")
+                recipient = data.get("recipient")
+                if self.identity is None:
+                    self.wait_for_identity(message, self.key_type)
+                    return
+                
+                # Only process if we're the intended recipient
+                if recipient == self.username_input.get().strip():
+                    try:
+                        if data.get("scheme") == SESSION_SCHEME:
+                            decrypted_message = self.sessions.decrypt(sender, recipient, data)
+                        else:
+                            decrypted_message = decrypt_message(self.identity, data)
+                        
+                        # Display the decrypted message
+                        self.update_chat_history(f"[Private from {sender}] {decrypted_message}")
+                        
+                        # If we're not already in a private chat with this sender, ask if we want to switch
+                        if not (self.private_mode and self.selected_user == sender):
+                            if messagebox.askyesno("Private Message", 
+                                                  f"You received a private message from {sender}. Switch to private chat with them?"):
+                                self.selected_user = sender
+                                self.start_private_chat()
+                    except Exception as e:
+                        self.update_chat_history(f"Error decrypting private message: {str(e)}")
+            else:
+                # Unknown JSON message type
+                self.update_chat_history(message)
+        except json.JSONDecodeError:
+            # Not JSON, treat as regular message
+            self.update_chat_history(message)
                 
     def update_typing_indicator(self):
         """Update the typing indicator label based on who is typing"""
@@ -661,10 +1108,8 @@ class ChatClient:
             self.typing_label.config(text=f"{users_text} are typing...")
     
     def update_chat_history(self, message):
-        self.chat_history.config(state='normal')
-        self.chat_history.insert(tk.END, message + "\n")
-        self.chat_history.see(tk.END)  # Scroll to the end
-        self.chat_history.config(state='disabled')
+        """Add a line to the chat; it is shown with the next frame"""
+        self.pending_lines.append(message)
     
     def apply_theme(self, theme_name):
         """Apply the selected theme to all UI elements"""
@@ -765,21 +1210,26 @@ class ChatClient:
         self.root.destroy()
 
 def main():
+    parser = argparse.ArgumentParser(description="Chat client")
+    parser.add_argument("--auto", type=int, nargs='?', const=0, metavar="INDEX",
+                        help="Connect right away under a predefined username (used by run_multiple_clients.py)")
+    parser.add_argument("--key-type", choices=KEY_TYPES, default=DEFAULT_KEY_TYPE,
+                        help="Identity key type offered to peers first")
+    parser.add_argument("--keystore", metavar="PATH",
+                        help=f"Keep the identity keys in this file (passphrase from {KEYSTORE_PASSPHRASE_ENV} or a prompt)")
+    parser.add_argument("--key-cache", metavar="PATH",
+                        help="Keep peers' public keys in this file (default: next to the keystore, if there is one)")
+    args = parser.parse_args()
+    key_cache = args.key_cache or (args.keystore + ".peers" if args.keystore else None)
+    
     root = tk.Tk()
     
     # Generate a random username if launched from multi-client script
     import random
-    import os
     
     # Check if this is being launched from the multi-client script
-    if len(sys.argv) > 1 and sys.argv[1] == "--auto":
-        # Get the index from command line if provided
-        index = 0
-        if len(sys.argv) > 2:
-            try:
-                index = int(sys.argv[2])
-            except ValueError:
-                pass
+    if args.auto is not None:
+        index = args.auto
                 
         # List of predefined usernames
         usernames = ["Alice", "Bob", "Charlie", "David", "Eva", 
@@ -791,7 +1241,7 @@ def main():
         else:
             username = f"User{random.randint(1000, 9999)}"
             
-        app = ChatClient(root)
+        app = ChatClient(root, key_type=args.key_type, keystore_path=args.keystore, key_cache_path=key_cache)
         # Set the username
         app.username_input.delete(0, tk.END)
         app.username_input.insert(0, username)
@@ -799,21 +1249,16 @@ def main():
         root.after(500, app.connect_to_server)
     else:
         # Normal launch
-        app = ChatClient(root)
+        app = ChatClient(root, key_type=args.key_type, keystore_path=args.keystore, key_cache_path=key_cache)
     
     # Position windows in a cascade if multiple clients
-    if len(sys.argv) > 2:
-        try:
-            index = int(sys.argv[2])
-            # Offset each window by 30 pixels
-            x_offset = 100 + (index * 30)
-            y_offset = 100 + (index * 30)
-            root.geometry(f"+{x_offset}+{y_offset}")
-        except ValueError:
-            pass
+    if args.auto is not None:
+        # Offset each window by 30 pixels
+        x_offset = 100 + (args.auto * 30)
+        y_offset = 100 + (args.auto * 30)
+        root.geometry(f"+{x_offset}+{y_offset}")
     
     root.mainloop()
 
 if __name__ == "__main__":
-    import sys
     main()
\ No newline at end of file
@@ -5,10 +5,18 @@ This script provides utilities to manage the chat application database.
 """
 
 import argparse
+import csv
+import json
+import os
 import psycopg2
 import sys
+import time
 import logging
 from datetime import datetime, timedelta
+from partitions import (PARTITIONED_TABLES, DEFAULT_MONTHS_AHEAD, is_partitioned, create_partitions,
+                        expired_partitions, drop_partition)
+from search import search_messages
+from transfer import TABLES, COMPRESSIONS, TransferError, export_tables, import_tables
 
 # Configure logging
 logging.basicConfig(
@@ -30,6 +38,22 @@ DB_CONFIG = {
     'port': '5432'  # Default PostgreSQL port
 }
 
+# Rows fetched per round trip by the listing commands' server-side cursors
+LIST_BATCH_SIZE = 2000
+
+# Output formats of the listing commands
+OUTPUT_FORMATS = ("table", "csv", "jsonl")
+
+# Rows deleted per transaction by purge-messages and delete-user
+DEFAULT_DELETE_BATCH = 5000
+
+# Channel the chat server listens on to drop changed users from its cache
+USER_CHANGED_CHANNEL = "chat_user_changed"
+
+def notify_user_changed(cursor, username):
+    """Tell running chat servers to forget their cached copy of a user (sent on commit)"""
+    cursor.execute("SELECT pg_notify(%s, %s)", (USER_CHANGED_CHANNEL, username))
+
 def get_db_connection():
     """Create and return a database connection"""
     try:
@@ -41,92 +65,258 @@ def get_db_connection():
         logger.error(f"Database connection error: {e}")
         return None
 
-def list_users():
-    """List all users in the database"""
+def count_rows(cursor, table, condition, params):
+    """Return how many rows of table match condition"""
+    cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE {condition}", params)
+    return cursor.fetchone()[0]
+
+def delete_in_batches(conn, table, condition, params, batch_size=DEFAULT_DELETE_BATCH, max_rate=None):
+    """Delete the rows of table matching condition, batch_size rows per transaction.
+    
+    Batches walk the primary key upwards, so with an index on (column, id)
+    for the condition's column, as the server creates for sender_id, each
+    one is a short index range scan; live inserts are only ever blocked for
+    one batch. Progress is
+    printed after every batch, and if max_rate is given the deletes are
+    slowed down to at most that many rows per second. Every batch is
+    committed, so an interrupted run can simply be started again.
+    
+    Returns the number of rows deleted.
+    """
+    cursor = conn.cursor()
+    deleted = 0
+    last_id = 0
+    started = time.monotonic()
+    try:
+        while True:
+            cursor.execute(f"""
+                DELETE FROM {table} WHERE id IN (
+                    SELECT id FROM {table}
+                    WHERE {condition} AND id > %s
+                    ORDER BY id
+                    LIMIT %s
+                )
+                RETURNING id
+            """, params + (last_id, batch_size))
+            ids = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+            if not ids:
+                break
+            deleted += len(ids)
+            last_id = max(ids)
+            
+            elapsed = time.monotonic() - started
+            if max_rate:
+                # Sleep off any lead over the allowed rate
+                ahead = deleted / max_rate - elapsed
+                if ahead > 0:
+                    time.sleep(ahead)
+                    elapsed += ahead
+            print(f"{table}: deleted {deleted} rows ({deleted / max(elapsed, 1e-6):.0f} rows/sec)")
+            
+            if len(ids) < batch_size:
+                break
+    finally:
+        cursor.close()
+    return deleted
+
+def stream_rows(conn, name, query, params=()):
+    """Run query on a named (server-side) cursor and yield its rows.
+    
+    Rows are fetched LIST_BATCH_SIZE at a time, so memory use does not
+    depend on how many rows the query returns.
+    """
+    cursor = conn.cursor(name=name)
+    cursor.itersize = LIST_BATCH_SIZE
+    try:
+        cursor.execute(query, params)
+        yield from cursor
+    finally:
+        cursor.close()
+
+def write_rows(rows, columns, output_format, table_header, table_row):
+    """Write rows to stdout as they arrive; returns how many were written.
+    
+    csv and jsonl write every column as is, with timestamps in ISO format;
+    table writes table_header once and then table_row(row) for each row.
+    """
+    count = 0
+    if output_format == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([value.isoformat() if isinstance(value, datetime) else value for value in row])
+            count += 1
+    elif output_format == "jsonl":
+        for row in rows:
+            sys.stdout.write(json.dumps({
+                column: value.isoformat() if isinstance(value, datetime) else value
+                for column, value in zip(columns, row)
+            }) + "\n")
+            count += 1
+    else:
+        for row in rows:
+            if count == 0:
+                print(table_header)
+            print(table_row(row))
+            count += 1
+    return count
+
+def time_filters(column, since=None, until=None):
+    """Return the SQL conditions and parameters limiting column to [since, until)"""
+    conditions, params = [], []
+    if since:
+        conditions.append(f"{column} >= %s")
+        params.append(since)
+    if until:
+        conditions.append(f"{column} < %s")
+        params.append(until)
+    return conditions, params
+
+def list_users(since=None, until=None, output_format="table"):
+    """List all users in the database, or those created in [since, until)"""
     conn = get_db_connection()
     if not conn:
         return
     
-    cursor = conn.cursor()
     try:
-        cursor.execute("""
+        conditions, params = time_filters("created_at", since, until)
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        users = stream_rows(conn, "list_users", f"""
         SELECT id, username, last_seen, email, is_active, created_at 
         FROM chat_users 
+        {where}
         ORDER BY id
-        """)
+        """, params)
         
-        users = cursor.fetchall()
-        
-        if not users:
-            print("No users found in the database.")
-            return
-            
-        print("\n{:<5} {:<20} {:<30} {:<30} {:<10} {:<20}".format(
-            "ID", "Username", "Email", "Last Seen", "Active", "Created At"))
-        print("-" * 115)
+        header = "\n{:<5} {:<20} {:<30} {:<30} {:<10} {:<20}\n{}".format(
+            "ID", "Username", "Email", "Last Seen", "Active", "Created At", "-" * 115)
         
-        for user in users:
+        def table_row(user):
             user_id, username, last_seen, email, is_active, created_at = user
-            print("{:<5} {:<20} {:<30} {:<30} {:<10} {:<20}".format(
+            return "{:<5} {:<20} {:<30} {:<30} {:<10} {:<20}".format(
                 user_id, 
                 username, 
                 email if email else "N/A", 
                 last_seen.strftime("%Y-%m-%d %H:%M:%S") if last_seen else "Never", 
                 "Yes" if is_active else "No",
                 created_at.strftime("%Y-%m-%d %H:%M:%S") if created_at else "N/A"
-            ))
+            )
+        
+        columns = ["id", "username", "last_seen", "email", "is_active", "created_at"]
+        if not write_rows(users, columns, output_format, header, table_row) and output_format == "table":
+            print("No users found in the database.")
             
+    except BrokenPipeError:
+        # The reader went away, e.g. piped into head; send what is still
+        # buffered to /dev/null so the flush at exit does not fail again
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
     except Exception as e:
         logger.error(f"Error listing users: {e}")
     finally:
-        cursor.close()
         conn.close()
 
-def list_messages(limit=20):
-    """List recent messages in the database"""
+def list_messages(limit=20, since=None, until=None, username=None, output_format="table"):
+    """List messages in the database in chronological order.
+    
+    With a limit only the newest limit messages are listed; a limit of 0
+    lists every message matching the filters.
+    """
     conn = get_db_connection()
     if not conn:
         return
     
-    cursor = conn.cursor()
     try:
-        cursor.execute("""
+        conditions, params = time_filters("m.timestamp", since, until)
+        if username:
+            conditions.append("u.username = %s")
+            params.append(username)
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        query = f"""
         SELECT m.id, u.username, m.message, m.timestamp, m.is_private, r.username as recipient
         FROM chat_messages m
         JOIN chat_users u ON m.sender_id = u.id
         LEFT JOIN chat_users r ON m.recipient_id = r.id
-        ORDER BY m.timestamp DESC
-        LIMIT %s
-        """, (limit,))
-        
-        messages = cursor.fetchall()
+        {where}
+        """
+        if limit:
+            # Newest limit messages, shown in chronological order
+            query = f"""
+            SELECT * FROM ({query} ORDER BY m.timestamp DESC, m.id DESC LIMIT %s) newest
+            ORDER BY timestamp, id
+            """
+            params.append(limit)
+        else:
+            query += " ORDER BY m.timestamp, m.id"
+        messages = stream_rows(conn, "list_messages", query, params)
         
-        if not messages:
-            print("No messages found in the database.")
-            return
-            
-        print("\n{:<5} {:<15} {:<50} {:<20} {:<10} {:<15}".format(
-            "ID", "Sender", "Message", "Timestamp", "Private", "Recipient"))
-        print("-" * 115)
+        header = "\n{:<5} {:<15} {:<50} {:<20} {:<10} {:<15}\n{}".format(
+            "ID", "Sender", "Message", "Timestamp", "Private", "Recipient", "-" * 115)
         
-        for message in reversed(messages):  # Show in chronological order
+        def table_row(message):
             msg_id, username, msg_text, timestamp, is_private, recipient = message
             
             # Truncate long messages
             if len(msg_text) > 47:
                 msg_text = msg_text[:47] + "..."
                 
-            print("{:<5} {:<15} {:<50} {:<20} {:<10} {:<15}".format(
+            return "{:<5} {:<15} {:<50} {:<20} {:<10} {:<15}".format(
                 msg_id, 
                 username, 
                 msg_text, 
                 timestamp.strftime("%Y-%m-%d %H:%M:%S"),
                 "Yes" if is_private else "No",
                 recipient if recipient else "All"
-            ))
+            )
+        
+        columns = ["id", "sender", "message", "timestamp", "is_private", "recipient"]
+        if not write_rows(messages, columns, output_format, header, table_row) and output_format == "table":
+            print("No messages found in the database.")
             
+    except BrokenPipeError:
+        # The reader went away, e.g. piped into head; send what is still
+        # buffered to /dev/null so the flush at exit does not fail again
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
     except Exception as e:
         logger.error(f"Error listing messages: {e}")
+    finally:
+        conn.close()
+
+def search(query, room_id=None, include_private=False, limit=20, offset=0):
+    """Full-text search of messages, best matches first"""
+    conn = get_db_connection()
+    if not conn:
+        return
+    
+    cursor = conn.cursor()
+    try:
+        messages = search_messages(cursor, query, room_id, include_private, limit, offset)
+        
+        if not messages:
+            print(f"No messages match '{query}'.")
+            return
+            
+        print("\n{:<8} {:<8} {:<15} {:<50} {:<20}".format(
+            "Rank", "ID", "Sender", "Message", "Timestamp"))
+        print("-" * 105)
+        
+        for msg_id, username, msg_text, timestamp, rank in messages:
+            # Truncate long messages
+            if len(msg_text) > 47:
+                msg_text = msg_text[:47] + "..."
+                
+            print("{:<8.4f} {:<8} {:<15} {:<50} {:<20}".format(
+                rank,
+                msg_id, 
+                username, 
+                msg_text, 
+                timestamp.strftime("%Y-%m-%d %H:%M:%S")
+            ))
+            
+    except Exception as e:
+        logger.error(f"Error searching messages: {e}")
     finally:
         cursor.close()
         conn.close()
@@ -164,8 +354,12 @@ def create_user(username, email=None, password=None):
         cursor.close()
         conn.close()
 
-def delete_user(username):
-    """Delete a user from the database"""
+def delete_user(username, batch_size=DEFAULT_DELETE_BATCH, max_rate=None, dry_run=False):
+    """Delete a user from the database.
+    
+    The user's messages are deleted in batches first; the user itself goes
+    last, so an interrupted delete can be finished by running it again.
+    """
     conn = get_db_connection()
     if not conn:
         return
@@ -181,28 +375,41 @@ def delete_user(username):
             
         user_id = result[0]
         
+        if dry_run:
+            msg_count = count_rows(cursor, "chat_messages", "sender_id = %s", (user_id,))
+            room_msg_count = count_rows(cursor, "room_messages", "sender_id = %s", (user_id,))
+            print(f"Would delete user '{username}' with {msg_count} messages and {room_msg_count} room messages.")
+            return
+        
         # Delete user's messages
-        cursor.execute("DELETE FROM chat_messages WHERE sender_id = %s", (user_id,))
-        msg_count = cursor.rowcount
+        msg_count = delete_in_batches(conn, "chat_messages", "sender_id = %s", (user_id,),
+                                      batch_size, max_rate)
         
         # Delete user's room messages
-        cursor.execute("DELETE FROM room_messages WHERE sender_id = %s", (user_id,))
-        room_msg_count = cursor.rowcount
+        room_msg_count = delete_in_batches(conn, "room_messages", "sender_id = %s", (user_id,),
+                                           batch_size, max_rate)
         
         # Delete user's room memberships
         cursor.execute("DELETE FROM room_members WHERE user_id = %s", (user_id,))
         
+        # Delete user's published public keys
+        cursor.execute("DELETE FROM user_keys WHERE user_id = %s", (user_id,))
+        
         # Delete rooms created by user
         cursor.execute("DELETE FROM chat_rooms WHERE created_by = %s", (user_id,))
         
         # Finally delete the user
         cursor.execute("DELETE FROM chat_users WHERE id = %s", (user_id,))
+        notify_user_changed(cursor, username)
         
         conn.commit()
         
         print(f"User '{username}' deleted successfully.")
         print(f"Deleted {msg_count} messages and {room_msg_count} room messages.")
         
+    except KeyboardInterrupt:
+        conn.rollback()
+        print(f"Interrupted; run delete-user {username} again to finish.")
     except Exception as e:
         conn.rollback()
         logger.error(f"Error deleting user: {e}")
@@ -210,8 +417,36 @@ def delete_user(username):
         cursor.close()
         conn.close()
 
-def purge_old_messages(days=30):
-    """Delete messages older than specified days"""
+def set_user_theme(username, theme):
+    """Change a user's theme"""
+    conn = get_db_connection()
+    if not conn:
+        return
+    
+    cursor = conn.cursor()
+    try:
+        cursor.execute("UPDATE chat_users SET theme = %s WHERE username = %s", (theme, username))
+        if cursor.rowcount == 0:
+            print(f"User '{username}' does not exist.")
+            return
+        notify_user_changed(cursor, username)
+        
+        conn.commit()
+        print(f"Theme of user '{username}' set to '{theme}'.")
+        
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error setting theme: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+def purge_old_messages(days=30, batch_size=DEFAULT_DELETE_BATCH, max_rate=None, dry_run=False):
+    """Delete messages older than specified days.
+    
+    Partitions of partitioned message tables that only hold older messages
+    are detached and dropped; the rest is deleted in batches.
+    """
     conn = get_db_connection()
     if not conn:
         return
@@ -220,18 +455,37 @@ def purge_old_messages(days=30):
     try:
         cutoff_date = datetime.now() - timedelta(days=days)
         
+        # Drop whole months first, one transaction each
+        dropped = []
+        for table in PARTITIONED_TABLES:
+            if is_partitioned(cursor, table):
+                for name in expired_partitions(cursor, table, cutoff_date):
+                    if not dry_run:
+                        drop_partition(cursor, table, name)
+                        conn.commit()
+                    dropped.append(name)
+        if dropped:
+            print(f"{'Would drop' if dry_run else 'Dropped'} partitions {', '.join(dropped)}.")
+        
+        if dry_run:
+            msg_count = count_rows(cursor, "chat_messages", "timestamp < %s", (cutoff_date,))
+            room_msg_count = count_rows(cursor, "room_messages", "timestamp < %s", (cutoff_date,))
+            print(f"Would purge {msg_count} messages and {room_msg_count} room messages older than {days} days.")
+            return
+        
         # Delete old messages
-        cursor.execute("DELETE FROM chat_messages WHERE timestamp < %s", (cutoff_date,))
-        msg_count = cursor.rowcount
+        msg_count = delete_in_batches(conn, "chat_messages", "timestamp < %s", (cutoff_date,),
+                                      batch_size, max_rate)
         
         # Delete old room messages
-        cursor.execute("DELETE FROM room_messages WHERE timestamp < %s", (cutoff_date,))
-        room_msg_count = cursor.rowcount
-        
-        conn.commit()
+        room_msg_count = delete_in_batches(conn, "room_messages", "timestamp < %s", (cutoff_date,),
+                                           batch_size, max_rate)
         
         print(f"Purged {msg_count} messages and {room_msg_count} room messages older than {days} days.")
         
+    except KeyboardInterrupt:
+        conn.rollback()
+        print("Interrupted; run purge-messages again to finish.")
     except Exception as e:
         conn.rollback()
         logger.error(f"Error purging old messages: {e}")
@@ -239,6 +493,33 @@ def purge_old_messages(days=30):
         cursor.close()
         conn.close()
 
+def create_message_partitions(months_ahead=DEFAULT_MONTHS_AHEAD):
+    """Create the monthly partitions of the message tables for the coming months"""
+    conn = get_db_connection()
+    if not conn:
+        return
+    
+    cursor = conn.cursor()
+    try:
+        for table in PARTITIONED_TABLES:
+            if not is_partitioned(cursor, table):
+                print(f"Table '{table}' is not partitioned.")
+                continue
+            created = create_partitions(cursor, table, months_ahead)
+            if created:
+                print(f"Created partitions {', '.join(created)}.")
+            else:
+                print(f"Partitions of '{table}' are up to date.")
+        
+        conn.commit()
+        
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error creating partitions: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
 def create_room(name, description=None, created_by=None, is_private=False):
     """Create a new chat room"""
     conn = get_db_connection()
@@ -367,6 +648,41 @@ def backup_database(filename=None):
         logger.error(f"Error backing up database: {e}")
         print(f"Error: {e}")
 
+def export_data(directory, tables=None, since=None, until=None, compression="none", workers=4):
+    """Export tables to CSV files with COPY, without pg_dump"""
+    try:
+        logger.info(f"Exporting {', '.join(tables or TABLES)} to {directory}")
+        manifest = export_tables(lambda: psycopg2.connect(**DB_CONFIG), directory, tables or TABLES,
+                                 since, until, compression, workers)
+        total = sum(entry["rows"] for entry in manifest["tables"].values())
+        logger.info(f"Export completed: {total} rows")
+        print(f"Exported {total} rows to {directory}")
+    except (TransferError, psycopg2.Error, OSError) as e:
+        logger.error(f"Error exporting data: {e}")
+        print(f"Error: {e}")
+
+def import_data(directory, tables=None, merge=False, workers=4):
+    """Import the tables of an export directory with COPY"""
+    try:
+        logger.info(f"Importing from {directory}")
+        imported = import_tables(lambda: psycopg2.connect(**DB_CONFIG), directory, tables, merge, workers)
+        logger.info(f"Import completed: {sum(imported.values())} rows")
+        print(f"Imported {sum(imported.values())} rows from {directory}")
+    except (TransferError, psycopg2.Error, OSError) as e:
+        logger.error(f"Error importing data: {e}")
+        print(f"Error: {e}")
+
+def parse_date(value):
+    """Parse a --since/--until date or timestamp"""
+    return datetime.fromisoformat(value)
+
+def add_batch_arguments(parser):
+    """Add the options of commands that delete in batches"""
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_DELETE_BATCH,
+                        help="Rows to delete per transaction")
+    parser.add_argument("--max-rate", type=float, help="Delete at most this many rows per second")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the rows that would be deleted")
+
 def main():
     parser = argparse.ArgumentParser(description="Chat Application Database Management")
     
@@ -374,10 +690,26 @@ def main():
     
     # List users command
     list_users_parser = subparsers.add_parser("list-users", help="List all users")
+    list_users_parser.add_argument("--since", type=parse_date, help="Only users created from this date or time on")
+    list_users_parser.add_argument("--until", type=parse_date, help="Only users created before this date or time")
+    list_users_parser.add_argument("--format", choices=OUTPUT_FORMATS, default="table", help="Output format")
     
     # List messages command
     list_msgs_parser = subparsers.add_parser("list-messages", help="List recent messages")
-    list_msgs_parser.add_argument("--limit", type=int, default=20, help="Number of messages to show")
+    list_msgs_parser.add_argument("--limit", type=int, default=20,
+                                  help="Number of messages to show, newest first (0 for all)")
+    list_msgs_parser.add_argument("--since", type=parse_date, help="Only messages from this date or time on")
+    list_msgs_parser.add_argument("--until", type=parse_date, help="Only messages before this date or time")
+    list_msgs_parser.add_argument("--user", help="Only messages sent by this user")
+    list_msgs_parser.add_argument("--format", choices=OUTPUT_FORMATS, default="table", help="Output format")
+    
+    # Search messages command
+    search_parser = subparsers.add_parser("search", help="Full-text search of messages")
+    search_parser.add_argument("query", help="Words to search for, e.g. 'deploy failed' -staging")
+    search_parser.add_argument("--room", type=int, help="Search the messages of this room ID instead")
+    search_parser.add_argument("--private", action="store_true", help="Include private messages")
+    search_parser.add_argument("--limit", type=int, default=20, help="Number of hits to show")
+    search_parser.add_argument("--offset", type=int, default=0, help="Number of hits to skip")
     
     # Create user command
     create_user_parser = subparsers.add_parser("create-user", help="Create a new user")
@@ -388,10 +720,23 @@ def main():
     # Delete user command
     delete_user_parser = subparsers.add_parser("delete-user", help="Delete a user")
     delete_user_parser.add_argument("username", help="Username to delete")
+    add_batch_arguments(delete_user_parser)
+    
+    # Set theme command
+    set_theme_parser = subparsers.add_parser("set-theme", help="Change a user's theme")
+    set_theme_parser.add_argument("username", help="Username to change")
+    set_theme_parser.add_argument("theme", help="Theme name, e.g. default, dark or forest")
     
     # Purge old messages command
     purge_parser = subparsers.add_parser("purge-messages", help="Delete old messages")
     purge_parser.add_argument("--days", type=int, default=30, help="Delete messages older than this many days")
+    add_batch_arguments(purge_parser)
+    
+    # Create partitions command
+    partitions_parser = subparsers.add_parser("create-partitions",
+                                              help="Create upcoming monthly message partitions")
+    partitions_parser.add_argument("--months-ahead", type=int, default=DEFAULT_MONTHS_AHEAD,
+                                   help="Months of partitions to create ahead of the current one")
     
     # Create room command
     create_room_parser = subparsers.add_parser("create-room", help="Create a new chat room")
@@ -407,24 +752,51 @@ def main():
     backup_parser = subparsers.add_parser("backup", help="Backup the database")
     backup_parser.add_argument("--filename", help="Output filename for the backup")
     
+    # Export command
+    export_parser = subparsers.add_parser("export", help="Export tables to CSV files with COPY")
+    export_parser.add_argument("directory", help="Directory to write the export to")
+    export_parser.add_argument("--tables", nargs="+", choices=TABLES, help="Tables to export (default: all)")
+    export_parser.add_argument("--since", type=parse_date, help="Only messages from this date or time on")
+    export_parser.add_argument("--until", type=parse_date, help="Only messages before this date or time")
+    export_parser.add_argument("--compress", choices=COMPRESSIONS, default="none", help="Compress the files")
+    export_parser.add_argument("--workers", type=int, default=4, help="Tables to export in parallel")
+    
+    # Import command
+    import_parser = subparsers.add_parser("import", help="Import an export directory with COPY")
+    import_parser.add_argument("directory", help="Directory written by export")
+    import_parser.add_argument("--tables", nargs="+", choices=TABLES, help="Tables to import (default: all)")
+    import_parser.add_argument("--merge", action="store_true",
+                               help="Skip rows that already exist instead of failing")
+    import_parser.add_argument("--workers", type=int, default=4, help="Tables to import in parallel")
+    
     args = parser.parse_args()
     
     if args.command == "list-users":
-        list_users()
+        list_users(args.since, args.until, args.format)
     elif args.command == "list-messages":
-        list_messages(args.limit)
+        list_messages(args.limit, args.since, args.until, args.user, args.format)
+    elif args.command == "search":
+        search(args.query, args.room, args.private, args.limit, args.offset)
     elif args.command == "create-user":
         create_user(args.username, args.email, args.password)
     elif args.command == "delete-user":
-        delete_user(args.username)
+        delete_user(args.username, args.batch_size, args.max_rate, args.dry_run)
+    elif args.command == "set-theme":
+        set_user_theme(args.username, args.theme)
     elif args.command == "purge-messages":
-        purge_old_messages(args.days)
+        purge_old_messages(args.days, args.batch_size, args.max_rate, args.dry_run)
+    elif args.command == "create-partitions":
+        create_message_partitions(args.months_ahead)
     elif args.command == "create-room":
         create_room(args.name, args.description, args.created_by, args.private)
     elif args.command == "list-rooms":
         list_rooms()
     elif args.command == "backup":
         backup_database(args.filename)
+    elif args.command == "export":
+        export_data(args.directory, args.tables, args.since, args.until, args.compress, args.workers)
+    elif args.command == "import":
+        import_data(args.directory, args.tables, args.merge, args.workers)
     else:
         parser.print_help()
 
@@ -0,0 +1,212 @@
+"""
+Database connection pool for the chat server.
+
+Opening a PostgreSQL connection costs a TCP round trip plus authentication,
+which used to be paid several times for every chat message. The pool keeps
+between min_size and max_size connections open and lends them out:
+
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        ...
+        conn.commit()
+
+A borrower waits at most timeout seconds for a free connection. Connections
+that sat idle longer than health_check_interval are pinged before being lent
+out, and connections that fail are discarded and replaced on demand.
+
+A connection returned in the middle of a transaction, e.g. by a block that
+returned right after a SELECT, is rolled back before it is lent out again,
+so no borrower leaves a snapshot or locks held while it sits idle.
+"""
+
+import collections
+import contextlib
+import threading
+import time
+
+# libpq transaction states, as reported by psycopg2's conn.info.transaction_status
+TRANSACTION_STATUS_IDLE = 0
+TRANSACTION_STATUS_UNKNOWN = 4
+
+class PoolError(Exception):
+    """Raised when a connection cannot be borrowed from the pool"""
+
+class PoolTimeout(PoolError):
+    """Raised when no connection became free within the borrow timeout"""
+
+class ConnectionPool:
+    """Thread-safe pool of DB-API connections created by a connect callable"""
+
+    def __init__(self, connect, min_size=2, max_size=10, timeout=5.0, health_check_interval=30.0):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.timeout = timeout  # Seconds a borrower may wait for a free connection
+        self.health_check_interval = health_check_interval
+        self.closed = False
+
+        self._idle = collections.deque()  # (connection, time it was returned), most recent last
+        self._size = 0  # Open connections, idle or borrowed
+        self._cond = threading.Condition()
+
+        # Counters
+        self.created = 0
+        self.discarded = 0
+        self.borrows = 0
+        self.waits = 0  # Borrows that had to wait for a connection to be returned
+        self.timeouts = 0
+        self.health_check_failures = 0
+        self.peak_in_use = 0
+        self.rollbacks = 0  # Connections returned with a transaction still open
+
+    def fill(self):
+        """Open connections until min_size are idle; raises if the database is unreachable"""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            conn = self._create()
+            self.release(conn)
+
+    def acquire(self, timeout=None):
+        """Borrow a connection, waiting up to timeout seconds (the pool default if None)"""
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+
+        while True:
+            conn = None
+            with self._cond:
+                waited = False
+                while True:
+                    if self.closed:
+                        raise PoolError("Connection pool is closed")
+                    if self._idle:
+                        conn, returned_at = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(f"No database connection free after {timeout} seconds")
+                    if not waited:
+                        self.waits += 1
+                        waited = True
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                conn = self._create()
+            elif not self._healthy(conn, returned_at):
+                self.health_check_failures += 1
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self.borrows += 1
+                self.peak_in_use = max(self.peak_in_use, self._size - len(self._idle))
+            return conn
+
+    def release(self, conn, discard=False):
+        """Return a borrowed connection, rolling back any open transaction; discard it if it is broken"""
+        if discard or self.closed or getattr(conn, 'closed', False):
+            self._discard(conn)
+            return
+        info = getattr(conn, 'info', None)
+        status = info.transaction_status if info is not None else None
+        if status == TRANSACTION_STATUS_UNKNOWN:
+            # The server connection is gone
+            self._discard(conn)
+            return
+        if status != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+            with self._cond:
+                self.rollbacks += 1
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """Borrow a connection for the duration of a with block.
+
+        However the block ends, an uncommitted transaction is rolled back
+        before the connection goes back to the pool, or the connection is
+        discarded if even the rollback fails.
+        """
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close every idle connection; borrowed ones are closed when returned"""
+        with self._cond:
+            self.closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self):
+        """Return a snapshot of the pool counters"""
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'peak_in_use': self.peak_in_use,
+                'created': self.created,
+                'discarded': self.discarded,
+                'borrows': self.borrows,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'health_check_failures': self.health_check_failures,
+                'rollbacks': self.rollbacks,
+            }
+
+    def _create(self):
+        # The slot in _size was reserved by the caller; give it back on failure
+        try:
+            conn = self.connect()
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.created += 1
+        return conn
+
+    def _healthy(self, conn, returned_at):
+        if getattr(conn, 'closed', False):
+            return False
+        if time.monotonic() - returned_at < self.health_check_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self.discarded += 1
+            self._cond.notify()
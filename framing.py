@@ -0,0 +1,217 @@
+"""
+Message framing for the chat protocol.
+
+A client that sends the framing option with its USERNAME: handshake switches
+the connection to framed mode: from then on every message in both directions
+is a 4-byte big-endian payload length followed by the UTF-8 payload. Clients
+that send a bare "USERNAME:<name>" keep the original unframed protocol.
+
+Framed clients may send further "KEY:value" option lines between the
+username and the framing line, e.g.
+
+    USERNAME:alice
+    SINCE_ID:1234
+    EPOCH:memory-3f2a9c1b7e4d
+    FRAMING:length-prefixed
+
+The handshake may arrive split over any number of reads, so servers collect
+it with a HandshakeReader (or recv_handshake on a blocking socket) before
+deciding whether the connection is framed. A bare USERNAME: has no end
+marker, so it is taken as a legacy handshake once no more data arrives
+within HANDSHAKE_WAIT seconds.
+"""
+
+import socket
+import struct
+
+# Frame header: payload length as an unsigned 32-bit big-endian integer
+FRAME_HEADER = struct.Struct('!I')
+
+# Largest payload we accept before treating the stream as corrupt
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Handshake option line sent after the username by framing-capable clients
+FRAMING_OPTION = "FRAMING:length-prefixed"
+_FRAMING_MARKER = f"\n{FRAMING_OPTION}\n".encode('utf-8')
+
+# Handshake option carrying the id of the last message a reconnecting client saw
+SINCE_ID_OPTION = "SINCE_ID"
+
+# Handshake option carrying the server epoch that SINCE_ID belongs to, as
+# sent in the history messages; SINCE_ID from another epoch is ignored
+EPOCH_OPTION = "EPOCH"
+
+# Size of the free space reserved before each recv_into call
+RECV_SIZE = 65536
+
+# Largest handshake we buffer while waiting for its framing line
+MAX_HANDSHAKE_SIZE = 4096
+
+# Seconds to wait for more of a handshake that could be a complete legacy one
+HANDSHAKE_WAIT = 0.2
+
+class FrameError(Exception):
+    """Raised when the peer sends data that is not a valid frame"""
+
+def encode_frame(payload):
+    """Return the payload bytes prefixed with their length"""
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def build_handshake(username, options=None):
+    """Build the handshake a framing-capable client sends on connect"""
+    lines = [f"USERNAME:{username}"]
+    for key, value in (options or {}).items():
+        lines.append(f"{key}:{value}")
+    return "\n".join(lines).encode('utf-8') + _FRAMING_MARKER
+
+def parse_handshake(data):
+    """Parse the first chunk received from a client.
+
+    Returns (username, framed, remainder, options). username is None if the
+    chunk is not a USERNAME: message. remainder holds any framed data the
+    client sent straight after the handshake, and options maps the keys of
+    any option lines to their values.
+    """
+    if data.startswith(b"USERNAME:"):
+        index = data.find(_FRAMING_MARKER)
+        if index != -1:
+            username, *lines = data[9:index].decode('utf-8').split("\n")
+            options = dict(line.split(":", 1) for line in lines if ":" in line)
+            return username, True, data[index + len(_FRAMING_MARKER):], options
+
+    message = data.decode('utf-8')
+    if message.startswith("USERNAME:"):
+        return message[9:], False, b"", {}
+    return None, False, b"", {}
+
+class HandshakeReader:
+    """Collects a handshake from however many chunks it arrives in"""
+
+    def __init__(self, max_size=MAX_HANDSHAKE_SIZE):
+        self.max_size = max_size
+        self._data = b""
+
+    @property
+    def legacy_possible(self):
+        """True while the data so far could be a complete legacy handshake"""
+        return b"\n" not in self._data
+
+    def feed(self, data):
+        """Add received data; returns what parse_handshake returns once the handshake is complete, else None"""
+        self._data += data
+        if not self._data.startswith(b"USERNAME:"):
+            if b"USERNAME:".startswith(self._data):
+                return None
+            return parse_handshake(self._data)
+        if _FRAMING_MARKER in self._data:
+            return parse_handshake(self._data)
+        if len(self._data) > self.max_size:
+            raise FrameError(f"Handshake exceeds {self.max_size} bytes without a framing line")
+        return None
+
+    def finish(self):
+        """Parse what was received once no more is coming (timeout or end of stream)"""
+        return parse_handshake(self._data)
+
+def recv_handshake(sock, wait=HANDSHAKE_WAIT):
+    """Receive a handshake from a blocking socket, however it is split.
+
+    Waits as long as the socket's timeout for the first chunk and for the
+    rest of a handshake that can only be a framed one, but only wait
+    seconds for more of one that could be a complete legacy handshake.
+    Returns what parse_handshake returns.
+    """
+    reader = HandshakeReader()
+    timeout = sock.gettimeout()
+    try:
+        data = sock.recv(1024)
+        while data:
+            result = reader.feed(data)
+            if result is not None:
+                return result
+            sock.settimeout(wait if reader.legacy_possible else timeout)
+            try:
+                data = sock.recv(1024)
+            except socket.timeout:
+                break
+        return reader.finish()
+    finally:
+        sock.settimeout(timeout)
+
+class FrameDecoder:
+    """Incremental decoder that turns a byte stream into complete frames.
+
+    Data is received straight into one reusable bytearray (recv_into) or
+    copied into it once (feed). Consumed bytes are reclaimed by compacting
+    the buffer only when more room is needed, so partial frames are never
+    re-concatenated chunk by chunk.
+    """
+
+    def __init__(self, initial_size=RECV_SIZE, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray(initial_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # Offset of the first unconsumed byte
+        self._end = 0    # Offset just past the last received byte
+
+    def recv_into(self, sock, size=RECV_SIZE):
+        """Receive from a socket directly into the buffer.
+
+        Returns the number of bytes read; 0 means the peer closed the connection.
+        """
+        self._reserve(size)
+        count = sock.recv_into(self._view[self._end:])
+        self._end += count
+        return count
+
+    def feed(self, data):
+        """Append data that was already received (e.g. by an asyncio transport)"""
+        count = len(data)
+        if not count:
+            return
+        self._reserve(count)
+        self._view[self._end:self._end + count] = data
+        self._end += count
+
+    def frames(self):
+        """Yield the payload of every complete frame currently buffered"""
+        header_size = FRAME_HEADER.size
+        while self._end - self._start >= header_size:
+            (length,) = FRAME_HEADER.unpack_from(self._buffer, self._start)
+            if length > self.max_frame_size:
+                raise FrameError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+
+            begin = self._start + header_size
+            if self._end - begin < length:
+                # Make sure the rest of this frame will fit without another resize
+                self._reserve(header_size + length - (self._end - self._start))
+                break
+
+            self._start = begin + length
+            yield bytes(self._view[begin:self._start])
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def pending(self):
+        """Number of buffered bytes that do not yet form a complete frame"""
+        return self._end - self._start
+
+    def _reserve(self, size):
+        """Ensure there is room for size more bytes after the buffered data"""
+        if len(self._buffer) - self._end >= size:
+            return
+
+        # Move the unconsumed bytes to the front of the buffer
+        pending = self._end - self._start
+        if self._start:
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = pending
+
+        if len(self._buffer) - self._end < size:
+            # Grow geometrically so large frames need few reallocations
+            new_size = max(len(self._buffer) * 2, pending + size)
+            self._view.release()
+            self._buffer.extend(bytes(new_size - len(self._buffer)))
+            self._view = memoryview(self._buffer)
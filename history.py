@@ -0,0 +1,129 @@
+"""
+In-memory recent message history for the chat server.
+
+Every joining client is sent the last few public messages of each user. The
+server used to query the database for that on every join (one query per user
+who ever posted). Now it keeps a ring buffer of the last limit messages per
+user, loaded once at startup and updated as messages are saved. The encoded
+"history" message is cached and only rebuilt after a new message arrived.
+
+It also keeps the last recent_size messages of everyone in id order, so a
+client that reconnects with the id of the last message it saw can be sent
+just the messages it missed (since) instead of the whole history again.
+"""
+
+import collections
+import json
+import threading
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+class HistoryCache:
+    """Ring buffer of the most recent messages of each user"""
+
+    def __init__(self, limit=10, recent_size=1000, epoch=None):
+        self.limit = limit
+        self.epoch = epoch  # Sent with the history so clients can tell which id space they saw
+        self._messages = {}  # username -> deque of formatted messages, oldest first
+        self._recent = collections.deque(maxlen=recent_size)  # Messages with ids, in id order
+        self._recent_floor = 0  # Highest id no longer (or never) held in _recent
+        self.last_id = 0  # Highest message id seen
+        self._lock = threading.Lock()
+        self._message = None  # Cached encoded history message; None when stale
+
+        # Counters
+        self.rebuilds = 0
+        self.served = 0
+
+    def add(self, username, message, timestamp, message_type='text', is_private=False, message_id=None):
+        """Record a message that was just sent and return its formatted entry"""
+        entry = format_message(message_id, username, message, timestamp, message_type, is_private)
+        with self._lock:
+            self._add_to_user(entry)
+            if message_id is not None:
+                self._add_to_recent(entry)
+            else:
+                # A message without an id cannot be part of a delta, so clients
+                # that may have missed it get the full history instead
+                self._recent_floor = self.last_id + 1
+        return entry
+
+    def load(self, rows):
+        """Add (id, username, message, timestamp) rows, in chronological order per user"""
+        with self._lock:
+            for message_id, username, message, timestamp in rows:
+                self._add_to_user(format_message(message_id, username, message, timestamp))
+                self.last_id = max(self.last_id, message_id)
+
+    def load_recent(self, rows):
+        """Add the (id, username, message, timestamp, message_type) rows of the
+        newest messages, in id order, to answer since() queries"""
+        with self._lock:
+            if len(rows) >= self._recent.maxlen:
+                # Anything older than what was loaded is unknown
+                self._recent_floor = max(self._recent_floor, rows[0][0] - 1)
+            for message_id, username, message, timestamp, message_type in rows:
+                self._add_to_recent(format_message(message_id, username, message, timestamp, message_type))
+
+    def since(self, since_id):
+        """Return the messages with an id above since_id, oldest first.
+        
+        Returns None if they are not all held in memory any more, or if the
+        client claims to have seen ids this server never issued.
+        """
+        with self._lock:
+            if since_id < self._recent_floor or since_id > self.last_id:
+                return None
+            return [entry for entry in self._recent if entry["id"] > since_id]
+
+    def message(self):
+        """Return the encoded history message, rebuilding it only if it is stale"""
+        with self._lock:
+            self.served += 1
+            if self._message is None:
+                history_data = {
+                    "type": "history",
+                    "epoch": self.epoch,
+                    "userMessages": {
+                        username: list(self._messages[username]) for username in sorted(self._messages)
+                    }
+                }
+                self._message = json.dumps(history_data).encode('utf-8')
+                self.rebuilds += 1
+            return self._message
+
+    def stats(self):
+        """Return a snapshot of the cache counters"""
+        with self._lock:
+            return {
+                'users': len(self._messages),
+                'messages': sum(len(messages) for messages in self._messages.values()),
+                'recent': len(self._recent),
+                'last_id': self.last_id,
+                'rebuilds': self.rebuilds,
+                'served': self.served,
+            }
+
+    def _add_to_user(self, entry):
+        messages = self._messages.get(entry["username"])
+        if messages is None:
+            messages = self._messages[entry["username"]] = collections.deque(maxlen=self.limit)
+        messages.append(entry)
+        self._message = None
+
+    def _add_to_recent(self, entry):
+        if len(self._recent) == self._recent.maxlen:
+            self._recent_floor = max(self._recent_floor, self._recent[0]["id"])
+        self._recent.append(entry)
+        self.last_id = max(self.last_id, entry["id"])
+
+def format_message(message_id, username, message, timestamp, message_type='text', is_private=False):
+    """Return the dictionary a chat message is sent to clients as"""
+    return {
+        "id": message_id,
+        "username": username,
+        "message": message,
+        "timestamp": timestamp.strftime(TIMESTAMP_FORMAT),
+        "message_type": message_type,
+        "is_private": is_private
+    }
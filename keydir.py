@@ -0,0 +1,116 @@
+"""
+Public key directory for the chat server.
+
+Clients publish their public keys once per login with publish_keys, and the
+server keeps them per user, in memory for lookups and in the user_keys
+table so they survive restarts. A get_keys request answers for many users
+in one frame, so a client has its peers' keys before a private chat starts
+instead of asking each peer and waiting for the answer to be relayed.
+
+The server stores and hands out keys without checking them. Clients pin
+each peer's fingerprint and warn when a key changes.
+"""
+
+import hashlib
+import threading
+
+# Key types the directory accepts, in order of preference
+KEY_TYPES = ("x25519", "rsa")
+
+# Fields a published key may carry, and the most bytes any one may hold
+KEY_FIELDS = ("key_type", "public_key", "signing_key", "signature")
+MAX_FIELD_LENGTH = 4096
+
+def key_fingerprint(fields):
+    """Return the SHA-256 fingerprint of a key's type and public parts, as hex"""
+    digest = hashlib.sha256()
+    for name in ("key_type", "public_key", "signing_key"):
+        digest.update((fields.get(name) or "").encode('utf-8') + b"\0")
+    return digest.hexdigest()
+
+def format_fingerprint(fingerprint):
+    """Return the first 160 bits of a fingerprint in groups of four, for people to compare"""
+    return " ".join(fingerprint[i:i + 4] for i in range(0, 40, 4))
+
+def clean_keys(keys):
+    """Check a publish_keys list; returns {key_type: fields} or raises ValueError"""
+    if not isinstance(keys, list) or not keys:
+        raise ValueError("keys must be a non-empty list")
+    cleaned = {}
+    for fields in keys:
+        if not isinstance(fields, dict) or fields.get("key_type") not in KEY_TYPES:
+            raise ValueError("unknown key type")
+        if not isinstance(fields.get("public_key"), str):
+            raise ValueError("public_key missing")
+        entry = {}
+        for name in KEY_FIELDS:
+            value = fields.get(name)
+            if value is None:
+                continue
+            if not isinstance(value, str) or len(value) > MAX_FIELD_LENGTH:
+                raise ValueError(f"invalid {name}")
+            entry[name] = value
+        cleaned[entry["key_type"]] = entry
+    return cleaned
+
+class KeyDirectory:
+    """Username -> published public keys, by key type"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = {}  # username -> {key_type: fields}
+
+        # Counters
+        self.published = 0
+        self.lookups = 0
+        self.keys_served = 0
+
+    def load(self, rows):
+        """Add (username, fields) rows read from user_keys"""
+        with self._lock:
+            for username, fields in rows:
+                self._keys.setdefault(username, {})[fields["key_type"]] = fields
+
+    def reload(self, username, rows):
+        """Replace username's keys with (username, fields) rows"""
+        with self._lock:
+            self._keys.pop(username, None)
+            for _, fields in rows:
+                self._keys.setdefault(username, {})[fields["key_type"]] = fields
+
+    def unchanged(self, username, keys):
+        """Return True if username already has exactly these cleaned keys"""
+        with self._lock:
+            current = self._keys.get(username, {})
+            return all(current.get(key_type) == fields for key_type, fields in keys.items())
+
+    def publish(self, username, keys):
+        """Store cleaned keys for username, replacing those of the same types"""
+        with self._lock:
+            self._keys.setdefault(username, {}).update(keys)
+            self.published += 1
+
+    def get(self, usernames):
+        """Return ({username: [fields, best type first]}, [usernames without keys])"""
+        found, missing = {}, []
+        with self._lock:
+            for username in usernames:
+                keys = self._keys.get(username)
+                if keys:
+                    found[username] = [keys[key_type] for key_type in KEY_TYPES if key_type in keys]
+                else:
+                    missing.append(username)
+            self.lookups += 1
+            self.keys_served += len(found)
+        return found, missing
+
+    def stats(self):
+        """Return a snapshot of the directory counters"""
+        with self._lock:
+            return {
+                'users': len(self._keys),
+                'keys': sum(len(keys) for keys in self._keys.values()),
+                'published': self.published,
+                'lookups': self.lookups,
+                'keys_served': self.keys_served,
+            }
@@ -0,0 +1,333 @@
+"""
+Identity keys for the chat client.
+
+A client's identity is an RSA key pair (the original scheme, which every
+peer understands), an X25519 key for agreeing message keys together with an
+Ed25519 key that signs it, or both. A 2048-bit RSA key takes a good part of
+a second to generate; X25519 and Ed25519 keys take microseconds. Clients
+list the key types they understand in public_key_request and the answer
+uses the best one both sides share, so peers that send no list keep getting
+RSA keys.
+
+The identity can be kept in a keystore file so a client reuses the same
+keys across runs instead of generating new ones on every start. The file is
+JSON holding PKCS#8 PEM private keys, encrypted with a passphrase unless
+none is given.
+
+Peers' public keys go into a KeyCache, which pins each user to a key
+fingerprint and reports when a user's key changes. It can be kept in a file
+too, so keys fetched in one run are there from the start of the next.
+"""
+
+import base64
+import collections
+import json
+import os
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, padding, rsa, x25519
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.backends import default_backend
+
+from keydir import KEY_TYPES, KEY_FIELDS, key_fingerprint
+
+DEFAULT_KEY_TYPE = "x25519"
+
+RSA_KEY_SIZE = 2048
+AES_KEY_SIZE = 256
+
+# Environment variable the keystore passphrase can be given in
+KEYSTORE_PASSPHRASE_ENV = "CHAT_KEYSTORE_PASSPHRASE"
+
+KEYSTORE_VERSION = 1
+KEY_CACHE_VERSION = 1
+
+# Signed together with an X25519 public key, so the signature means nothing elsewhere
+X25519_SIGNATURE_CONTEXT = b"chat-x25519-key:"
+# HKDF info for message keys agreed over X25519
+X25519_MESSAGE_INFO = b"chat-private-message"
+
+OAEP_PADDING = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+
+class KeystoreError(Exception):
+    """Raised when keys cannot be loaded, saved or verified"""
+
+# A peer's public key as received in a public_key_response
+PeerKey = collections.namedtuple('PeerKey', ['key_type', 'public_key', 'signing_key'])
+
+def b64encode(data):
+    return base64.b64encode(data).decode('utf-8')
+
+def raw_public_bytes(public_key):
+    return public_key.public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+
+def choose_key_type(offered):
+    """Pick the key type to answer a public_key_request with.
+
+    offered is the requester's key_types list, or None for a client that
+    sends none and only understands RSA.
+    """
+    if not offered:
+        return "rsa"
+    for key_type in KEY_TYPES:
+        if key_type in offered:
+            return key_type
+    return "rsa"
+
+class Identity:
+    """A client's private keys; holds RSA, X25519 + Ed25519, or both"""
+
+    def __init__(self, rsa_key=None, x25519_key=None, ed25519_key=None):
+        self.rsa_key = rsa_key
+        self.x25519_key = x25519_key
+        self.ed25519_key = ed25519_key
+
+    @classmethod
+    def generate(cls, key_type=DEFAULT_KEY_TYPE):
+        identity = cls()
+        identity.add_keys(key_type)
+        return identity
+
+    def has(self, key_type):
+        """Return True if the keys of key_type are present"""
+        if key_type == "rsa":
+            return self.rsa_key is not None
+        return self.x25519_key is not None and self.ed25519_key is not None
+
+    def add_keys(self, key_type):
+        """Generate the keys of key_type unless present; returns True if any were made"""
+        if self.has(key_type):
+            return False
+        if key_type == "rsa":
+            self.rsa_key = rsa.generate_private_key(
+                public_exponent=65537,
+                key_size=RSA_KEY_SIZE,
+                backend=default_backend()
+            )
+        elif key_type == "x25519":
+            self.x25519_key = x25519.X25519PrivateKey.generate()
+            self.ed25519_key = ed25519.Ed25519PrivateKey.generate()
+        else:
+            raise KeystoreError(f"Unknown key type: {key_type}")
+        return True
+
+    def public_key_fields(self, key_type):
+        """Return the public_key_response fields publishing our key of key_type"""
+        if key_type == "rsa":
+            pem = self.rsa_key.public_key().public_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PublicFormat.SubjectPublicKeyInfo
+            ).decode('utf-8')
+            return {"key_type": "rsa", "public_key": pem}
+        public_key = raw_public_bytes(self.x25519_key.public_key())
+        return {
+            "key_type": "x25519",
+            "public_key": b64encode(public_key),
+            "signing_key": b64encode(raw_public_bytes(self.ed25519_key.public_key())),
+            "signature": b64encode(self.ed25519_key.sign(X25519_SIGNATURE_CONTEXT + public_key)),
+        }
+
+def peer_key_from_response(data):
+    """Build a PeerKey from a public_key_response, checking the key signature"""
+    key_type = data.get("key_type", "rsa")
+    try:
+        if key_type == "rsa":
+            public_key = serialization.load_pem_public_key(data["public_key"].encode('utf-8'), backend=default_backend())
+            return PeerKey("rsa", public_key, None)
+        if key_type == "x25519":
+            public_bytes = base64.b64decode(data["public_key"])
+            signing_key = ed25519.Ed25519PublicKey.from_public_bytes(base64.b64decode(data["signing_key"]))
+            signing_key.verify(base64.b64decode(data["signature"]), X25519_SIGNATURE_CONTEXT + public_bytes)
+            return PeerKey("x25519", x25519.X25519PublicKey.from_public_bytes(public_bytes), signing_key)
+    except InvalidSignature:
+        raise KeystoreError("key signature does not match")
+    except (KeyError, TypeError, ValueError) as e:
+        raise KeystoreError(f"malformed key: {e}")
+    raise KeystoreError(f"unknown key type {key_type}")
+
+def encrypt_message(peer_key, plaintext):
+    """Encrypt plaintext for peer_key; returns the private_message fields.
+
+    RSA peers get the original scheme: a random AES key wrapped with
+    RSA-OAEP and AES-CFB over the text. X25519 peers get a key agreed with
+    a fresh ephemeral X25519 key through HKDF, and AES-GCM; the client now
+    sends them session messages instead (see ratchet.py), but still reads
+    this scheme.
+    """
+    data = plaintext.encode('utf-8')
+    if peer_key.key_type == "x25519":
+        ephemeral = x25519.X25519PrivateKey.generate()
+        key = derive_message_key(ephemeral.exchange(peer_key.public_key))
+        nonce = os.urandom(12)
+        return {
+            "scheme": "x25519",
+            "ephemeral_key": b64encode(raw_public_bytes(ephemeral.public_key())),
+            "iv": b64encode(nonce),
+            "encrypted_message": b64encode(AESGCM(key).encrypt(nonce, data, None)),
+        }
+
+    aes_key = os.urandom(AES_KEY_SIZE // 8)
+    iv = os.urandom(16)  # 16 bytes for AES
+    encryptor = Cipher(algorithms.AES(aes_key), modes.CFB(iv), backend=default_backend()).encryptor()
+    return {
+        "encrypted_key": b64encode(peer_key.public_key.encrypt(aes_key, OAEP_PADDING)),
+        "iv": b64encode(iv),
+        "encrypted_message": b64encode(encryptor.update(data) + encryptor.finalize()),
+    }
+
+def decrypt_message(identity, data):
+    """Decrypt the fields of a private_message sent to identity; returns the text"""
+    iv = base64.b64decode(data["iv"])
+    encrypted_message = base64.b64decode(data["encrypted_message"])
+    scheme = data.get("scheme", "rsa")
+    if scheme == "x25519":
+        if identity.x25519_key is None:
+            raise KeystoreError("no X25519 key to decrypt with")
+        ephemeral = x25519.X25519PublicKey.from_public_bytes(base64.b64decode(data["ephemeral_key"]))
+        key = derive_message_key(identity.x25519_key.exchange(ephemeral))
+        return AESGCM(key).decrypt(iv, encrypted_message, None).decode('utf-8')
+    if scheme != "rsa":
+        raise KeystoreError(f"unknown encryption scheme {scheme}")
+    if identity.rsa_key is None:
+        raise KeystoreError("no RSA key to decrypt with")
+    aes_key = identity.rsa_key.decrypt(base64.b64decode(data["encrypted_key"]), OAEP_PADDING)
+    decryptor = Cipher(algorithms.AES(aes_key), modes.CFB(iv), backend=default_backend()).decryptor()
+    return (decryptor.update(encrypted_message) + decryptor.finalize()).decode('utf-8')
+
+def derive_message_key(shared_secret):
+    return HKDF(algorithm=hashes.SHA256(), length=AES_KEY_SIZE // 8, salt=None,
+                info=X25519_MESSAGE_INFO).derive(shared_secret)
+
+def best_key(keys):
+    """Return the fields of the preferred key type among a user's published keys"""
+    by_type = {fields.get("key_type"): fields for fields in keys}
+    for key_type in KEY_TYPES:
+        if key_type in by_type:
+            return by_type[key_type]
+    return None
+
+def write_private_file(path, content):
+    """Write content to path as JSON, readable only by its owner.
+
+    A new file is written and swapped in, so a crash never leaves half of one.
+    """
+    temp_path = path + ".tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding='utf-8') as out:
+        json.dump(content, out, indent=2)
+    os.replace(temp_path, path)
+
+class KeyCache:
+    """Peers' public keys by fingerprint, and the fingerprint each user is pinned to"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._keys = {}  # fingerprint -> public key fields
+        self._pins = {}  # username -> fingerprint
+        self._parsed = {}  # fingerprint -> PeerKey
+        self.dirty = False  # Pins changed since the last save
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as cache_file:
+                    stored = json.load(cache_file)
+                self._keys = dict(stored["keys"])
+                self._pins = {username: fingerprint for username, fingerprint in stored["pins"].items()
+                              if fingerprint in self._keys}
+            except (KeyError, TypeError, ValueError) as e:
+                raise KeystoreError(f"cannot read key cache {path}: {e}")
+
+    def __len__(self):
+        return len(self._pins)
+
+    def get(self, username):
+        """Return the PeerKey username is pinned to, or None"""
+        fingerprint = self._pins.get(username)
+        if fingerprint is None:
+            return None
+        peer_key = self._parsed.get(fingerprint)
+        if peer_key is None:
+            peer_key = self._parsed[fingerprint] = peer_key_from_response(self._keys[fingerprint])
+        return peer_key
+
+    def fingerprint(self, username):
+        return self._pins.get(username)
+
+    def remember(self, username, fields):
+        """Pin username to the key in fields.
+
+        Returns (peer_key, previous) where previous is the fingerprint the
+        user was pinned to before if the key changed, else None. Raises
+        KeystoreError for keys that do not verify.
+        """
+        # Responses from clients that predate key types carry bare RSA keys
+        fields = dict({name: fields[name] for name in KEY_FIELDS if name in fields}, key_type=fields.get("key_type", "rsa"))
+        fingerprint = key_fingerprint(fields)
+        peer_key = self._parsed.get(fingerprint)
+        if peer_key is None:
+            peer_key = peer_key_from_response(fields)
+            self._parsed[fingerprint] = peer_key
+            self._keys[fingerprint] = fields
+        previous = self._pins.get(username)
+        if previous != fingerprint:
+            self._pins[username] = fingerprint
+            self.dirty = True
+        return peer_key, previous if previous not in (None, fingerprint) else None
+
+    def save(self):
+        """Write the pinned keys to the cache file, if there is one and they changed"""
+        if not self.path or not self.dirty:
+            return
+        pinned = set(self._pins.values())
+        write_private_file(self.path, {
+            "version": KEY_CACHE_VERSION,
+            "keys": {fingerprint: fields for fingerprint, fields in self._keys.items() if fingerprint in pinned},
+            "pins": self._pins,
+        })
+        self.dirty = False
+
+def load_identity(path, passphrase=None):
+    """Read an identity from a keystore file"""
+    password = passphrase.encode('utf-8') if passphrase else None
+    try:
+        with open(path, encoding='utf-8') as keystore_file:
+            stored = json.load(keystore_file)
+        keys = {name: serialization.load_pem_private_key(pem.encode('utf-8'), password=password,
+                                                         backend=default_backend())
+                for name, pem in stored["keys"].items()}
+    except (KeyError, TypeError, ValueError) as e:
+        # Also what a wrong passphrase raises
+        raise KeystoreError(f"cannot read keystore {path}: {e}")
+    return Identity(keys.get("rsa"), keys.get("x25519"), keys.get("ed25519"))
+
+def save_identity(identity, path, passphrase=None):
+    """Write identity to a keystore file readable only by its owner"""
+    if passphrase:
+        encryption = serialization.BestAvailableEncryption(passphrase.encode('utf-8'))
+    else:
+        encryption = serialization.NoEncryption()
+    keys = {name: key.private_bytes(encoding=serialization.Encoding.PEM,
+                                    format=serialization.PrivateFormat.PKCS8,
+                                    encryption_algorithm=encryption).decode('utf-8')
+            for name, key in (("rsa", identity.rsa_key), ("x25519", identity.x25519_key),
+                              ("ed25519", identity.ed25519_key))
+            if key is not None}
+
+    write_private_file(path, {"version": KEYSTORE_VERSION, "keys": keys})
+
+def load_or_create_identity(path, passphrase=None, key_type=DEFAULT_KEY_TYPE):
+    """Load the identity in path, adding keys of key_type if it lacks them.
+
+    Creates the keystore if path does not exist. Returns (identity,
+    created) where created is True if any keys were generated.
+    """
+    if os.path.exists(path):
+        identity = load_identity(path, passphrase)
+    else:
+        identity = Identity()
+    created = identity.add_keys(key_type)
+    if created:
+        save_identity(identity, path, passphrase)
+    return identity, created
@@ -0,0 +1,467 @@
+"""
+Per-connection outbound queues for the chat servers.
+
+Every session owns one queue. Senders only enqueue, so a slow reader can no
+longer stall the thread that is broadcasting. Each queue has high-water marks;
+a client that falls behind them either has new messages dropped or is
+disconnected, depending on the configured policy.
+
+Broadcasts go through fan_out, which frames a payload once and puts the same
+bytes object on every recipient's queue. Writers send everything that has
+piled up for a socket in one writev-style call.
+"""
+
+import collections
+import os
+import selectors
+import socket
+import threading
+import asyncio
+from framing import encode_frame
+
+# Slow-consumer policies
+POLICY_DISCONNECT = 'disconnect'  # Evict the client once its queue is full
+POLICY_DROP = 'drop'              # Keep the client but discard messages that do not fit
+POLICIES = (POLICY_DISCONNECT, POLICY_DROP)
+
+# Default high-water marks
+DEFAULT_MAX_MESSAGES = 1000
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+
+# Most buffers the kernel accepts in one sendmsg call
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = -1
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+# Windows sockets have no sendmsg; fall back to joining the buffers
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+class SlowConsumerError(ConnectionError):
+    """Raised when a client is disconnected because its outbound queue is full"""
+
+def send_buffers(sock, buffers):
+    """Send a list of buffers completely, using as few system calls as possible"""
+    if not HAVE_SENDMSG or len(buffers) == 1:
+        sock.sendall(buffers[0] if len(buffers) == 1 else b"".join(buffers))
+        return
+
+    remaining = buffers
+    while remaining:
+        sent = sock.sendmsg(remaining[:IOV_MAX])
+        remaining = _consume(remaining, sent)
+
+def send_buffers_nowait(sock, buffers):
+    """Send as much of a list of buffers as the socket accepts without blocking.
+
+    Returns the buffers (the first possibly trimmed) that are still unsent.
+    """
+    remaining = buffers
+    while remaining:
+        try:
+            sent = sock.sendmsg(remaining[:IOV_MAX], (), socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            break
+        remaining = _consume(remaining, sent)
+    return remaining
+
+def _consume(buffers, sent):
+    """Drop sent bytes from the front of a buffer list"""
+    index = 0
+    while sent:
+        length = len(buffers[index])
+        if sent < length:
+            buffers = buffers[index:]
+            buffers[0] = memoryview(buffers[0])[sent:]
+            return buffers
+        sent -= length
+        index += 1
+    return buffers[index:]
+
+def fan_out(sessions, message, exclude=None):
+    """Queue one message for many sessions, encoding the frame only once.
+
+    Returns the clients whose queue refused the message because the
+    connection is closed or was evicted as a slow consumer.
+    """
+    framed = None
+    failed = []
+    for session in sessions:
+        if session.client is exclude:
+            continue
+        if session.framed:
+            if framed is None:
+                framed = encode_frame(message)
+            data = framed
+        else:
+            data = message
+        try:
+            session.outbound.put(data)
+        except ConnectionError:
+            failed.append(session.client)
+    return failed
+
+# Results of OutboundQueue.write_pending
+WRITE_DONE = 0     # Queue is empty
+WRITE_MORE = 1     # More messages arrived while writing
+WRITE_BLOCKED = 2  # The socket buffer is full; retry once it is writable
+
+class SocketWriter:
+    """Writer thread shared by all OutboundQueues.
+
+    Queues with pending data are scheduled here once, however many messages
+    are added, and each turn writes everything a queue holds with one
+    non-blocking sendmsg. Sockets whose buffer is full are registered with a
+    selector and written again as soon as they become writable; the writer
+    checks them on every turn, however busy the other sockets keep it, so
+    one slow reader never holds up the others and is never starved. When
+    there is nothing to write it sleeps in the selector, and schedule()
+    wakes it through a socket pair.
+    """
+
+    def __init__(self):
+        self._ready = collections.deque()
+        self._forgotten = []  # Closed queues that may still be registered with the selector
+        self._lock = threading.Lock()
+        self._waiting = False  # Writer is, or is about to be, asleep in select()
+        self._woken = False  # A wake-up byte was sent since it went to sleep
+
+        self._selector = selectors.DefaultSelector()
+        self._wake_recv, self._wake_send = socket.socketpair()
+        self._wake_recv.setblocking(False)
+        self._wake_send.setblocking(False)
+        self._selector.register(self._wake_recv, selectors.EVENT_READ)
+
+        self._thread = threading.Thread(target=self._run, name="socket-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def schedule(self, queue):
+        """Ask the writer to flush a queue"""
+        with self._lock:
+            self._ready.append(queue)
+            if not self._waiting or self._woken:
+                return
+            self._woken = True
+        self._wake()
+
+    def forget(self, queue):
+        """Stop waiting for a closed queue's socket to become writable"""
+        with self._lock:
+            self._forgotten.append(queue)
+            if not self._waiting or self._woken:
+                return
+            self._woken = True
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_send.send(b"\0")
+        except BlockingIOError:
+            pass  # Plenty of wake-ups are pending already
+
+    def _run(self):
+        while True:
+            with self._lock:
+                batch, self._ready = self._ready, collections.deque()
+                forgotten, self._forgotten = self._forgotten, []
+                self._waiting = not batch
+
+            for queue in forgotten:
+                self._unregister(queue)
+
+            # Only sleep when there is nothing to write
+            for key, _ in self._selector.select(0 if batch else None):
+                if key.data is None:
+                    self._drain_wake()
+                else:
+                    self._unregister(key.data)
+                    batch.append(key.data)
+
+            with self._lock:
+                self._waiting = self._woken = False
+
+            for queue in batch:
+                result = queue.write_pending()
+                if result == WRITE_MORE:
+                    self.schedule(queue)
+                elif result == WRITE_BLOCKED:
+                    self._register(queue)
+
+    def _drain_wake(self):
+        try:
+            while self._wake_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _register(self, queue):
+        try:
+            self._selector.register(queue.sock, selectors.EVENT_WRITE, queue)
+        except KeyError:
+            # The descriptor belonged to a socket that was closed while registered
+            self._selector.unregister(self._selector.get_key(queue.sock).fileobj)
+            self._selector.register(queue.sock, selectors.EVENT_WRITE, queue)
+        except ValueError:
+            pass  # The socket is closed already
+
+    def _unregister(self, queue):
+        try:
+            self._selector.unregister(queue.sock)
+        except (KeyError, ValueError):
+            pass
+
+_shared_writer = None
+_shared_writer_lock = threading.Lock()
+
+def get_shared_writer():
+    """Return the process-wide SocketWriter, starting it on first use"""
+    global _shared_writer
+    with _shared_writer_lock:
+        if _shared_writer is None:
+            _shared_writer = SocketWriter()
+        return _shared_writer
+
+# Non-blocking sendmsg is needed for the shared writer; elsewhere (Windows)
+# every queue gets a writer thread of its own that uses blocking sends
+USE_SHARED_WRITER = HAVE_SENDMSG and hasattr(socket, 'MSG_DONTWAIT')
+
+class OutboundQueue:
+    """Bounded send queue for a blocking socket.
+
+    The queue is drained by the shared SocketWriter, or by a writer thread of
+    its own on platforms without non-blocking sendmsg.
+    """
+
+    def __init__(self, sock, name="", max_messages=DEFAULT_MAX_MESSAGES,
+                 max_bytes=DEFAULT_MAX_BYTES, policy=POLICY_DISCONNECT):
+        self.sock = sock
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.closed = False
+
+        # Counters
+        self.depth_bytes = 0
+        self.peak_depth = 0
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        self.write_calls = 0
+        self.dropped = 0
+
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+        self._scheduled = False  # Queue is waiting for, or being served by, the shared writer
+        if USE_SHARED_WRITER:
+            self._writer = get_shared_writer()
+        else:
+            self._writer = None
+            thread = threading.Thread(target=self._run, name=f"writer-{name}")
+            thread.daemon = True
+            thread.start()
+
+    def put(self, data):
+        """Queue data for sending.
+
+        Returns False if the data was dropped by the drop policy. Raises
+        SlowConsumerError if the client was evicted, or ConnectionResetError
+        if the queue is already closed.
+        """
+        with self._cond:
+            if self.closed:
+                raise ConnectionResetError("Connection is closed")
+
+            if len(self._items) >= self.max_messages or self.depth_bytes + len(data) > self.max_bytes:
+                if self.policy == POLICY_DROP:
+                    self.dropped += 1
+                    return False
+                self._close_locked()
+                raise SlowConsumerError(
+                    f"Outbound queue full ({len(self._items)} messages, {self.depth_bytes} bytes)")
+
+            self._items.append(data)
+            self.depth_bytes += len(data)
+            self.peak_depth = max(self.peak_depth, len(self._items))
+            if self._writer is None:
+                self._cond.notify()
+                return True
+            schedule = not self._scheduled
+            self._scheduled = True
+
+        if schedule:
+            self._writer.schedule(self)
+        return True
+
+    def close(self):
+        """Stop writing and shut the socket down so the reader notices too"""
+        with self._cond:
+            self._close_locked()
+
+    def stats(self):
+        """Return a snapshot of the queue counters"""
+        with self._cond:
+            return {
+                'depth': len(self._items),
+                'depth_bytes': self.depth_bytes,
+                'peak_depth': self.peak_depth,
+                'sent_messages': self.sent_messages,
+                'sent_bytes': self.sent_bytes,
+                'write_calls': self.write_calls,
+                'dropped': self.dropped,
+            }
+
+    def write_pending(self):
+        """Write everything queued without blocking (called by the shared writer)"""
+        with self._cond:
+            if self.closed:
+                return WRITE_DONE
+            batch = list(self._items)
+            self._items.clear()
+
+        try:
+            remaining = send_buffers_nowait(self.sock, batch)
+        except OSError:
+            self.close()
+            return WRITE_DONE
+
+        with self._cond:
+            if self.closed:
+                return WRITE_DONE
+            # Put any unsent tail back at the front of the queue
+            self._items.extendleft(reversed(remaining))
+            sent = len(batch) - len(remaining)
+            size = sum(len(data) for data in batch[:sent])
+            if remaining:
+                size += len(batch[sent]) - len(remaining[0])
+            self.depth_bytes -= size
+            self.sent_messages += sent
+            self.sent_bytes += size
+            self.write_calls += 1
+
+            if remaining:
+                return WRITE_BLOCKED
+            if self._items:
+                return WRITE_MORE
+            self._scheduled = False
+            return WRITE_DONE
+
+    def _close_locked(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._items.clear()
+        self.depth_bytes = 0
+        self._cond.notify_all()
+        if self._writer is not None:
+            self._writer.forget(self)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _run(self):
+        # Dedicated writer thread, used when there is no shared writer
+        while True:
+            with self._cond:
+                while not self._items and not self.closed:
+                    self._cond.wait()
+                if self.closed:
+                    return
+                # Take everything queued so far and write it in one go
+                batch = list(self._items)
+                self._items.clear()
+
+            size = sum(len(data) for data in batch)
+            try:
+                send_buffers(self.sock, batch)
+            except OSError:
+                self.close()
+                return
+
+            with self._cond:
+                if self.closed:
+                    return
+                self.depth_bytes -= size
+                self.sent_messages += len(batch)
+                self.sent_bytes += size
+                self.write_calls += 1
+
+class TransportQueue:
+    """Outbound queue for an asyncio transport.
+
+    The transport's own write buffer is the queue and the event loop is the
+    writer, so only the high-water mark and policy are applied here. The
+    buffer is measured in bytes, so max_bytes is the only limit. Messages
+    queued during one event loop iteration are handed to the transport in a
+    single writelines call.
+    """
+
+    def __init__(self, transport, max_bytes=DEFAULT_MAX_BYTES, policy=POLICY_DISCONNECT):
+        self.transport = transport
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._loop = asyncio.get_running_loop()
+        self._pending = []
+        self._pending_bytes = 0
+
+        # Counters
+        self.peak_depth_bytes = 0
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        self.write_calls = 0
+        self.dropped = 0
+
+    @property
+    def closed(self):
+        return self.transport.is_closing()
+
+    def put(self, data):
+        """Queue data for sending; same contract as OutboundQueue.put"""
+        if self.transport.is_closing():
+            raise ConnectionResetError("Connection is closed")
+
+        depth = self.transport.get_write_buffer_size() + self._pending_bytes
+        if depth + len(data) > self.max_bytes:
+            if self.policy == POLICY_DROP:
+                self.dropped += 1
+                return False
+            self._pending.clear()
+            self.transport.abort()
+            raise SlowConsumerError(f"Outbound buffer full ({depth} bytes)")
+
+        if not self._pending:
+            self._loop.call_soon(self._flush)
+        self._pending.append(data)
+        self._pending_bytes += len(data)
+        self.peak_depth_bytes = max(self.peak_depth_bytes, depth + len(data))
+        return True
+
+    def close(self):
+        self._flush()
+        self.transport.close()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = []
+        self._pending_bytes = 0
+        if self.transport.is_closing():
+            return
+        self.transport.writelines(pending)
+        self.sent_messages += len(pending)
+        self.sent_bytes += sum(len(data) for data in pending)
+        self.write_calls += 1
+
+    def stats(self):
+        """Return a snapshot of the queue counters"""
+        return {
+            'depth_bytes': self.transport.get_write_buffer_size() + self._pending_bytes,
+            'peak_depth_bytes': self.peak_depth_bytes,
+            'sent_messages': self.sent_messages,
+            'sent_bytes': self.sent_bytes,
+            'write_calls': self.write_calls,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,101 @@
+"""
+Monthly range partitioning of the message tables.
+
+With partitioning enabled chat_messages and room_messages are partitioned
+by timestamp, one partition per calendar month named <table>_pYYYYMM, plus
+a <table>_default partition for rows outside every month that exists. The
+chat server creates the partitions for the coming months at startup and
+then once a day, and purging old messages detaches and drops whole
+partitions instead of deleting rows, so neither leaves dead tuples for
+VACUUM to clean up.
+
+Queries that bound timestamp (history pages do) only scan the partitions
+that can hold matching rows.
+"""
+
+import datetime
+import re
+
+# Tables partitioned by month when partitioning is enabled
+PARTITIONED_TABLES = ("chat_messages", "room_messages")
+
+# Months of partitions kept created ahead of the current one
+DEFAULT_MONTHS_AHEAD = 3
+
+def month_start(moment):
+    """Return midnight on the first day of moment's month"""
+    return datetime.datetime(moment.year, moment.month, 1)
+
+def add_months(month, count):
+    """Return the first day of the month count months after month"""
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.datetime(index // 12, index % 12 + 1, 1)
+
+def partition_name(table, month):
+    """Return the name of table's partition for month"""
+    return f"{table}_p{month:%Y%m}"
+
+def is_partitioned(cursor, table):
+    """Return True if table exists and is a partitioned table"""
+    cursor.execute("""
+        SELECT 1 FROM pg_partitioned_table p
+        JOIN pg_class c ON c.oid = p.partrelid
+        WHERE c.relname = %s AND pg_table_is_visible(c.oid)
+    """, (table,))
+    return cursor.fetchone() is not None
+
+def create_partitions(cursor, table, months_ahead=DEFAULT_MONTHS_AHEAD, now=None):
+    """Create table's default partition and its partitions from this month to
+    months_ahead months ahead; returns the names of those that were missing"""
+    existing = {name for name, _ in list_partitions(cursor, table)}
+    created = []
+
+    default = f"{table}_default"
+    if default not in existing:
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {default} PARTITION OF {table} DEFAULT")
+        created.append(default)
+
+    current = month_start(now or datetime.datetime.now())
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        name = partition_name(table, month)
+        if name in existing:
+            continue
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table}
+            FOR VALUES FROM (%s) TO (%s)
+        """, (month, add_months(month, 1)))
+        created.append(name)
+    return created
+
+def list_partitions(cursor, table):
+    """Return (name, month) for every partition of table, oldest month first.
+
+    month is None for the default partition and any partition not named
+    after a month.
+    """
+    cursor.execute("""
+        SELECT child.relname
+        FROM pg_inherits i
+        JOIN pg_class parent ON parent.oid = i.inhparent
+        JOIN pg_class child ON child.oid = i.inhrelid
+        WHERE parent.relname = %s AND pg_table_is_visible(parent.oid)
+    """, (table,))
+    pattern = re.compile(re.escape(table) + r"_p(\d{4})(\d{2})$")
+    partitions = []
+    for (name,) in cursor.fetchall():
+        match = pattern.match(name)
+        month = datetime.datetime(int(match.group(1)), int(match.group(2)), 1) if match else None
+        partitions.append((name, month))
+    partitions.sort(key=lambda partition: (partition[1] is None, partition[1] or datetime.datetime.min))
+    return partitions
+
+def expired_partitions(cursor, table, cutoff):
+    """Return the names of table's monthly partitions holding only rows older than cutoff"""
+    return [name for name, month in list_partitions(cursor, table)
+            if month is not None and add_months(month, 1) <= cutoff]
+
+def drop_partition(cursor, table, name):
+    """Detach a partition from table and drop it"""
+    cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+    cursor.execute(f"DROP TABLE {name}")
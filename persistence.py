@@ -0,0 +1,403 @@
+"""
+Write-behind message persistence for the chat server.
+
+Client handlers used to INSERT and commit every chat message before it was
+broadcast, so database latency was added to every message. Handlers now only
+queue the message; a writer thread hands batches to a flush callable (one
+multi-row INSERT per batch) once max_batch messages are waiting or
+flush_interval seconds have passed since the first of them arrived.
+
+The queue is bounded. Messages that do not fit, or whose batch fails to
+flush because the database is down, are appended to an optional spill file
+(one JSON record per line) and replayed once a flush succeeds again.
+Messages that do not fit are handed to a spill thread, so submit() never
+waits for the disk even on an event loop;
+without a spill file they are counted as dropped. close() flushes whatever
+is still queued, so a clean shutdown loses nothing.
+
+Only errors of the retryable types (the database being unreachable) are
+spilled. A batch that fails for any other reason is written again in
+halves, so one bad record cannot hold back the rest, and the records that
+fail on their own go to the reject file in the spill format, where they
+can be looked at and moved back once fixed.
+"""
+
+import collections
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("ChatServer")
+
+# Defaults
+DEFAULT_MAX_BATCH = 500
+DEFAULT_FLUSH_INTERVAL = 0.05
+DEFAULT_MAX_QUEUE = 10000
+
+# Seconds between attempts to replay the spill file while the database is down
+SPILL_RETRY_INTERVAL = 5.0
+
+class MessageWriter:
+    """Queues records and writes them in batches on a background thread.
+
+    Records are tuples of JSON-serialisable values, except that datetimes
+    are allowed too (they are written to the spill file as ISO strings).
+    """
+
+    def __init__(self, flush_batch, max_batch=DEFAULT_MAX_BATCH, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_queue=DEFAULT_MAX_QUEUE, spill_path=None, reject_path=None, retryable=(Exception,)):
+        self.flush_batch = flush_batch  # Called with a list of records; raises on failure
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.spill_path = spill_path
+        self.reject_path = reject_path  # Records that cannot be written, or None to drop them
+        self.retryable = retryable  # Exception types that mean the database is unavailable
+        self.closed = False
+
+        self._queue = collections.deque()
+        self._first_queued_at = None  # When the oldest queued record arrived
+        self._cond = threading.Condition()
+        self._spill_lock = threading.Lock()
+        self._next_replay = 0.0  # Monotonic time of the next spill replay attempt
+        self._overflow = collections.deque()  # Records that did not fit, waiting for the spill thread
+        self._overflow_cond = threading.Condition()
+        self._overflow_closed = False
+
+        # Counters
+        self.submitted = 0
+        self.written = 0
+        self.batches = 0
+        self.max_batch_seen = 0
+        self.flush_seconds = 0.0  # Total time spent in flush_batch
+        self.max_flush_seconds = 0.0
+        self.failed_batches = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.rejected = 0
+        self.dropped = 0
+
+        self._thread = threading.Thread(target=self._run, name="message-writer")
+        self._thread.daemon = True
+        self._thread.start()
+        self._spill_thread = threading.Thread(target=self._run_spill, name="message-spill")
+        self._spill_thread.daemon = True
+        self._spill_thread.start()
+
+    def submit(self, record):
+        """Queue a record for writing; returns False if it is spilled or dropped instead"""
+        with self._cond:
+            if not self.closed and len(self._queue) < self.max_queue:
+                if not self._queue:
+                    self._first_queued_at = time.monotonic()
+                self._queue.append(record)
+                self.submitted += 1
+                # Wake the writer to start the flush timer, or to flush a full batch
+                if len(self._queue) == 1 or len(self._queue) >= self.max_batch:
+                    self._cond.notify()
+                return True
+            self.submitted += 1
+            if not self.closed:
+                # Appended under _cond, so close() cannot stop the spill thread before it sees the record
+                with self._overflow_cond:
+                    self._overflow.append(record)
+                    self._overflow_cond.notify()
+                return False
+
+        # Shutting down; nothing is left to hand the record to
+        self._spill([record])
+        return False
+
+    def close(self, timeout=5.0):
+        """Stop accepting records and flush everything still queued"""
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        with self._overflow_cond:
+            self._overflow_closed = True
+            self._overflow_cond.notify()
+        self._spill_thread.join(timeout)
+
+    def stats(self):
+        """Return a snapshot of the writer counters"""
+        with self._cond:
+            return {
+                'queued': len(self._queue),
+                'overflow': len(self._overflow),
+                'submitted': self.submitted,
+                'written': self.written,
+                'batches': self.batches,
+                'avg_batch': round(self.written / self.batches, 1) if self.batches else 0,
+                'max_batch': self.max_batch_seen,
+                'avg_flush_ms': round(self.flush_seconds * 1000 / self.batches, 2) if self.batches else 0,
+                'max_flush_ms': round(self.max_flush_seconds * 1000, 2),
+                'failed_batches': self.failed_batches,
+                'spilled': self.spilled,
+                'replayed': self.replayed,
+                'rejected': self.rejected,
+                'dropped': self.dropped,
+            }
+
+    def _run(self):
+        self._replay_spill()
+        while True:
+            with self._cond:
+                while not self.closed:
+                    if len(self._queue) >= self.max_batch:
+                        break
+                    if self._queue:
+                        remaining = self._first_queued_at + self.flush_interval - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait(SPILL_RETRY_INTERVAL if self._has_spill() else None)
+                        if not self._queue:
+                            break
+                batch = [self._queue.popleft() for _ in range(min(self.max_batch, len(self._queue)))]
+                if self._queue:
+                    self._first_queued_at = time.monotonic()
+                closing = self.closed and not self._queue
+
+            if batch and self._write(batch):
+                self._replay_spill()
+            elif not batch:
+                self._replay_spill()
+            if closing:
+                return
+
+    def _run_spill(self):
+        """Spill the records that did not fit in the queue, off the callers' threads"""
+        while True:
+            with self._overflow_cond:
+                while not self._overflow and not self._overflow_closed:
+                    self._overflow_cond.wait()
+                records = list(self._overflow)
+                self._overflow.clear()
+                closing = self._overflow_closed
+            if records:
+                self._spill(records)
+            elif closing:
+                return
+
+    def _write(self, batch):
+        """Flush one batch, spilling what the database could not take; returns True if it was up"""
+        start = time.perf_counter()
+        written, unwritten = self._flush(batch)
+        if unwritten:
+            self._spill(unwritten)
+            with self._cond:
+                self.written += written
+            return False
+
+        elapsed = time.perf_counter() - start
+        with self._cond:
+            self.written += written
+            self.batches += 1
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            self.flush_seconds += elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        return True
+
+    def _flush(self, batch):
+        """Write batch, rejecting records that fail on their own.
+
+        Returns (records written, records left unwritten because the
+        database is unavailable).
+        """
+        try:
+            self.flush_batch(batch)
+            return len(batch), []
+        except Exception as e:
+            with self._cond:
+                self.failed_batches += 1
+            if isinstance(e, self.retryable):
+                logger.error(f"Failed to write {len(batch)} messages: {e}")
+                return 0, batch
+            if len(batch) == 1:
+                self._reject(batch, e)
+                return 0, []
+            logger.error(f"Failed to write {len(batch)} messages, writing them in parts: {e}")
+
+        # Split the failed batch until every part is written or is a single bad record
+        written = 0
+        middle = len(batch) // 2
+        pending = [batch[middle:], batch[:middle]]
+        while pending:
+            records = pending.pop()
+            try:
+                self.flush_batch(records)
+            except Exception as e:
+                if isinstance(e, self.retryable):
+                    logger.error(f"Failed to write {len(records)} messages: {e}")
+                    return written, records + [record for part in reversed(pending) for record in part]
+                if len(records) == 1:
+                    self._reject(records, e)
+                else:
+                    middle = len(records) // 2
+                    pending += [records[middle:], records[:middle]]
+                continue
+            written += len(records)
+        return written, []
+
+    def _reject(self, records, error):
+        logger.error(f"Rejected a message that cannot be written: {error}")
+        with self._cond:
+            self.rejected += len(records)
+        if not self.reject_path:
+            return
+        try:
+            with self._spill_lock, open(self.reject_path, 'a', encoding='utf-8') as reject:
+                for record in records:
+                    reject.write(json.dumps([_to_json(value) for value in record]) + "\n")
+        except OSError as e:
+            logger.error(f"Failed to write {len(records)} rejected messages to {self.reject_path}: {e}")
+
+    def _has_spill(self):
+        return bool(self.spill_path) and (
+            os.path.exists(self.spill_path) or os.path.exists(self.spill_path + ".replay"))
+
+    def _spill(self, records):
+        if not self.spill_path:
+            with self._cond:
+                self.dropped += len(records)
+            logger.warning(f"Dropped {len(records)} messages that could not be written")
+            return
+
+        try:
+            with self._spill_lock, open(self.spill_path, 'a', encoding='utf-8') as spill:
+                for record in records:
+                    spill.write(json.dumps([_to_json(value) for value in record]) + "\n")
+        except OSError as e:
+            logger.error(f"Failed to spill {len(records)} messages to {self.spill_path}: {e}")
+            with self._cond:
+                self.dropped += len(records)
+            return
+        with self._cond:
+            self.spilled += len(records)
+
+    def _replay_spill(self):
+        """Write the spilled records back, at most once per SPILL_RETRY_INTERVAL"""
+        if not self._has_spill() or time.monotonic() < self._next_replay:
+            return
+        self._next_replay = time.monotonic() + SPILL_RETRY_INTERVAL
+
+        # Move the file aside first so new spills go to a fresh one
+        replay_path = self.spill_path + ".replay"
+        with self._spill_lock:
+            if not os.path.exists(replay_path) and os.path.exists(self.spill_path):
+                os.replace(self.spill_path, replay_path)
+
+        with open(replay_path, encoding='utf-8') as replay:
+            records = [tuple(_from_json(value) for value in json.loads(line)) for line in replay if line.strip()]
+
+        replayed = 0
+        for start in range(0, len(records), self.max_batch):
+            batch = records[start:start + self.max_batch]
+            written, unwritten = self._flush(batch)
+            replayed += written
+            with self._cond:
+                self.replayed += written
+            if unwritten:
+                logger.error("Failed to replay spilled messages")
+                # Keep what is left for the next attempt
+                with self._spill_lock, open(replay_path, 'w', encoding='utf-8') as replay:
+                    for record in unwritten + records[start + self.max_batch:]:
+                        replay.write(json.dumps([_to_json(value) for value in record]) + "\n")
+                return
+
+        os.remove(replay_path)
+        logger.info(f"Replayed {replayed} spilled messages")
+
+def _to_json(value):
+    if isinstance(value, datetime.datetime):
+        return {"$datetime": value.isoformat()}
+    return value
+
+def _from_json(value):
+    if isinstance(value, dict) and "$datetime" in value:
+        return datetime.datetime.fromisoformat(value["$datetime"])
+    return value
+
+ID_RETRY_INTERVAL = 1.0  # Seconds between attempts to reserve ids after a failure
+
+class IdAllocator:
+    """Hands out message ids reserved from the database in blocks.
+
+    Messages are written behind the broadcast, so their ids cannot come from
+    the INSERT. Reserving a block of sequence values up front gives every
+    message its final id the moment it arrives, with one query per block.
+
+    next_id() never waits for the database, as it runs on the event loop:
+    the next block is reserved in a background thread once fewer than
+    low_water ids are left. If the ids run out anyway, next_id() returns
+    None and the writer takes the id from the sequence when it inserts.
+    """
+
+    def __init__(self, reserve, block_size=100, low_water=None):
+        self.reserve = reserve  # Called with a count; returns that many new ids in increasing order
+        self.block_size = block_size
+        self.low_water = block_size // 2 if low_water is None else low_water
+        self._ids = collections.deque()
+        self._lock = threading.Lock()
+        self._refilling = False
+        self._next_refill = 0.0  # Monotonic time before which a failed reservation is not retried
+
+        # Counters
+        self.refills = 0
+        self.failed_refills = 0
+        self.exhausted = 0
+
+    def fill(self):
+        """Reserve a block now, e.g. at startup; logs and returns False if it fails"""
+        with self._lock:
+            if self._refilling:
+                return True
+            self._refilling = True
+        return self._refill()
+
+    def next_id(self):
+        """Return the next reserved id, or None if none is left right now"""
+        with self._lock:
+            message_id = self._ids.popleft() if self._ids else None
+            if message_id is None:
+                self.exhausted += 1
+            if (len(self._ids) < self.low_water and not self._refilling
+                    and time.monotonic() >= self._next_refill):
+                self._refilling = True
+                thread = threading.Thread(target=self._refill)
+                thread.daemon = True
+                thread.start()
+        return message_id
+
+    def stats(self):
+        """Return a snapshot of the allocator counters"""
+        with self._lock:
+            return {
+                'available': len(self._ids),
+                'refills': self.refills,
+                'failed_refills': self.failed_refills,
+                'exhausted': self.exhausted,
+            }
+
+    def _refill(self):
+        try:
+            ids = self.reserve(self.block_size)
+        except Exception as e:
+            logger.error(f"Could not reserve message ids: {e}")
+            with self._lock:
+                self.failed_refills += 1
+                self._next_refill = time.monotonic() + ID_RETRY_INTERVAL
+                self._refilling = False
+            return False
+        with self._lock:
+            self._ids.extend(ids)
+            self.refills += 1
+            self._refilling = False
+        return True
@@ -0,0 +1,82 @@
+"""
+Presence tracking for the chat servers.
+
+Instead of sending the whole user list to everyone on every join and leave,
+the server collects presence changes for a short window and then publishes
+one versioned delta:
+
+    {"type": "presence_delta", "base_version": 41, "version": 42,
+     "joined": ["bob"], "left": ["carol"]}
+
+A client applies a delta only if base_version matches the version it has;
+otherwise it sends {"type": "presence_sync"} and gets a full user_list
+snapshot, which is also what every client receives when it connects.
+"""
+
+import json
+import threading
+
+from timers import thread_timer
+
+class PresenceTracker:
+    """Debounces joins and leaves into versioned presence deltas.
+
+    Callers only mark a username as changed; whether it is online is read
+    from the registry when the window closes. A user who disconnects and
+    reconnects within one window therefore produces no delta at all, and
+    several devices of one user joining at once produce a single join.
+    """
+
+    def __init__(self, registry, publish, window=0.1, schedule=thread_timer):
+        self.registry = registry
+        self.publish = publish  # Called with the encoded delta after each flush
+        self.window = window
+        self.schedule = schedule  # schedule(delay, callback); replaced by the asyncio engine
+        self.version = 0
+
+        # Reentrant: publishing can drop a dead client, which marks another change
+        self._lock = threading.RLock()
+        self._announced = set()  # Usernames online as of the last delta
+        self._changed = set()
+        self._scheduled = False
+
+    def mark_changed(self, username):
+        """Record that a user's sessions changed; a delta goes out when the window closes"""
+        with self._lock:
+            self._changed.add(username)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.schedule(self.window, self.flush)
+
+    def flush(self):
+        """Publish one delta covering every change since the last flush"""
+        with self._lock:
+            self._scheduled = False
+            changed, self._changed = self._changed, set()
+
+            joined = []
+            left = []
+            for username in sorted(changed):
+                online = bool(self.registry.sessions_for(username))
+                if online and username not in self._announced:
+                    joined.append(username)
+                    self._announced.add(username)
+                elif not online and username in self._announced:
+                    left.append(username)
+                    self._announced.discard(username)
+
+            if not joined and not left:
+                return
+
+            delta = {
+                "type": "presence_delta",
+                "base_version": self.version,
+                "version": self.version + 1,
+                "joined": joined,
+                "left": left
+            }
+            self.version += 1
+
+            # Publish under the lock so deltas always go out in version order
+            self.publish(json.dumps(delta).encode('utf-8'))
@@ -0,0 +1,230 @@
+"""
+Private message sessions for the chat client.
+
+Instead of a fresh key agreement for every private message, a sender sets
+up one session per peer: an ephemeral X25519 key agreed with the peer's
+X25519 key gives a root key, and from it a chain key that is advanced with
+HMAC-SHA256 for every message (a symmetric ratchet). Each message gets its
+own AES-GCM key from the chain, with the message counter as the nonce and
+the session, counter, sender and recipient as associated data.
+
+Every message carries the session id, its counter and the session's
+ephemeral public key, so a recipient that has never seen the session, or
+forgot it on a restart, can rebuild it from the message in hand. After
+that, decrypting costs two HMACs and one AES-GCM call. The sender starts a
+new session every REKEY_MESSAGES messages or REKEY_SECONDS seconds.
+
+A received message only changes a session once it has authenticated: the
+keys up to its counter are derived on the side and kept only if AES-GCM
+accepts the message, and counters too far ahead are refused before any
+key is derived, so a forged message can neither stall the client nor move
+a session past the genuine messages.
+"""
+
+import base64
+import hmac
+import os
+import time
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import x25519
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+SESSION_SCHEME = "session"
+
+REKEY_MESSAGES = 1000  # Messages sent in one session before starting a new one
+REKEY_SECONDS = 3600  # Age at which a sending session is replaced
+MAX_SKIP = 100  # Keys kept for messages that arrive out of order or never
+INCOMING_PER_PEER = 4  # Receiving sessions remembered per peer; older ones are forgotten
+
+SESSION_INFO = b"chat-session-root"
+
+class SessionError(Exception):
+    """Raised when a session message cannot be decrypted"""
+
+def b64encode(data):
+    return base64.b64encode(data).decode('utf-8')
+
+def chain_step(chain_key):
+    """Return (next chain key, message key) for one step of the ratchet"""
+    return hmac.digest(chain_key, b"\x02", "sha256"), hmac.digest(chain_key, b"\x01", "sha256")
+
+def associated_data(session_id, counter, sender, recipient):
+    return f"{session_id}:{counter}:{sender}>{recipient}".encode('utf-8')
+
+class Chain:
+    """One direction of a session: a chain key advanced once per message"""
+
+    def __init__(self, session_id, chain_key):
+        self.session_id = session_id
+        self.chain_key = chain_key
+        self.counter = 0  # Counter of the next message key
+        self.created = time.monotonic()
+        self.skipped = {}  # counter -> message key of messages not seen yet
+
+    def next_key(self):
+        """Return (counter, message key) for the next message to send"""
+        counter = self.counter
+        self.chain_key, message_key = chain_step(self.chain_key)
+        self.counter += 1
+        return counter, message_key
+
+    def key_for(self, counter, max_gap=MAX_SKIP):
+        """Return (message key, state) for a received message without changing the chain.
+
+        Messages more than max_gap ahead of the chain are refused before
+        any key is derived. Pass state to commit() once the message has
+        authenticated.
+        """
+        if counter < self.counter:
+            message_key = self.skipped.get(counter)
+            if message_key is None:
+                raise SessionError(f"message {counter} was already read or is too old")
+            return message_key, None
+        if counter - self.counter > max_gap:
+            raise SessionError(f"message {counter} is too far ahead of message {self.counter}")
+        chain_key = self.chain_key
+        skipped = {}
+        for skipped_counter in range(self.counter, counter):
+            chain_key, skipped[skipped_counter] = chain_step(chain_key)
+        chain_key, message_key = chain_step(chain_key)
+        return message_key, (chain_key, skipped)
+
+    def commit(self, counter, state):
+        """Apply what key_for derived for the message with counter, which authenticated.
+
+        Keys of the last MAX_SKIP skipped messages are kept so they can
+        still be read if they arrive late; each key is used once.
+        """
+        if state is None:
+            del self.skipped[counter]
+            return
+        self.chain_key, skipped = state
+        self.counter = counter + 1
+        self.skipped.update(skipped)
+        while len(self.skipped) > MAX_SKIP:
+            del self.skipped[min(self.skipped)]
+
+class SessionStore:
+    """Sending and receiving sessions with every peer.
+
+    Sending only needs the peer's key; receiving needs identity, which may
+    be set once the client's keys are ready.
+    """
+
+    def __init__(self, identity=None):
+        self.identity = identity
+        self._outgoing = {}  # peer -> (Chain, ephemeral public key, PeerKey it was set up for)
+        self._incoming = {}  # peer -> {session_id: Chain}, oldest first
+
+        # Counters
+        self.sessions_started = 0
+        self.sessions_accepted = 0
+        self.encrypted = 0
+        self.decrypted = 0
+
+    def encrypt(self, sender, recipient, peer_key, plaintext):
+        """Encrypt plaintext for recipient's X25519 peer_key; returns the private_message fields"""
+        outgoing = self._outgoing.get(recipient)
+        if outgoing is None or outgoing[2] is not peer_key or self._expired(outgoing[0]):
+            outgoing = self._start(recipient, peer_key)
+        chain, ephemeral_key, _ = outgoing
+
+        counter, message_key = chain.next_key()
+        ciphertext = AESGCM(message_key).encrypt(
+            counter.to_bytes(12, 'big'),
+            plaintext.encode('utf-8'),
+            associated_data(chain.session_id, counter, sender, recipient)
+        )
+        self.encrypted += 1
+        return {
+            "scheme": SESSION_SCHEME,
+            "session_id": chain.session_id,
+            "counter": counter,
+            "ephemeral_key": ephemeral_key,
+            "encrypted_message": b64encode(ciphertext),
+        }
+
+    def decrypt(self, sender, recipient, data):
+        """Decrypt the fields of a session private_message from sender; returns the text"""
+        try:
+            session_id = str(data["session_id"])
+            counter = int(data["counter"])
+            ciphertext = base64.b64decode(data["encrypted_message"])
+        except (KeyError, TypeError, ValueError) as e:
+            raise SessionError(f"malformed session message: {e}")
+        if not 0 <= counter < REKEY_MESSAGES:
+            raise SessionError(f"malformed session message: counter {counter}")
+
+        sessions = self._incoming.get(sender, {})
+        chain = sessions.get(session_id)
+        if chain is None:
+            # A session we have not seen, or forgot; any genuine counter is below REKEY_MESSAGES
+            chain = self._accept(session_id, data.get("ephemeral_key"))
+            message_key, state = chain.key_for(counter, max_gap=REKEY_MESSAGES)
+        else:
+            message_key, state = chain.key_for(counter)
+        try:
+            plaintext = AESGCM(message_key).decrypt(
+                counter.to_bytes(12, 'big'),
+                ciphertext,
+                associated_data(session_id, counter, sender, recipient)
+            )
+        except InvalidTag:
+            raise SessionError("message does not authenticate")
+
+        chain.commit(counter, state)
+        if session_id not in sessions:
+            sessions = self._incoming.setdefault(sender, {})
+            sessions[session_id] = chain
+            while len(sessions) > INCOMING_PER_PEER:
+                del sessions[next(iter(sessions))]
+            self.sessions_accepted += 1
+        self.decrypted += 1
+        return plaintext.decode('utf-8')
+
+    def forget(self, peer):
+        """Drop the sessions with peer, e.g. when its key changed"""
+        self._outgoing.pop(peer, None)
+        self._incoming.pop(peer, None)
+
+    def stats(self):
+        """Return a snapshot of the session counters"""
+        return {
+            'outgoing_sessions': len(self._outgoing),
+            'incoming_sessions': sum(len(sessions) for sessions in self._incoming.values()),
+            'sessions_started': self.sessions_started,
+            'sessions_accepted': self.sessions_accepted,
+            'encrypted': self.encrypted,
+            'decrypted': self.decrypted,
+        }
+
+    def _start(self, recipient, peer_key):
+        ephemeral = x25519.X25519PrivateKey.generate()
+        root_key = derive_root_key(ephemeral.exchange(peer_key.public_key))
+        ephemeral_key = b64encode(ephemeral.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw))
+        outgoing = (Chain(b64encode(os.urandom(9)), root_key), ephemeral_key, peer_key)
+        self._outgoing[recipient] = outgoing
+        self.sessions_started += 1
+        return outgoing
+
+    def _accept(self, session_id, ephemeral_key):
+        """Build the receiving chain of a new session; it is kept once a message authenticates"""
+        if self.identity is None or self.identity.x25519_key is None:
+            raise SessionError("no X25519 key to set up a session with")
+        try:
+            ephemeral = x25519.X25519PublicKey.from_public_bytes(base64.b64decode(ephemeral_key))
+            shared_secret = self.identity.x25519_key.exchange(ephemeral)
+        except (TypeError, ValueError) as e:
+            raise SessionError(f"malformed session key: {e}")
+        return Chain(session_id, derive_root_key(shared_secret))
+
+    @staticmethod
+    def _expired(chain):
+        return chain.counter >= REKEY_MESSAGES or time.monotonic() - chain.created >= REKEY_SECONDS
+
+def derive_root_key(shared_secret):
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=SESSION_INFO).derive(shared_secret)
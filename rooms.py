@@ -0,0 +1,110 @@
+"""
+Room membership index for the chat server.
+
+Room messages go only to the online sessions of the room's members, so the
+server keeps, for every room, the tuple of member sessions currently
+connected. Membership (which users belong to which room) is loaded from
+room_members at startup and updated on join_room and leave_room; sessions
+are added to and removed from their user's rooms as they connect and
+disconnect.
+
+Like SessionRegistry the index is copy-on-write: writers build new tuples
+under a lock, and a room fan-out just grabs the current tuple.
+"""
+
+import threading
+
+class RoomIndex:
+    """Room -> member usernames and room -> online member sessions"""
+
+    def __init__(self):
+        self._lock = threading.Lock()  # Serialises writers only
+        self._members = {}  # room_id -> set of member usernames
+        self._rooms_of = {}  # username -> set of room_ids
+        self._sessions = {}  # room_id -> tuple of online member sessions
+
+        # Counters
+        self.room_messages = 0
+        self.deliveries = 0
+
+    def load(self, rows):
+        """Add (room_id, username) membership rows"""
+        with self._lock:
+            for room_id, username in rows:
+                self._members.setdefault(room_id, set()).add(username)
+                self._rooms_of.setdefault(username, set()).add(room_id)
+
+    def join(self, room_id, username, sessions):
+        """Make username a member of room_id; sessions are its online sessions"""
+        with self._lock:
+            self._members.setdefault(room_id, set()).add(username)
+            self._rooms_of.setdefault(username, set()).add(room_id)
+            online = self._sessions.get(room_id, ())
+            self._sessions[room_id] = online + tuple(s for s in sessions if s not in online)
+
+    def leave(self, room_id, username):
+        """Remove username from room_id"""
+        with self._lock:
+            self._discard(self._members, room_id, username)
+            self._discard(self._rooms_of, username, room_id)
+            self._set_sessions(room_id, tuple(s for s in self._sessions.get(room_id, ())
+                                              if s.username != username))
+
+    def session_joined(self, session):
+        """Add a newly connected session to its user's rooms"""
+        with self._lock:
+            for room_id in self._rooms_of.get(session.username, ()):
+                online = self._sessions.get(room_id, ())
+                if session not in online:
+                    self._sessions[room_id] = online + (session,)
+
+    def session_left(self, session):
+        """Remove a disconnected session from its user's rooms"""
+        with self._lock:
+            for room_id in self._rooms_of.get(session.username, ()):
+                self._set_sessions(room_id, tuple(s for s in self._sessions.get(room_id, ())
+                                                  if s is not session))
+
+    def is_member(self, room_id, username):
+        """Return True if username belongs to room_id"""
+        return username in self._members.get(room_id, ())
+
+    def rooms_for(self, username):
+        """Return the ids of the rooms username belongs to"""
+        with self._lock:
+            return sorted(self._rooms_of.get(username, ()))
+
+    def sessions(self, room_id):
+        """Return an immutable snapshot of the room's online member sessions"""
+        return self._sessions.get(room_id, ())
+
+    def count_message(self, deliveries):
+        """Record a room message that was queued for deliveries sessions"""
+        with self._lock:
+            self.room_messages += 1
+            self.deliveries += deliveries
+
+    def stats(self):
+        """Return a snapshot of the index counters"""
+        with self._lock:
+            return {
+                'rooms': len(self._members),
+                'memberships': sum(len(members) for members in self._members.values()),
+                'online_memberships': sum(len(sessions) for sessions in self._sessions.values()),
+                'room_messages': self.room_messages,
+                'deliveries': self.deliveries,
+            }
+
+    def _set_sessions(self, room_id, sessions):
+        if sessions:
+            self._sessions[room_id] = sessions
+        else:
+            self._sessions.pop(room_id, None)
+
+    @staticmethod
+    def _discard(index, key, value):
+        values = index.get(key)
+        if values is not None:
+            values.discard(value)
+            if not values:
+                del index[key]
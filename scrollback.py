@@ -0,0 +1,70 @@
+"""
+Compact scrollback store for the chat client.
+
+The chat widget only ever holds a window of recent lines; everything the
+session has shown is kept here instead, as UTF-8 in one bytearray plus an
+array of line offsets, which costs a few bytes per line on top of the text
+rather than a Python string object per line. Lines are addressed by an
+absolute index that never changes while the line is stored, so the client
+can remember which range the widget shows.
+
+Appending past max_lines drops the oldest quarter in one go, so the buffer
+is compacted rarely. Older history fetched from the server is prepended.
+"""
+
+from array import array
+
+class LineStore:
+    """Text lines in a bytearray, indexed by absolute line number"""
+
+    def __init__(self, max_lines=50000):
+        self.max_lines = max_lines
+        self.start = 0  # Absolute index of the first stored line
+        self._data = bytearray()
+        self._offsets = array('Q', [0])  # Line start + i is _data[_offsets[i]:_offsets[i + 1]]
+
+    @property
+    def end(self):
+        """Absolute index just past the last stored line"""
+        return self.start + len(self._offsets) - 1
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def extend(self, lines):
+        """Append lines (without newlines)"""
+        for line in lines:
+            self._data += line.encode('utf-8')
+            self._offsets.append(len(self._data))
+        if len(self) > self.max_lines:
+            self._drop(len(self) - self.max_lines + self.max_lines // 4)
+
+    def prepend(self, lines):
+        """Insert lines (without newlines) before the first stored line"""
+        encoded = [line.encode('utf-8') for line in lines]
+        offsets = array('Q', [0])
+        for line in encoded:
+            offsets.append(offsets[-1] + len(line))
+        shift = offsets[-1]
+        offsets.extend(offset + shift for offset in self._offsets[1:])
+        self._data[:0] = b"".join(encoded)
+        self._offsets = offsets
+        self.start -= len(encoded)
+
+    def lines(self, first, last):
+        """Return the stored lines with absolute indexes in [first, last)"""
+        first = max(first, self.start) - self.start
+        last = min(last, self.end) - self.start
+        return [self._data[self._offsets[i]:self._offsets[i + 1]].decode('utf-8') for i in range(first, last)]
+
+    def clear(self):
+        """Forget every line; indexes keep counting from end"""
+        self.start = self.end
+        self._data = bytearray()
+        self._offsets = array('Q', [0])
+
+    def _drop(self, count):
+        cut = self._offsets[count]
+        del self._data[:cut]
+        self._offsets = array('Q', (offset - cut for offset in self._offsets[count:]))
+        self.start += count
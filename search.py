@@ -0,0 +1,54 @@
+"""
+Full-text search over chat messages.
+
+chat_messages and room_messages get a search_vector column that PostgreSQL
+generates from the message text, with a GIN index on it, so a search is an
+index lookup instead of a LIKE scan over every message. Queries use web
+search syntax ("deploy failed", -staging, foo OR bar) and hits are ranked
+by ts_rank, best first.
+"""
+
+# Text search configuration used for both the column and the queries
+SEARCH_CONFIG = "english"
+
+# Tables whose messages can be searched
+SEARCH_TABLES = ("chat_messages", "room_messages")
+
+def create_search_index(cursor, table):
+    """Add the generated search_vector column and its GIN index to table.
+
+    Adding the column rewrites the table once; after that PostgreSQL keeps
+    it up to date on every insert and update.
+    """
+    cursor.execute(f"""
+        ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', message)) STORED
+    """)
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_search ON {table} USING GIN (search_vector)")
+
+def search_messages(cursor, query, room_id=None, include_private=False, limit=20, offset=0):
+    """Run a ranked full-text search on an open cursor.
+
+    Searches the public messages, or only those of one room if room_id is
+    given. Rows are (id, username, message, timestamp, rank), best match
+    first and newest first among equal ranks.
+    """
+    if room_id is not None:
+        source = "room_messages m"
+        condition = "m.room_id = %s"
+        params = (room_id,)
+    else:
+        source = "chat_messages m"
+        condition = "TRUE" if include_private else "m.is_private = FALSE"
+        params = ()
+
+    cursor.execute(f"""
+        SELECT m.id, u.username, m.message, m.timestamp, ts_rank(m.search_vector, q) AS rank
+        FROM {source}
+        JOIN chat_users u ON m.sender_id = u.id,
+             websearch_to_tsquery('{SEARCH_CONFIG}', %s) q
+        WHERE {condition} AND m.search_vector @@ q
+        ORDER BY rank DESC, m.id DESC
+        LIMIT %s OFFSET %s
+    """, (query,) + params + (limit, offset))
+    return cursor.fetchall()
@@ -1,17 +1,49 @@
 import socket
 import threading
+import time
+import asyncio
+import argparse
 import sys
 import psycopg2
+from psycopg2.extras import execute_values
 import datetime
 import logging
 import signal
 import json
+import itertools
+import os
+from framing import (FrameDecoder, FrameError, HandshakeReader, encode_frame, recv_handshake,
+                     HANDSHAKE_WAIT, SINCE_ID_OPTION, EPOCH_OPTION)
+from sessions import Session, SessionRegistry
+from presence import PresenceTracker
+from typing_state import TypingTracker
+from outbound import OutboundQueue, fan_out, TransportQueue, POLICIES, POLICY_DISCONNECT
+from db_pool import ConnectionPool, PoolError
+from persistence import MessageWriter, IdAllocator
+from user_cache import UserCache, LastSeenBatcher
+from history import HistoryCache, TIMESTAMP_FORMAT, format_message
+from partitions import PARTITIONED_TABLES, DEFAULT_MONTHS_AHEAD, is_partitioned, create_partitions
+from search import SEARCH_TABLES, create_search_index, search_messages
+from rooms import RoomIndex
+from keydir import KeyDirectory, clean_keys, key_fingerprint
+import select
 
 # Use IPv4 address instead of IPv6
 host = '127.0.0.1'  # IPv4 localhost
 port = 5054
 listener_limit = 100
 
+# Outbound queue settings (per connection)
+queue_max_messages = 1000  # High-water mark in queued messages
+queue_max_bytes = 4 * 1024 * 1024  # High-water mark in queued bytes
+slow_client_policy = POLICY_DISCONNECT  # What to do when a client falls behind: 'disconnect' or 'drop'
+stats_interval = 0  # Seconds between queue depth reports in the log (0 disables them)
+
+# Presence settings
+presence_window = 0.1  # Seconds to collect joins and leaves into one presence delta
+typing_tick = 0.1  # Seconds to collect typing changes into one typing_state message
+typing_timeout = 3.0  # Seconds after the last TYPING: before the server clears the flag
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -23,8 +55,8 @@ logging.basicConfig(
 )
 logger = logging.getLogger("ChatServer")
 
-active_clients = []  # List of connected clients
-client_usernames = {}  # Dictionary to store client socket: username pairs
+registry = SessionRegistry()  # Connected sessions indexed by client and by username
+user_list_cache = (None, None)  # ((registry version, presence version), encoded user_list message)
 
 # Database configuration
 DB_CONFIG = {
@@ -35,27 +67,102 @@ DB_CONFIG = {
     'port': '5432'  # Default PostgreSQL port
 }
 
+# Database connection pool settings
+db_pool_min = 2  # Connections opened at startup and kept open
+db_pool_max = 10  # Most connections open at once
+db_pool_timeout = 5.0  # Seconds to wait for a free connection before giving up
+db_health_check_interval = 30.0  # Idle seconds after which a connection is pinged before reuse
+
+db_pool = None  # ConnectionPool, or None when running without a database
+
+# Write-behind persistence settings
+write_batch_size = 500  # Most messages written in one INSERT
+write_flush_interval = 0.05  # Seconds a message may wait for its batch to fill
+write_queue_size = 10000  # Messages waiting to be written before new ones are spilled
+spill_file = None  # File that holds messages the database could not take, or None to drop them
+
+# Errors that mean the database is unavailable; a batch that fails with one is spilled and retried
+DB_UNAVAILABLE = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError)
+
+message_writer = None  # MessageWriter, or None when running without a database
+message_ids = None  # IdAllocator, or None when running without a database
+id_block_size = 100  # Message ids reserved from the database at a time
+id_low_water = 50  # Ids left when the next block is reserved in the background
+memory_message_ids = itertools.count(1)  # Message ids used when running without a database
+
+# The id space SINCE_ID values refer to. In memory ids start again at 1 on
+# every run, so each run is its own epoch; database ids outlive restarts.
+server_epoch = f"memory-{os.urandom(6).hex()}"
+
+# User identity cache settings
+user_cache_size = 10000  # Users whose (id, theme) are kept in memory
+last_seen_interval = 30.0  # Seconds between batched last_seen updates
+USER_CHANGED_CHANNEL = "chat_user_changed"  # NOTIFY channel carrying usernames to invalidate
+
+user_cache = UserCache(user_cache_size)
+last_seen = None  # LastSeenBatcher, or None when running without a database
+
+# Recent public messages of each user, sent to every joining client
+HISTORY_PER_USER = 10
+HISTORY_RECENT_SIZE = 1000  # Newest messages kept to bring reconnecting clients up to date
+
+# history_request page sizes
+HISTORY_PAGE_DEFAULT = 50  # Messages per page when the client does not say
+HISTORY_PAGE_MAX = 200  # Largest page a client may ask for
+HISTORY_CHUNK_SIZE = 50  # Messages per history_page frame; larger pages are streamed in several
+history_cache = HistoryCache(HISTORY_PER_USER, HISTORY_RECENT_SIZE, server_epoch)
+
+# Chat rooms
+rooms = RoomIndex()  # Room members and the online sessions of each room
+room_writer = None  # MessageWriter for room_messages, or None when running without a database
+room_message_ids = None  # IdAllocator for room_messages, or None when running without a database
+memory_room_message_ids = itertools.count(1)  # Room message ids used when running without a database
+
+# Public key directory
+key_directory = KeyDirectory()  # Public keys published by users, loaded from user_keys
+KEYS_BATCH_MAX = 500  # Most users one get_keys request may ask about
+
+# search page sizes
+SEARCH_PAGE_DEFAULT = 20  # Hits per page when the client does not say
+SEARCH_PAGE_MAX = 100  # Largest page a client may ask for
+
+# Monthly partitioning of chat_messages and room_messages
+partition_messages = False  # Create the message tables partitioned by month
+partition_months_ahead = DEFAULT_MONTHS_AHEAD  # Months of partitions kept created ahead
+PARTITION_CHECK_INTERVAL = 24 * 60 * 60  # Seconds between checks for partitions to create
+messages_partitioned = False  # Whether the database's message tables turned out to be partitioned
+
 # Global flag for server running state
 server_running = True
 
-def get_db_connection():
-    """Create and return a database connection"""
+def create_db_pool():
+    """Open the database connection pool; returns None if it cannot be filled"""
+    pool = ConnectionPool(
+        lambda: psycopg2.connect(**DB_CONFIG),
+        min_size=db_pool_min,
+        max_size=db_pool_max,
+        timeout=db_pool_timeout,
+        health_check_interval=db_health_check_interval
+    )
     try:
-        logger.info(f"Connecting to database: {DB_CONFIG['dbname']} on {DB_CONFIG['host']}")
-        conn = psycopg2.connect(**DB_CONFIG)
-        logger.info("Database connection established successfully")
-        return conn
+        logger.info(f"Connecting to database: {DB_CONFIG['dbname']} on {DB_CONFIG['host']} "
+                    f"(pool of {db_pool_min}-{db_pool_max} connections)")
+        pool.fill()
+        logger.info("Database connection pool established successfully")
+        return pool
     except Exception as e:
         logger.error(f"Database connection error: {e}")
+        pool.close()
         return None
 
 def setup_database():
     """Create database tables if they don't exist"""
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to database. Chat history will not be saved.")
+    global messages_partitioned
+    if db_pool is None:
+        logger.error("Failed to connect to database. Chat history will only be kept in memory.")
         return False
     
+    conn = db_pool.acquire()
     cursor = conn.cursor()
     
     try:
@@ -76,11 +183,19 @@ def setup_database():
         )
         ''')
         
+        # Partitioned message tables need the partition key in their primary key
+        if partition_messages:
+            message_key = "PRIMARY KEY (id, timestamp)"
+            partitioning = "PARTITION BY RANGE (timestamp)"
+        else:
+            message_key = "PRIMARY KEY (id)"
+            partitioning = ""
+        
         # Create messages table
         logger.info("Creating chat_messages table if it doesn't exist")
-        cursor.execute('''
+        cursor.execute(f'''
         CREATE TABLE IF NOT EXISTS chat_messages (
-            id SERIAL PRIMARY KEY,
+            id SERIAL,
             sender_id INTEGER,
             message TEXT NOT NULL,
             timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -88,9 +203,10 @@ def setup_database():
             recipient_id INTEGER NULL,
             message_type VARCHAR(20) DEFAULT 'text',
             read_status BOOLEAN DEFAULT FALSE,
+            {message_key},
             FOREIGN KEY (sender_id) REFERENCES chat_users (id),
             FOREIGN KEY (recipient_id) REFERENCES chat_users (id)
-        )
+        ) {partitioning}
         ''')
         
         # Create chat rooms table
@@ -110,18 +226,22 @@ def setup_database():
         
         # Create room messages table
         logger.info("Creating room_messages table if it doesn't exist")
-        cursor.execute('''
+        cursor.execute(f'''
         CREATE TABLE IF NOT EXISTS room_messages (
-            id SERIAL PRIMARY KEY,
+            id SERIAL,
             room_id INTEGER,
             sender_id INTEGER,
             message TEXT NOT NULL,
             timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            {message_key},
             FOREIGN KEY (room_id) REFERENCES chat_rooms (id),
             FOREIGN KEY (sender_id) REFERENCES chat_users (id)
-        )
+        ) {partitioning}
         ''')
         
+        # Databases created partitioned stay partitioned, with or without the option
+        messages_partitioned = ensure_partitions(cursor)
+        
         # Create room members table
         logger.info("Creating room_members table if it doesn't exist")
         cursor.execute('''
@@ -136,12 +256,42 @@ def setup_database():
         )
         ''')
         
+        # Create user keys table
+        logger.info("Creating user_keys table if it doesn't exist")
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_keys (
+            user_id INTEGER,
+            key_type VARCHAR(16),
+            key_data TEXT NOT NULL,
+            fingerprint CHAR(64) NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, key_type),
+            FOREIGN KEY (user_id) REFERENCES chat_users (id)
+        )
+        ''')
+        
         # Create some indexes for performance
         logger.info("Creating indexes for better performance")
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON chat_messages (timestamp)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_room_messages_timestamp ON room_messages (timestamp)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_room_messages_room_id ON room_messages (room_id)')
         
+        # Composite indexes matching the (timestamp, id) keyset order of history pages
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_messages_public_page
+                          ON chat_messages (timestamp DESC, id DESC) WHERE is_private = FALSE''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_messages_private_page
+                          ON chat_messages (sender_id, recipient_id, timestamp DESC, id DESC) WHERE is_private''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_room_messages_page
+                          ON room_messages (room_id, timestamp DESC, id DESC)''')
+        
+        # (sender_id, id) lets db_management delete a user's messages in id order, one range scan per batch
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_sender ON chat_messages (sender_id, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_room_messages_sender ON room_messages (sender_id, id)')
+        
+        # Full-text search columns and their GIN indexes
+        for table in SEARCH_TABLES:
+            create_search_index(cursor, table)
+        
         conn.commit()
         logger.info("Database schema setup complete")
         return True
@@ -151,345 +301,1142 @@ def setup_database():
         return False
     finally:
         cursor.close()
-        conn.close()
+        db_pool.release(conn)
 
-def get_or_create_user(username, theme='default'):
-    """Get user ID from database or create if not exists"""
-    conn = get_db_connection()
-    if not conn:
-        return None, theme
-        
-    cursor = conn.cursor()
+def ensure_partitions(cursor):
+    """Create the monthly partitions the message tables will need soon.
     
+    Returns True if any message table is partitioned.
+    """
+    partitioned = False
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(cursor, table):
+            if partition_messages:
+                logger.warning(f"{table} was created without partitioning; it has to be migrated "
+                               f"to a partitioned table before partitions can be added")
+            continue
+        partitioned = True
+        created = create_partitions(cursor, table, partition_months_ahead)
+        if created:
+            logger.info(f"Created partitions {', '.join(created)}")
+    return partitioned
+
+def maintain_partitions():
+    """Keep creating upcoming message partitions while the server runs"""
+    while server_running:
+        time.sleep(PARTITION_CHECK_INTERVAL)
+        try:
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                ensure_partitions(cursor)
+                conn.commit()
+                cursor.close()
+        except Exception as e:
+            logger.error(f"Error creating message partitions: {e}")
+
+def fetch_or_create_user(cursor, username, theme='default'):
+    """Get user ID and theme on an open cursor, creating the user if it does not exist"""
     # Try to find existing user
     cursor.execute("SELECT id, theme FROM chat_users WHERE username = %s", (username,))
     result = cursor.fetchone()
     
     if result:
-        user_id = result[0]
-        user_theme = result[1]
+        return result[0], result[1]
+    
+    # Create new user with default theme
+    cursor.execute("""
+        INSERT INTO chat_users (username, last_seen, theme) 
+        VALUES (%s, %s, %s) 
+        RETURNING id
+    """, (username, datetime.datetime.now(), theme))
+    return cursor.fetchone()[0], theme
+
+def get_or_create_user(username, theme='default'):
+    """Get user ID from the cache or database, creating the user if it does not exist"""
+    if db_pool is None:
+        return None, theme
+    
+    cached = user_cache.get(username)
+    if cached is not None:
+        user_id, user_theme = cached
     else:
-        # Create new user with default theme
-        cursor.execute("""
-            INSERT INTO chat_users (username, last_seen, theme) 
-            VALUES (%s, %s, %s) 
-            RETURNING id
-        """, (username, datetime.datetime.now(), theme))
-        user_id = cursor.fetchone()[0]
-        user_theme = theme
-    
-    # Update last seen
-    cursor.execute("UPDATE chat_users SET last_seen = %s WHERE id = %s", 
-                  (datetime.datetime.now(), user_id))
-    conn.commit()
-    cursor.close()
-    conn.close()
+        try:
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                user_id, user_theme = fetch_or_create_user(cursor, username, theme)
+                conn.commit()
+                cursor.close()
+        except Exception as e:
+            logger.error(f"Database error: {e}")
+            return None, theme
+        user_cache.put(username, user_id, user_theme)
+    
+    # Update last seen with the next batch
+    last_seen.touch(user_id)
     
     return user_id, user_theme
 
-def save_message(username, message_text, message_type='text', is_private=False, recipient=None):
-    """Save message to database"""
-    try:
-        conn = get_db_connection()
-        if not conn:
-            return False
+def fetch_users(cursor, usernames):
+    """Map each username to (user ID, theme) on an open cursor, creating missing users"""
+    cursor.execute("SELECT username, id, theme FROM chat_users WHERE username = ANY(%s)", (list(usernames),))
+    users = {username: (user_id, theme) for username, user_id, theme in cursor.fetchall()}
+    for username in usernames:
+        if username not in users:
+            users[username] = fetch_or_create_user(cursor, username)
+    return users
+
+def update_last_seen(batch):
+    """Write a batch of (user_id, timestamp) last_seen updates with one UPDATE"""
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        execute_values(cursor, """
+            UPDATE chat_users AS u SET last_seen = v.last_seen
+            FROM (VALUES %s) AS v (id, last_seen)
+            WHERE u.id = v.id
+        """, batch, page_size=len(batch))
+        conn.commit()
+        cursor.close()
+
+def listen_for_user_changes():
+    """Invalidate cached users named in NOTIFYs sent by db_management"""
+    while server_running:
+        try:
+            conn = psycopg2.connect(**DB_CONFIG)
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute(f"LISTEN {USER_CHANGED_CHANNEL}")
+            
+            # Anything may have changed while we were not listening
+            user_cache.clear()
             
+            while server_running:
+                if select.select([conn], [], [], 5.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    logger.info(f"User {notify.payload} changed; dropping it from the cache")
+                    user_cache.invalidate(notify.payload)
+                    key_directory.reload(notify.payload, load_user_keys(notify.payload))
+        except Exception as e:
+            logger.error(f"User change listener error: {e}")
+            time.sleep(5.0)
+
+def insert_messages(batch):
+    """Write a batch of queued messages with a single multi-row INSERT.
+    
+    Each record is (username, message, timestamp, message_type, is_private,
+    recipient, message_id), as queued by save_message. Raises if the batch
+    cannot be written.
+    """
+    with db_pool.connection() as conn:
         cursor = conn.cursor()
         
-        # Get user ID
-        user_id, _ = get_or_create_user(username)
-        if not user_id:
-            return False
+        # Resolve every sender and recipient in the batch, querying only for uncached users
+        usernames = {record[0] for record in batch} | {record[5] for record in batch if record[5]}
+        user_ids, fetched = resolve_user_ids(cursor, usernames)
         
-        recipient_id = None
-        if is_private and recipient:
-            # Get recipient ID if this is a private message
-            recipient_id, _ = get_or_create_user(recipient)
+        rows = [
+            (message_id, user_ids[username], message_text, timestamp, message_type, is_private,
+             user_ids[recipient] if recipient else None)
+            for username, message_text, timestamp, message_type, is_private, recipient, message_id in batch
+        ]
+        try:
+            # Messages whose id could not be reserved take the next one from the sequence
+            execute_values(cursor, """
+                INSERT INTO chat_messages 
+                (id, sender_id, message, timestamp, message_type, is_private, recipient_id) 
+                VALUES %s
+            """, rows, page_size=len(rows),
+               template="(COALESCE(%s, nextval(pg_get_serial_sequence('chat_messages', 'id'))), %s, %s, %s, %s, %s, %s)")
+            conn.commit()
+        except psycopg2.IntegrityError:
+            # A cached user was deleted; look everyone up again when the batch is retried
+            for username in usernames:
+                user_cache.invalidate(username)
+            raise
+        cursor.close()
+    
+    for username, (user_id, theme) in fetched.items():
+        user_cache.put(username, user_id, theme)
+    
+    # Senders were seen when they sent
+    for record in batch:
+        last_seen.touch(user_ids[record[0]], record[2])
+
+def insert_room_messages(batch):
+    """Write a batch of queued room messages with a single multi-row INSERT.
+    
+    Each record is (room_id, username, message, timestamp, message_id), as
+    queued by save_room_message. Raises if the batch cannot be written.
+    """
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
         
-        # Fix empty attributes issue - convert None values to appropriate defaults
-        if message_type is None:
-            message_type = 'text'
+        usernames = {record[1] for record in batch}
+        user_ids, fetched = resolve_user_ids(cursor, usernames)
         
-        if is_private is None:
-            is_private = False
-            
-        # Save message with additional metadata
+        rows = [
+            (message_id, room_id, user_ids[username], message_text, timestamp)
+            for room_id, username, message_text, timestamp, message_id in batch
+        ]
+        try:
+            execute_values(cursor, """
+                INSERT INTO room_messages (id, room_id, sender_id, message, timestamp) 
+                VALUES %s
+            """, rows, page_size=len(rows),
+               template="(COALESCE(%s, nextval(pg_get_serial_sequence('room_messages', 'id'))), %s, %s, %s, %s)")
+            conn.commit()
+        except psycopg2.IntegrityError:
+            # A cached user was deleted; look everyone up again when the batch is retried
+            for username in usernames:
+                user_cache.invalidate(username)
+            raise
+        cursor.close()
+    
+    for username, (user_id, theme) in fetched.items():
+        user_cache.put(username, user_id, theme)
+    
+    for record in batch:
+        last_seen.touch(user_ids[record[1]], record[3])
+
+def resolve_user_ids(cursor, usernames):
+    """Map usernames to user ids, querying only for users that are not cached.
+    
+    Returns (user_ids, fetched), where fetched holds the (id, theme) of the
+    users that had to be queried, to be cached once the caller's write succeeded.
+    """
+    user_ids = {}
+    for username in usernames:
+        cached = user_cache.get(username)
+        if cached is not None:
+            user_ids[username] = cached[0]
+    missing = usernames - user_ids.keys()
+    fetched = fetch_users(cursor, missing) if missing else {}
+    for username, (user_id, _) in fetched.items():
+        user_ids[username] = user_id
+    return user_ids, fetched
+
+def reserve_message_ids(count, table='chat_messages'):
+    """Reserve count ids from the id sequence of a message table"""
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
         cursor.execute("""
-            INSERT INTO chat_messages 
-            (sender_id, message, timestamp, message_type, is_private, recipient_id) 
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """, (user_id, message_text, datetime.datetime.now(), message_type, is_private, recipient_id))
-        
+            SELECT nextval(pg_get_serial_sequence(%s, 'id'))
+            FROM generate_series(1, %s)
+        """, (table, count))
+        ids = sorted(row[0] for row in cursor.fetchall())
         conn.commit()
         cursor.close()
-        conn.close()
-        return True
+    return ids
+
+def next_message_id(room=False):
+    """Return the id for a new (room) message, or None if no reserved id is left.
+    
+    Never waits for the database; a message without an id gets one from the
+    sequence when the writer inserts it.
+    """
+    allocator, memory_ids = (room_message_ids, memory_room_message_ids) if room else (message_ids, memory_message_ids)
+    if allocator is None:
+        return next(memory_ids)
+    return allocator.next_id()
+
+def save_message(username, message_text, message_type='text', is_private=False, recipient=None):
+    """Queue a message to be saved to the database by the write-behind writer.
+    
+    Returns the message as it is sent to clients, including its id.
+    """
+    # Fix empty attributes issue - convert None values to appropriate defaults
+    if message_type is None:
+        message_type = 'text'
+    
+    if is_private is None:
+        is_private = False
+    
+    # Timestamp and number it now, not when the batch is written, so history keeps the arrival order
+    timestamp = datetime.datetime.now()
+    message_id = next_message_id()
+    if not is_private:
+        entry = history_cache.add(username, message_text, timestamp, message_type, is_private, message_id)
+    else:
+        entry = format_message(message_id, username, message_text, timestamp, message_type, is_private)
+    
+    # In-memory mode: the history cache is all we keep
+    if message_writer is not None:
+        message_writer.submit((
+            username,
+            message_text,
+            timestamp,
+            message_type,
+            is_private,
+            recipient if is_private else None,
+            message_id
+        ))
+    
+    return entry
+
+def save_room_message(room_id, username, message_text):
+    """Queue a room message to be saved to room_messages; returns it as sent to the room.
+    
+    Runs on the event loop in the asyncio engine, so it never waits for an
+    id: if none is reserved, the message goes out with id None and the
+    writer takes one from the room_messages sequence.
+    """
+    timestamp = datetime.datetime.now()
+    message_id = next_message_id(room=True)
+    
+    if room_writer is not None:
+        room_writer.submit((room_id, username, message_text, timestamp, message_id))
+    
+    return {
+        "id": message_id,
+        "room_id": room_id,
+        "username": username,
+        "message": message_text,
+        "timestamp": timestamp.strftime(TIMESTAMP_FORMAT)
+    }
+
+def load_room_members():
+    """Return (room_id, username) for every room membership"""
+    if db_pool is None:
+        return []
+    
+    try:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            SELECT rm.room_id, u.username
+            FROM room_members rm
+            JOIN chat_users u ON rm.user_id = u.id
+            ''')
+            rows = cursor.fetchall()
+            cursor.close()
+            conn.rollback()
     except Exception as e:
         logger.error(f"Database error: {e}")
-        return False
+        return []
+    
+    return rows
+
+def load_user_keys(username=None):
+    """Return (username, key fields) for every published key, or only username's"""
+    if db_pool is None:
+        return []
+    
+    condition = "WHERE u.username = %s" if username is not None else ""
+    try:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+            SELECT u.username, k.key_data
+            FROM user_keys k
+            JOIN chat_users u ON k.user_id = u.id
+            {condition}
+            ''', (username,) if username is not None else ())
+            rows = cursor.fetchall()
+            cursor.close()
+            conn.rollback()
+    except Exception as e:
+        logger.error(f"Database error: {e}")
+        return []
+    
+    return [(row[0], json.loads(row[1])) for row in rows]
 
 def get_recent_messages(limit=10):
-    """Get recent messages from database grouped by user"""
-    conn = get_db_connection()
-    if not conn:
-        return {}
-        
-    cursor = conn.cursor()
+    """Get the last limit messages of every user, oldest first, with one query.
     
-    # Get all unique users who have sent messages
-    cursor.execute('''
-    SELECT DISTINCT u.username
-    FROM chat_messages m
-    JOIN chat_users u ON m.sender_id = u.id
-    ORDER BY u.username
-    ''')
+    Returns (id, username, message, timestamp) rows ordered by username and
+    then timestamp; used to warm the history cache at startup.
+    """
+    if db_pool is None:
+        return []
     
-    users = [row[0] for row in cursor.fetchall()]
+    try:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            SELECT id, username, message, timestamp
+            FROM (
+                SELECT m.id, u.username, m.message, m.timestamp,
+                       ROW_NUMBER() OVER (PARTITION BY m.sender_id ORDER BY m.timestamp DESC) AS recent
+                FROM chat_messages m
+                JOIN chat_users u ON m.sender_id = u.id
+            ) ranked
+            WHERE recent <= %s
+            ORDER BY username, timestamp
+            ''', (limit,))
+            rows = cursor.fetchall()
+            cursor.close()
+            conn.rollback()
+    except Exception as e:
+        logger.error(f"Database error: {e}")
+        return []
     
-    # Get messages for each user
-    user_messages = {}
-    for username in users:
-        cursor.execute('''
-        SELECT u.username, m.message, m.timestamp 
+    return rows
+
+def get_latest_messages(limit):
+    """Get the newest limit public messages in id order, with their ids.
+    
+    Returns (id, username, message, timestamp, message_type) rows; used to
+    warm the history cache so reconnecting clients can be sent what they missed.
+    """
+    if db_pool is None:
+        return []
+    
+    try:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            SELECT m.id, u.username, m.message, m.timestamp, m.message_type
+            FROM chat_messages m
+            JOIN chat_users u ON m.sender_id = u.id
+            WHERE m.is_private = FALSE
+            ORDER BY m.timestamp DESC, m.id DESC
+            LIMIT %s
+            ''', (limit,))
+            rows = cursor.fetchall()
+            cursor.close()
+            conn.rollback()
+    except Exception as e:
+        logger.error(f"Database error: {e}")
+        return []
+    
+    # Read newest first by timestamp, which partitions are ordered by
+    rows.sort()
+    return rows
+
+def fetch_history_page(cursor, session, conversation, request, before, limit):
+    """Run the keyset query for one history page on an open cursor.
+    
+    Rows are (id, username, message, timestamp, message_type, is_private),
+    newest first, all strictly older than the before cursor (timestamp, id) if
+    one is given. Returns an error string instead if the request is not allowed.
+    """
+    keyset = ""
+    keyset_params = ()
+    if before is not None:
+        # The plain timestamp bound lets the planner skip newer partitions
+        keyset = "AND m.timestamp <= %s AND (m.timestamp, m.id) < (%s, %s)"
+        keyset_params = (before[0],) + tuple(before)
+    
+    if conversation == "public":
+        cursor.execute(f'''
+        SELECT m.id, u.username, m.message, m.timestamp, m.message_type, m.is_private
         FROM chat_messages m
         JOIN chat_users u ON m.sender_id = u.id
-        WHERE u.username = %s
-        ORDER BY m.timestamp DESC
+        WHERE m.is_private = FALSE {keyset}
+        ORDER BY m.timestamp DESC, m.id DESC
         LIMIT %s
-        ''', (username, limit))
-        
-        messages = cursor.fetchall()
-        
-        # Convert to list of dictionaries
-        message_list = []
-        for msg in messages:
-            message_list.append({
-                'username': msg[0],
-                'message': msg[1],
-                'timestamp': msg[2]
-            })
+        ''', keyset_params + (limit,))
+        return None
+    
+    if conversation == "private":
+        peer = request.get("peer")
+        cached = user_cache.get(peer)
+        if cached is not None:
+            peer_id = cached[0]
+        else:
+            cursor.execute("SELECT id FROM chat_users WHERE username = %s", (peer,))
+            row = cursor.fetchone()
+            if row is None:
+                return f"Unknown user {peer}"
+            peer_id = row[0]
         
-        # Store messages in chronological order
-        user_messages[username] = list(reversed(message_list))
+        # One index-ordered scan per direction, merged
+        direction = f'''
+            (SELECT * FROM chat_messages m
+             WHERE m.is_private AND m.sender_id = %s AND m.recipient_id = %s {keyset}
+             ORDER BY m.timestamp DESC, m.id DESC
+             LIMIT %s)
+        '''
+        cursor.execute(f'''
+        SELECT m.id, u.username, m.message, m.timestamp, m.message_type, m.is_private
+        FROM ({direction} UNION ALL {direction}) m
+        JOIN chat_users u ON m.sender_id = u.id
+        ORDER BY m.timestamp DESC, m.id DESC
+        LIMIT %s
+        ''', (session.user_id, peer_id) + keyset_params + (limit,)
+             + (peer_id, session.user_id) + keyset_params + (limit, limit))
+        return None
     
-    cursor.close()
-    conn.close()
+    if conversation == "room":
+        room_id = request.get("room_id")
+        cursor.execute("SELECT 1 FROM room_members WHERE room_id = %s AND user_id = %s",
+                       (room_id, session.user_id))
+        if cursor.fetchone() is None:
+            return f"Not a member of room {room_id}"
+        
+        cursor.execute(f'''
+        SELECT m.id, u.username, m.message, m.timestamp, 'text', FALSE
+        FROM room_messages m
+        JOIN chat_users u ON m.sender_id = u.id
+        WHERE m.room_id = %s {keyset}
+        ORDER BY m.timestamp DESC, m.id DESC
+        LIMIT %s
+        ''', (room_id,) + keyset_params + (limit,))
+        return None
     
-    return user_messages
+    return f"Unknown conversation {conversation}"
+
+def send_to_client(client, message):
+    """Queue one message for a client, framing it if the client negotiated framing"""
+    session = registry.get(client)
+    if session is None:
+        raise ConnectionResetError("Client is not connected")
+    if session.framed:
+        message = encode_frame(message)
+    session.outbound.put(message)
+
+def send_to_user(username, message):
+    """Send a message to every session of one user; returns the number of sessions reached"""
+    sessions = registry.sessions_for(username)
+    failed = fan_out(sessions, message)
+    for client in failed:
+        # If sending fails, remove the client
+        remove_client(client)
+    return len(sessions) - len(failed)
 
 def broadcast_message(message, _client):
     """Send message to all connected clients except the sender"""
-    for client in active_clients:
-        if client != _client:
-            try:
-                client.send(message)
-            except:
-                # If sending fails, remove the client
-                remove_client(client)
+    for client in fan_out(registry.sessions(), message, exclude=_client):
+        # If sending fails, remove the client
+        remove_client(client)
+
+def broadcast_chat(sender, entry, text):
+    """Send a public chat message to everyone except its sender.
+    
+    Framed clients get it as a "chat" message carrying its id, and the sender
+    gets a "chat_ack" with the id; legacy clients get the original text.
+    """
+    sessions = registry.sessions()
+    chat_message = json.dumps(dict(entry, type="chat")).encode('utf-8')
+    failed = fan_out([s for s in sessions if s.framed], chat_message, exclude=sender)
+    failed += fan_out([s for s in sessions if not s.framed], text, exclude=sender)
+    
+    session = registry.get(sender)
+    if session is not None and session.framed:
+        ack = json.dumps({"type": "chat_ack", "id": entry["id"]}).encode('utf-8')
+        try:
+            send_to_client(sender, ack)
+        except ConnectionError:
+            failed.append(sender)
+    
+    for client in failed:
+        # If sending fails, remove the client
+        remove_client(client)
 
 def remove_client(client):
-    """Remove a client from the active clients list"""
-    if client in active_clients:
-        username = client_usernames.get(client, "Unknown")
-        active_clients.remove(client)
-        if client in client_usernames:
-            del client_usernames[client]
-        broadcast_message(f"{username} has left the chat!".encode('utf-8'), None)
-        logger.info(f"Client {username} disconnected")
-        
-        # Send updated user list to all remaining clients
-        broadcast_user_list()
-
-def broadcast_user_list():
-    """Send updated user list to all clients"""
-    user_list = list(client_usernames.values())
-    user_list_data = {
-        "type": "user_list",
-        "users": user_list
+    """Remove a client from the registry and tell the remaining clients.
+    
+    Clients whose sends fail while announcing the departure are removed in
+    the same loop rather than by recursing back into remove_client.
+    """
+    pending = [client]
+    while pending:
+        session = registry.remove(pending.pop())
+        if session is None:
+            continue
+        session.outbound.close()
+        rooms.session_left(session)
+        logger.info(f"Client {session.username} disconnected")
+        
+        pending.extend(fan_out(registry.sessions(), f"{session.username} has left the chat!".encode('utf-8')))
+        
+        # The remaining clients hear about it in the next presence delta
+        presence.mark_changed(session.username)
+        if not registry.sessions_for(session.username):
+            typing.user_left(session.username)
+
+def user_list_message():
+    """Return the encoded user_list snapshot, rebuilding it only when someone joined or left"""
+    global user_list_cache
+    version = (registry.version, presence.version)
+    cached_version, message = user_list_cache
+    if cached_version != version:
+        user_list_data = {
+            "type": "user_list",
+            "users": registry.usernames(),
+            "version": presence.version
+        }
+        message = json.dumps(user_list_data).encode('utf-8')
+        user_list_cache = (version, message)
+    return message
+
+def publish_presence(delta):
+    """Send a presence delta to framed clients and the full user list to legacy ones"""
+    sessions = registry.sessions()
+    failed = fan_out([s for s in sessions if s.framed], delta)
+    failed += fan_out([s for s in sessions if not s.framed], user_list_message())
+    for client in failed:
+        # If sending fails, remove the client
+        remove_client(client)
+
+presence = PresenceTracker(registry, publish_presence, presence_window)
+
+def publish_typing(message, started, stopped):
+    """Send the typing_state to framed clients and per-user typing updates to legacy ones"""
+    sessions = registry.sessions()
+    failed = fan_out([s for s in sessions if s.framed], message)
+    
+    legacy = [s for s in sessions if not s.framed]
+    if legacy:
+        for username, is_typing in [(u, True) for u in started] + [(u, False) for u in stopped]:
+            typing_data = {
+                "type": "typing",
+                "username": username,
+                "isTyping": is_typing
+            }
+            failed += fan_out(legacy, json.dumps(typing_data).encode('utf-8'))
+    
+    for client in failed:
+        # If sending fails, remove the client
+        remove_client(client)
+
+typing = TypingTracker(publish_typing, typing_tick, typing_timeout)
+
+def register_client(session):
+    """Add a session to the registry and send it the join information"""
+    registry.add(session)
+    rooms.session_joined(session)
+    client = session.client
+    username = session.username
+    address = session.address
+    
+    # Notify all clients about the new connection
+    join_message = f"{username} has joined the chat!"
+    broadcast_message(join_message.encode('utf-8'), client)
+    logger.info(f"New client {username} connected from {address[0]}:{address[1]}")
+    
+    # Send welcome message to the new client
+    welcome_message = f"Welcome to the chat, {username}!"
+    send_to_client(client, welcome_message.encode('utf-8'))
+    
+    # Send user settings including theme
+    settings_data = {
+        "type": "settings",
+        "theme": session.theme,
+        "username": username,
+        "rooms": rooms.rooms_for(username)
     }
+    send_to_client(client, json.dumps(settings_data).encode('utf-8'))
     
-    message = json.dumps(user_list_data).encode('utf-8')
-    for client in active_clients:
+    # Send the full user list to the new client; everyone else gets a delta
+    send_to_client(client, user_list_message())
+    presence.mark_changed(username)
+
+def build_history_message():
+    """Return the chat history message sent to a newly joined client"""
+    return history_cache.message()
+
+def history_messages(since_id=None):
+    """Return the messages that bring a joining client's history up to date.
+    
+    A client that reconnects with the id of the last message it saw gets just
+    the newer messages, as history_delta messages of up to HISTORY_CHUNK_SIZE
+    each (the last one marked final). Everyone else, or a client whose gap is
+    no longer held in memory, gets the full history message.
+    """
+    if since_id is not None:
+        missed = history_cache.since(since_id)
+        if missed is not None:
+            chunks = [missed[i:i + HISTORY_CHUNK_SIZE] for i in range(0, len(missed), HISTORY_CHUNK_SIZE)] or [[]]
+            return [
+                json.dumps({
+                    "type": "history_delta",
+                    "epoch": server_epoch,
+                    "messages": chunk,
+                    "final": index == len(chunks) - 1
+                }).encode('utf-8')
+                for index, chunk in enumerate(chunks)
+            ]
+    return [build_history_message()]
+
+def parse_since_id(options):
+    """Return the SINCE_ID handshake option as an int, or None if it is missing or from another epoch"""
+    if options.get(EPOCH_OPTION) != server_epoch:
+        return None
+    try:
+        return int(options[SINCE_ID_OPTION])
+    except (KeyError, ValueError):
+        return None
+
+def history_pages(session, request):
+    """Answer a history_request, yielding the page as one or more history_page messages.
+    
+    A request looks like {"type": "history_request", "conversation": "public"
+    | "private" | "room", "peer": ..., "room_id": ..., "limit": 50, "before":
+    {"timestamp": ..., "id": ...}}; "before" is the next_cursor of the
+    previous page, or absent for the newest page. Each history_page carries up
+    to HISTORY_CHUNK_SIZE messages, newest first; the last one has "final":
+    true and the cursor for the next page (null once the start is reached).
+    """
+    conversation = request.get("conversation", "public")
+    
+    def page(messages, final=True, next_cursor=None, error=None):
+        page_data = {
+            "type": "history_page",
+            "request_id": request.get("request_id"),
+            "conversation": conversation,
+            "messages": messages,
+            "final": final,
+            "next_cursor": next_cursor
+        }
+        if error:
+            page_data["error"] = error
+        return json.dumps(page_data).encode('utf-8')
+    
+    try:
+        limit = min(max(int(request.get("limit", HISTORY_PAGE_DEFAULT)), 1), HISTORY_PAGE_MAX)
+        before = request.get("before")
+        if before is not None:
+            before = (datetime.datetime.fromisoformat(before["timestamp"]), int(before["id"]))
+    except (TypeError, ValueError, KeyError):
+        yield page([], error="Invalid history request")
+        return
+    
+    if db_pool is None:
+        # Without a database nothing older is kept; tell the client it reached the start
+        yield page([])
+        return
+    if session.user_id is None:
+        yield page([], error="History is not available")
+        return
+    
+    try:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            error = fetch_history_page(cursor, session, conversation, request, before, limit)
+            if error:
+                yield page([], error=error)
+                return
+            
+            # Hold one chunk back so the last frame can be marked final
+            count = 0
+            last_row = None
+            chunk = cursor.fetchmany(HISTORY_CHUNK_SIZE)
+            while True:
+                following = cursor.fetchmany(HISTORY_CHUNK_SIZE) if chunk else []
+                messages = [
+                    {
+                        "id": row[0],
+                        "username": row[1],
+                        "message": row[2],
+                        "timestamp": row[3].strftime(TIMESTAMP_FORMAT),
+                        "message_type": row[4],
+                        "is_private": row[5]
+                    } for row in chunk
+                ]
+                count += len(chunk)
+                if chunk:
+                    last_row = chunk[-1]
+                
+                if following:
+                    yield page(messages, final=False)
+                    chunk = following
+                    continue
+                
+                # A full page means there may be more; a short one reached the start
+                next_cursor = None
+                if count == limit and last_row is not None:
+                    next_cursor = {"timestamp": last_row[3].isoformat(), "id": last_row[0]}
+                yield page(messages, next_cursor=next_cursor)
+                break
+            
+            cursor.close()
+            conn.rollback()
+    except Exception as e:
+        logger.error(f"Database error: {e}")
+        yield page([], error="History is not available")
+
+def search_results(session, request):
+    """Answer a search request with one search_results message.
+    
+    A request looks like {"type": "search", "query": "...", "room_id": ...,
+    "limit": 20, "offset": 0}; without room_id the public messages are
+    searched. Hits are ranked best first; next_offset is where the next page
+    starts, or null if this was the last one.
+    """
+    def results(hits, next_offset=None, error=None):
+        results_data = {
+            "type": "search_results",
+            "request_id": request.get("request_id"),
+            "query": request.get("query"),
+            "results": hits,
+            "next_offset": next_offset
+        }
+        if error:
+            results_data["error"] = error
+        return json.dumps(results_data).encode('utf-8')
+    
+    try:
+        query = str(request["query"]).strip()
+        room_id = request.get("room_id")
+        if room_id is not None:
+            room_id = int(room_id)
+        limit = min(max(int(request.get("limit", SEARCH_PAGE_DEFAULT)), 1), SEARCH_PAGE_MAX)
+        offset = max(int(request.get("offset", 0)), 0)
+    except (TypeError, ValueError, KeyError):
+        return results([], error="Invalid search request")
+    if not query:
+        return results([], error="Invalid search request")
+    
+    if db_pool is None or session.user_id is None:
+        return results([], error="Search is not available")
+    
+    try:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            if room_id is not None:
+                cursor.execute("SELECT 1 FROM room_members WHERE room_id = %s AND user_id = %s",
+                               (room_id, session.user_id))
+                if cursor.fetchone() is None:
+                    return results([], error=f"Not a member of room {room_id}")
+            rows = search_messages(cursor, query, room_id, limit=limit, offset=offset)
+            cursor.close()
+            conn.rollback()
+    except Exception as e:
+        logger.error(f"Database error: {e}")
+        return results([], error="Search is not available")
+    
+    hits = [
+        {
+            "id": row[0],
+            "username": row[1],
+            "message": row[2],
+            "timestamp": row[3].strftime(TIMESTAMP_FORMAT),
+            "rank": round(row[4], 4)
+        } for row in rows
+    ]
+    return results(hits, next_offset=offset + limit if len(rows) == limit else None)
+
+def room_membership(session, request):
+    """Answer a join_room or leave_room request.
+    
+    Membership belongs to the user, so all of its sessions join or leave the
+    room together. Returns a room_joined, room_left or room_error message.
+    """
+    message_type = request.get("type")
+    try:
+        room_id = int(request["room_id"])
+    except (TypeError, ValueError, KeyError):
+        return room_error(request.get("room_id"), "Invalid room")
+    username = session.username
+    
+    if db_pool is not None:
+        if session.user_id is None:
+            return room_error(room_id, "Rooms are not available")
         try:
-            client.send(message)
-        except:
-            # If sending fails, remove the client
-            remove_client(client)
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                if message_type == "join_room":
+                    cursor.execute("SELECT is_private FROM chat_rooms WHERE id = %s", (room_id,))
+                    row = cursor.fetchone()
+                    if row is None:
+                        return room_error(room_id, f"Unknown room {room_id}")
+                    if row[0] and not rooms.is_member(room_id, username):
+                        return room_error(room_id, f"Room {room_id} is private")
+                    cursor.execute('''
+                    INSERT INTO room_members (room_id, user_id) VALUES (%s, %s)
+                    ON CONFLICT DO NOTHING
+                    ''', (room_id, session.user_id))
+                else:
+                    cursor.execute("DELETE FROM room_members WHERE room_id = %s AND user_id = %s",
+                                   (room_id, session.user_id))
+                conn.commit()
+                cursor.close()
+        except Exception as e:
+            logger.error(f"Database error: {e}")
+            return room_error(room_id, "Rooms are not available")
+    
+    if message_type == "join_room":
+        rooms.join(room_id, username, registry.sessions_for(username))
+        members = sorted({s.username for s in rooms.sessions(room_id)})
+        return json.dumps({"type": "room_joined", "room_id": room_id, "online": members}).encode('utf-8')
+    
+    rooms.leave(room_id, username)
+    return json.dumps({"type": "room_left", "room_id": room_id}).encode('utf-8')
+
+def room_error(room_id, error):
+    """Return a room_error message"""
+    return json.dumps({"type": "room_error", "room_id": room_id, "error": error}).encode('utf-8')
+
+def publish_keys(session, request):
+    """Store the public keys a client publishes at login.
+    
+    Clients publish on every login, so keys the directory already holds are
+    acknowledged without touching the database. Returns a keys_published or
+    keys_error message.
+    """
+    try:
+        keys = clean_keys(request.get("keys"))
+    except ValueError as e:
+        return json.dumps({"type": "keys_error", "error": f"Invalid keys: {e}"}).encode('utf-8')
+    username = session.username
+    
+    if not key_directory.unchanged(username, keys) and db_pool is not None and session.user_id is not None:
+        try:
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                execute_values(cursor, '''
+                INSERT INTO user_keys (user_id, key_type, key_data, fingerprint)
+                VALUES %s
+                ON CONFLICT (user_id, key_type) DO UPDATE
+                SET key_data = EXCLUDED.key_data, fingerprint = EXCLUDED.fingerprint,
+                    updated_at = CURRENT_TIMESTAMP
+                ''', [(session.user_id, key_type, json.dumps(fields), key_fingerprint(fields))
+                      for key_type, fields in keys.items()])
+                conn.commit()
+                cursor.close()
+        except Exception as e:
+            logger.error(f"Database error: {e}")
+            return json.dumps({"type": "keys_error", "error": "Keys could not be saved"}).encode('utf-8')
+    key_directory.publish(username, keys)
+    
+    fingerprints = {key_type: key_fingerprint(fields) for key_type, fields in keys.items()}
+    return json.dumps({"type": "keys_published", "fingerprints": fingerprints}).encode('utf-8')
+
+def get_keys(request):
+    """Answer a get_keys request with the published keys of every user asked about"""
+    usernames = request.get("usernames")
+    if not isinstance(usernames, list):
+        usernames = []
+    found, missing = key_directory.get([str(username) for username in usernames[:KEYS_BATCH_MAX]])
+    return json.dumps({"type": "keys", "keys": found, "missing": missing}).encode('utf-8')
+
+def send_room_message(client, session, request):
+    """Send a room_message to the room's online members and save it.
+    
+    Only the members' sessions are looked at, so the cost grows with the
+    size of the room, not with the number of users online.
+    """
+    try:
+        room_id = int(request["room_id"])
+        text = str(request["message"])
+    except (TypeError, ValueError, KeyError):
+        send_to_client(client, room_error(request.get("room_id"), "Invalid room message"))
+        return
+    if not rooms.is_member(room_id, session.username):
+        send_to_client(client, room_error(room_id, f"Not a member of room {room_id}"))
+        return
+    
+    entry = save_room_message(room_id, session.username, text)
+    sessions = rooms.sessions(room_id)
+    failed = fan_out(sessions, json.dumps(dict(entry, type="room_message")).encode('utf-8'), exclude=client)
+    rooms.count_message(sum(1 for s in sessions if s.client is not client))
+    
+    ack = json.dumps({"type": "chat_ack", "room_id": room_id, "id": entry["id"]}).encode('utf-8')
+    try:
+        send_to_client(client, ack)
+    except ConnectionError:
+        failed.append(client)
+    
+    for failed_client in failed:
+        # If sending fails, remove the client
+        remove_client(failed_client)
+
+def process_message(client, message_bytes):
+    """Route a single message received from a client"""
+    session = registry.get(client)
+    if session is not None:
+        session.messages_received += 1
+        session.bytes_received += len(message_bytes)
+    
+    message_text = message_bytes.decode('utf-8')
+    
+    # Try to parse as JSON for special messages
+    try:
+        data = json.loads(message_text)
+        message_type = data.get("type", "") if isinstance(data, dict) else ""
+        
+        # Handle public key request
+        if message_type == "public_key_request":
+            requester = data.get("requester")
+            target = data.get("target")
+            
+            # Forward the request to the target
+            send_to_user(target, message_bytes)
+            return
+        
+        # Handle public key response
+        elif message_type == "public_key_response":
+            sender = data.get("sender")
+            recipient = data.get("recipient")
+            
+            # Forward the response to the recipient
+            send_to_user(recipient, message_bytes)
+            return
+        
+        # Handle private message
+        elif message_type == "private_message":
+            sender = data.get("sender")
+            recipient = data.get("recipient")
+            
+            # Forward the encrypted message to all of the recipient's sessions only
+            send_to_user(recipient, message_bytes)
+            return
+        
+        # Handle a client whose presence version fell out of step
+        elif message_type == "presence_sync":
+            send_to_client(client, user_list_message())
+            return
+        
+        # Handle a request for older messages
+        elif message_type == "history_request":
+            if session is None:
+                return
+            if isinstance(client, ChatProtocol):
+                client.loop.create_task(client.send_history(session, data))
+            else:
+                for page in history_pages(session, data):
+                    send_to_client(client, page)
+            return
+        
+        # Handle full-text search
+        elif message_type == "search":
+            if session is None:
+                return
+            if isinstance(client, ChatProtocol):
+                client.loop.create_task(client.send_search(session, data))
+            else:
+                send_to_client(client, search_results(session, data))
+            return
+        
+        # Handle joining and leaving rooms
+        elif message_type in ("join_room", "leave_room"):
+            if session is None:
+                return
+            if isinstance(client, ChatProtocol):
+                client.loop.create_task(client.send_room_membership(session, data))
+            else:
+                send_to_client(client, room_membership(session, data))
+            return
+        
+        # Handle keys published by a client at login
+        elif message_type == "publish_keys":
+            if session is None:
+                return
+            if isinstance(client, ChatProtocol):
+                client.loop.create_task(client.send_published_keys(session, data))
+            else:
+                send_to_client(client, publish_keys(session, data))
+            return
+        
+        # Handle a batch lookup of other users' public keys
+        elif message_type == "get_keys":
+            if session is not None:
+                send_to_client(client, get_keys(data))
+            return
+        
+        # Handle a message to one room's members
+        elif message_type == "room_message":
+            if session is not None:
+                send_room_message(client, session, data)
+            return
+        
+        # Handle typing indicator
+        elif message_type == "typing":
+            # Already handled by the existing code
+            pass
+        
+        # Anything else is a request this server does not know, not chat text
+        else:
+            logger.warning(f"Ignoring unknown message type {message_type!r}")
+            return
+            
+    except json.JSONDecodeError:
+        # Not JSON, continue with normal message handling
+        pass
+    
+    # Handle typing indicator; the change goes out with the next typing_state
+    if message_text.startswith("TYPING:"):
+        username = session.username if session is not None else message_text[7:]
+        typing.set_typing(username, True)
+        return
+        
+    # Handle stopped typing indicator
+    if message_text.startswith("STOPPED_TYPING:"):
+        username = session.username if session is not None else message_text[15:]
+        typing.set_typing(username, False)
+        return
+    
+    # Extract username from message format "Username: Message"
+    if ": " in message_text:
+        username, content = message_text.split(": ", 1)
+        # Save message to database with null checks for empty attributes
+        message_type = "text"  # Default value
+        is_private = False     # Default value
+        entry = save_message(username, content, message_type, is_private)
+        
+        # Broadcast public message to all clients
+        broadcast_chat(client, entry, message_bytes)
+
+def session_stats():
+    """Return the receive and outbound queue counters of every connected session"""
+    return {
+        f"{session.username}@{session.address[0]}:{session.address[1]}": dict(
+            session.outbound.stats(),
+            messages_received=session.messages_received,
+            bytes_received=session.bytes_received
+        )
+        for session in registry.sessions()
+    }
+
+def report_session_stats():
+    """Periodically log the outbound queue depth of every connection"""
+    while server_running:
+        time.sleep(stats_interval)
+        for name, stats in session_stats().items():
+            logger.info(f"Session {name}: {stats}")
+        if db_pool is not None:
+            logger.info(f"Database pool: {db_pool.stats()}")
+        if message_writer is not None:
+            logger.info(f"Message writer: {message_writer.stats()}")
+            logger.info(f"User cache: {user_cache.stats()}, last_seen: {last_seen.stats()}")
+            logger.info(f"Message ids: {message_ids.stats()}")
+        logger.info(f"History cache: {history_cache.stats()}")
+        logger.info(f"Rooms: {rooms.stats()}")
+        logger.info(f"Key directory: {key_directory.stats()}")
+        if room_writer is not None:
+            logger.info(f"Room message writer: {room_writer.stats()}")
+            logger.info(f"Room message ids: {room_message_ids.stats()}")
+        logger.info(f"Typing: {typing.updates} updates, {typing.published} typing_state messages, "
+                    f"{typing.expired} expired")
 
 def handle_client(client, address):
     """Handle communication with a single client"""
     try:
         # Wait for the first message which should contain the username
-        message = client.recv(1024).decode('utf-8')
+        username, framed, remainder, options = recv_handshake(client)
         
         # Extract username from first message
-        if message.startswith("USERNAME:"):
-            username = message[9:]
-            client_usernames[client] = username
-            active_clients.append(client)
+        if username is not None:
+            outbound = OutboundQueue(client, username, queue_max_messages, queue_max_bytes, slow_client_policy)
             
             # Save user to database and get theme
             user_id, user_theme = get_or_create_user(username)
+            register_client(Session(client, username, address, user_id, user_theme, framed, outbound))
             
-            # Notify all clients about the new connection
-            join_message = f"{username} has joined the chat!"
-            broadcast_message(join_message.encode('utf-8'), client)
-            logger.info(f"New client {username} connected from {address[0]}:{address[1]}")
-            
-            # Send welcome message to the new client
-            welcome_message = f"Welcome to the chat, {username}!"
-            client.send(welcome_message.encode('utf-8'))
-            
-            # Send user settings including theme
-            settings_data = {
-                "type": "settings",
-                "theme": user_theme,
-                "username": username
-            }
-            client.send(json.dumps(settings_data).encode('utf-8'))
-            
-            # Send list of active users to the new client
-            user_list = list(client_usernames.values())
-            user_list_data = {
-                "type": "user_list",
-                "users": user_list
-            }
-            client.send(json.dumps(user_list_data).encode('utf-8'))
-            
-            # Send updated user list to all clients
-            broadcast_user_list()
-            
-            # Send recent chat history to the new client as JSON, grouped by user
-            user_messages = get_recent_messages(10)  # Get last 10 messages per user
-            history_data = {
-                "type": "history",
-                "userMessages": {}
-            }
-            
-            # Format each user's messages
-            for user, messages in user_messages.items():
-                history_data["userMessages"][user] = [
-                    {
-                        "username": msg["username"],
-                        "message": msg["message"],
-                        "timestamp": msg["timestamp"].strftime("%Y-%m-%d %H:%M:%S"),
-                        "message_type": msg.get("message_type", "text"),
-                        "is_private": msg.get("is_private", False)
-                    } for msg in messages
-                ]
-            
-            history_json = json.dumps(history_data)
-            client.send(history_json.encode('utf-8'))
+            # Send recent chat history to the new client as JSON, grouped by user,
+            # or only what it missed if it is reconnecting
+            for message in history_messages(parse_since_id(options)):
+                send_to_client(client, message)
         
-        # Main message handling loop
-        while server_running:
-            message_bytes = client.recv(4096)  # Increased buffer size for encrypted messages
-            if not message_bytes:
-                break
-                
-            message_text = message_bytes.decode('utf-8')
-            
-            # Try to parse as JSON for special messages
-            try:
-                data = json.loads(message_text)
-                message_type = data.get("type", "")
-                
-                # Handle public key request
-                if message_type == "public_key_request":
-                    requester = data.get("requester")
-                    target = data.get("target")
-                    
-                    # Find the target client
-                    target_client = None
-                    for c, name in client_usernames.items():
-                        if name == target:
-                            target_client = c
-                            break
-                    
-                    if target_client:
-                        # Forward the request to the target
-                        target_client.send(message_bytes)
-                    continue
-                
-                # Handle public key response
-                elif message_type == "public_key_response":
-                    sender = data.get("sender")
-                    recipient = data.get("recipient")
-                    
-                    # Find the recipient client
-                    recipient_client = None
-                    for c, name in client_usernames.items():
-                        if name == recipient:
-                            recipient_client = c
-                            break
-                    
-                    if recipient_client:
-                        # Forward the response to the recipient
-                        recipient_client.send(message_bytes)
-                    continue
-                
-                # Handle private message
-                elif message_type == "private_message":
-                    sender = data.get("sender")
-                    recipient = data.get("recipient")
-                    
-                    # Find the recipient client
-                    recipient_client = None
-                    for c, name in client_usernames.items():
-                        if name == recipient:
-                            recipient_client = c
-                            break
-                    
-                    if recipient_client:
-                        # Forward the encrypted message to the recipient only
-                        recipient_client.send(message_bytes)
-                    continue
-                
-                # Handle typing indicator
-                elif message_type == "typing":
-                    # Already handled by the existing code
-                    pass
-                    
-            except json.JSONDecodeError:
-                # Not JSON, continue with normal message handling
-                pass
-            
-            # Handle typing indicator
-            if message_text.startswith("TYPING:"):
-                username = message_text[7:]
-                # Create typing indicator message
-                typing_data = {
-                    "type": "typing",
-                    "username": username,
-                    "isTyping": True
-                }
-                # Broadcast typing status to all other clients
-                broadcast_message(json.dumps(typing_data).encode('utf-8'), client)
-                continue
-                
-            # Handle stopped typing indicator
-            if message_text.startswith("STOPPED_TYPING:"):
-                username = message_text[15:]
-                # Create stopped typing indicator message
-                typing_data = {
-                    "type": "typing",
-                    "username": username,
-                    "isTyping": False
-                }
-                # Broadcast typing status to all other clients
-                broadcast_message(json.dumps(typing_data).encode('utf-8'), client)
-                continue
-            
-            # Extract username from message format "Username: Message"
-            if ": " in message_text:
-                username, content = message_text.split(": ", 1)
-                # Save message to database with null checks for empty attributes
-                message_type = "text"  # Default value
-                is_private = False     # Default value
-                save_message(username, content, message_type, is_private)
-                
-                # Broadcast public message to all clients
-                broadcast_message(message_bytes, client)
+        if framed:
+            # Framed clients: process every complete frame, however the stream was split
+            decoder = FrameDecoder()
+            decoder.feed(remainder)
+            while server_running:
+                for frame in decoder.frames():
+                    process_message(client, frame)
+                if not decoder.recv_into(client):
+                    break
+        else:
+            # Legacy clients: one recv is treated as one message
+            while server_running:
+                message_bytes = client.recv(4096)  # Increased buffer size for encrypted messages
+                if not message_bytes:
+                    break
+                process_message(client, message_bytes)
             
     except Exception as e:
         logger.error(f"Error handling client {address}: {e}")
@@ -497,6 +1444,152 @@ def handle_client(client, address):
         remove_client(client)
         client.close()
 
+class ChatProtocol(asyncio.Protocol):
+    """Connection handler for the asyncio server mode.
+    
+    Each connection is a protocol instance rather than a thread. The protocol
+    object itself is the client key in the registry, and
+    its TransportQueue only queues data on the transport, so broadcasts never
+    block the event loop.
+    """
+    
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.address = None
+        self.handshake_done = False
+        self.handshake = HandshakeReader()  # Collects the handshake until it is complete
+        self.handshake_timer = None  # Ends the wait for more of a possible legacy handshake
+        self.pending = []  # Data received while the join is still in progress
+        self.framed = False
+        self.decoder = None  # FrameDecoder once the client negotiated framing
+        self.outbound = None
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        self.outbound = TransportQueue(transport, queue_max_bytes, slow_client_policy)
+        logger.info(f"New connection from {self.address[0]}:{self.address[1]}")
+    
+    def data_received(self, data):
+        if self.pending is not None and self.handshake_done:
+            # Join is still running in the executor; keep ordering intact
+            self.pending.append(data)
+            return
+        
+        if not self.handshake_done:
+            # The first message should contain the username, however many reads it takes
+            if self.handshake_timer is not None:
+                self.handshake_timer.cancel()
+                self.handshake_timer = None
+            try:
+                handshake = self.handshake.feed(data)
+            except (FrameError, UnicodeDecodeError):
+                handshake = (None, False, b"", {})
+            if handshake is not None:
+                self.handshake_received(handshake)
+            elif self.handshake.legacy_possible:
+                self.handshake_timer = self.loop.call_later(HANDSHAKE_WAIT, self.handshake_timed_out)
+            return
+        
+        try:
+            if self.decoder:
+                self.decoder.feed(data)
+                for frame in self.decoder.frames():
+                    process_message(self, frame)
+            else:
+                process_message(self, data)
+        except Exception as e:
+            logger.error(f"Error handling client {self.address}: {e}")
+            self.transport.close()
+    
+    def handshake_received(self, handshake):
+        """Start the join for a complete (username, framed, remainder, options) handshake"""
+        self.handshake_done = True
+        username, framed, remainder, options = handshake
+        if username is not None:
+            if framed:
+                self.framed = True
+                self.decoder = FrameDecoder()
+                self.pending.append(remainder)
+            self.loop.create_task(self.join(username, parse_since_id(options)))
+        else:
+            self.pending = None
+    
+    def handshake_timed_out(self):
+        """Nothing more arrived, so what we have is a legacy handshake"""
+        self.handshake_timer = None
+        if self.transport.is_closing():
+            return
+        try:
+            handshake = self.handshake.finish()
+        except UnicodeDecodeError:
+            handshake = (None, False, b"", {})
+        self.handshake_received(handshake)
+    
+    async def join(self, username, since_id=None):
+        """Register the client, running the database calls off the event loop"""
+        try:
+            user_id, user_theme = await self.loop.run_in_executor(None, get_or_create_user, username)
+            if self.transport.is_closing():
+                return
+            register_client(Session(self, username, self.address, user_id, user_theme, self.framed, self.outbound))
+            
+            for message in history_messages(since_id):
+                if self.transport.is_closing():
+                    break
+                send_to_client(self, message)
+        except Exception as e:
+            logger.error(f"Error handling client {self.address}: {e}")
+            self.transport.close()
+            return
+        
+        # Process anything the client sent while we were joining
+        pending, self.pending = self.pending, None
+        for data in pending:
+            self.data_received(data)
+    
+    async def send_history(self, session, request):
+        """Answer a history_request, running the query off the event loop"""
+        try:
+            pages = await self.loop.run_in_executor(None, lambda: list(history_pages(session, request)))
+            for page in pages:
+                send_to_client(self, page)
+        except ConnectionError:
+            pass
+    
+    async def send_search(self, session, request):
+        """Answer a search request, running the query off the event loop"""
+        try:
+            results = await self.loop.run_in_executor(None, search_results, session, request)
+            send_to_client(self, results)
+        except ConnectionError:
+            pass
+    
+    async def send_room_membership(self, session, request):
+        """Answer a join_room or leave_room request, running the query off the event loop"""
+        try:
+            reply = await self.loop.run_in_executor(None, room_membership, session, request)
+            send_to_client(self, reply)
+        except ConnectionError:
+            pass
+    
+    async def send_published_keys(self, session, request):
+        """Store published keys, running the query off the event loop"""
+        try:
+            reply = await self.loop.run_in_executor(None, publish_keys, session, request)
+            send_to_client(self, reply)
+        except ConnectionError:
+            pass
+    
+    def connection_lost(self, exc):
+        if self.handshake_timer is not None:
+            self.handshake_timer.cancel()
+        remove_client(self)
+    
+    def close(self):
+        self.transport.close()
+
 def signal_handler(sig, frame):
     """Handle Ctrl+C signal to gracefully shut down the server"""
     global server_running
@@ -505,33 +1598,28 @@ def signal_handler(sig, frame):
     server_running = False
     
     # Close all client connections
-    for client in list(active_clients):
+    for session in registry.sessions():
         try:
-            client.close()
+            session.client.close()
         except:
             pass
     
+    # Write out every message still waiting in the write-behind queue
+    if message_writer is not None:
+        message_writer.close()
+    if room_writer is not None:
+        room_writer.close()
+    if last_seen is not None:
+        last_seen.close()
+    if db_pool is not None:
+        db_pool.close()
+    
     sys.exit(0)
 
-def main():
+def run_threaded_server():
+    """Accept connections and handle each one in its own thread"""
     global server_running
     
-    # Register signal handler for Ctrl+C
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-    
-    logger.info("Starting chat server...")
-    print("Starting chat server...")
-    
-    # Setup database
-    db_ready = setup_database()
-    if not db_ready:
-        logger.warning("Database setup failed. Continuing without message persistence.")
-        print("Warning: Database setup failed. Continuing without message persistence.")
-    else:
-        logger.info(f"Successfully connected to database: {DB_CONFIG['dbname']}")
-        print(f"Successfully connected to database: {DB_CONFIG['dbname']}")
-    
     # Create IPv4 socket
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     
@@ -581,5 +1669,187 @@ def main():
         logger.info("Server has been shut down")
         print("Server has been shut down")
 
+async def serve_asyncio():
+    """Serve all connections from a single event loop"""
+    loop = asyncio.get_running_loop()
+    
+    # Presence deltas are flushed from the event loop instead of timer threads
+    presence.schedule = loop.call_later
+    typing.schedule = loop.call_later
+    
+    server = await loop.create_server(
+        ChatProtocol, host, port,
+        family=socket.AF_INET,
+        reuse_address=True,
+        backlog=listener_limit
+    )
+    logger.info(f"Successfully bound to host {host} and port {port}")
+    print(f"Successfully bound to host {host} and port {port}")
+    logger.info(f"Server is listening for connections (asyncio mode)...")
+    print(f"Server is listening for connections (asyncio mode)...")
+    print("Press Ctrl+C to stop the server")
+    
+    async with server:
+        await server.serve_forever()
+
+def run_asyncio_server():
+    """Run the asyncio server until it is interrupted"""
+    global server_running
+    
+    try:
+        asyncio.run(serve_asyncio())
+    except OSError as e:
+        logger.error(f"Socket error: {e}")
+        print(f"Socket error: {e}")
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        print(f"Error: {e}")
+    finally:
+        server_running = False
+        logger.info("Server has been shut down")
+        print("Server has been shut down")
+
+def apply_queue_settings(args):
+    """Apply the outbound queue, presence and typing command line options"""
+    global queue_max_messages, queue_max_bytes, slow_client_policy, stats_interval
+    queue_max_messages = args.queue_max_messages
+    queue_max_bytes = args.queue_max_bytes
+    slow_client_policy = args.slow_client_policy
+    stats_interval = args.stats_interval
+    presence.window = args.presence_window
+    typing.set_timeout(args.typing_timeout)
+
+def main():
+    global db_pool, db_pool_min, db_pool_max, db_pool_timeout, message_writer, last_seen, message_ids
+    global partition_messages, partition_months_ahead, room_writer, room_message_ids, server_epoch
+    
+    parser = argparse.ArgumentParser(description="Chat Server")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded",
+                        help="Connection handling engine: one thread per client, or a single asyncio event loop")
+    parser.add_argument("--queue-max-messages", type=int, default=queue_max_messages,
+                        help="Messages that may be queued for one client before the slow-client policy applies")
+    parser.add_argument("--queue-max-bytes", type=int, default=queue_max_bytes,
+                        help="Bytes that may be queued for one client before the slow-client policy applies")
+    parser.add_argument("--slow-client-policy", choices=POLICIES, default=slow_client_policy,
+                        help="Disconnect clients that fall behind, or drop the messages they cannot take")
+    parser.add_argument("--stats-interval", type=float, default=stats_interval,
+                        help="Log per-connection queue depth every N seconds (0 disables)")
+    parser.add_argument("--presence-window", type=float, default=presence_window,
+                        help="Seconds to batch joins and leaves into one presence update")
+    parser.add_argument("--typing-timeout", type=float, default=typing_timeout,
+                        help="Seconds without a TYPING: refresh before a typing indicator expires")
+    parser.add_argument("--db-pool-min", type=int, default=db_pool_min,
+                        help="Database connections to open at startup")
+    parser.add_argument("--db-pool-max", type=int, default=db_pool_max,
+                        help="Most database connections to open at once")
+    parser.add_argument("--db-pool-timeout", type=float, default=db_pool_timeout,
+                        help="Seconds to wait for a free database connection")
+    parser.add_argument("--write-batch-size", type=int, default=write_batch_size,
+                        help="Most messages written to the database in one INSERT")
+    parser.add_argument("--write-flush-interval", type=float, default=write_flush_interval,
+                        help="Seconds a message may wait for its write batch to fill")
+    parser.add_argument("--write-queue-size", type=int, default=write_queue_size,
+                        help="Messages that may wait to be written before new ones are spilled")
+    parser.add_argument("--spill-file", default=spill_file,
+                        help="File to keep messages in while the database is unavailable (dropped if unset); "
+                             "messages that cannot be written at all go to the same name with .rejected")
+    parser.add_argument("--id-block-size", type=int, default=id_block_size,
+                        help="Message ids reserved from the database at a time")
+    parser.add_argument("--id-low-water", type=int, default=id_low_water,
+                        help="Ids left when the next block is reserved; raise it for bursty traffic")
+    parser.add_argument("--user-cache-size", type=int, default=user_cache_size,
+                        help="Users whose identity is cached in memory")
+    parser.add_argument("--partition-messages", action="store_true",
+                        help="Create the message tables partitioned by month (new databases only)")
+    parser.add_argument("--partition-months-ahead", type=int, default=partition_months_ahead,
+                        help="Months of message partitions to keep created ahead of the current one")
+    args = parser.parse_args()
+    apply_queue_settings(args)
+    
+    # Register signal handler for Ctrl+C
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    
+    logger.info(f"Starting chat server ({args.mode} mode)...")
+    print(f"Starting chat server ({args.mode} mode)...")
+    
+    # Setup database
+    db_pool_min = args.db_pool_min
+    db_pool_max = args.db_pool_max
+    db_pool_timeout = args.db_pool_timeout
+    user_cache.max_size = args.user_cache_size
+    partition_messages = args.partition_messages
+    partition_months_ahead = args.partition_months_ahead
+    db_pool = create_db_pool()
+    db_ready = setup_database()
+    if not db_ready:
+        if db_pool is not None:
+            db_pool.close()
+            db_pool = None
+        logger.warning("Database setup failed. Continuing in memory without message persistence.")
+        print("Warning: Database setup failed. Continuing in memory without message persistence.")
+    else:
+        logger.info(f"Successfully connected to database: {DB_CONFIG['dbname']}")
+        print(f"Successfully connected to database: {DB_CONFIG['dbname']}")
+        server_epoch = f"db-{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['dbname']}"
+        history_cache.epoch = server_epoch
+        message_writer = MessageWriter(
+            insert_messages,
+            max_batch=args.write_batch_size,
+            flush_interval=args.write_flush_interval,
+            max_queue=args.write_queue_size,
+            spill_path=args.spill_file,
+            reject_path=args.spill_file + ".rejected" if args.spill_file else None,
+            retryable=DB_UNAVAILABLE
+        )
+        room_writer = MessageWriter(
+            insert_room_messages,
+            max_batch=args.write_batch_size,
+            flush_interval=args.write_flush_interval,
+            max_queue=args.write_queue_size,
+            spill_path=args.spill_file + ".rooms" if args.spill_file else None,
+            reject_path=args.spill_file + ".rooms.rejected" if args.spill_file else None,
+            retryable=DB_UNAVAILABLE
+        )
+        last_seen = LastSeenBatcher(update_last_seen, last_seen_interval)
+        
+        # Warm the history cache so joins never have to query for it
+        history_cache.load(get_recent_messages(HISTORY_PER_USER))
+        history_cache.load_recent(get_latest_messages(HISTORY_RECENT_SIZE))
+        message_ids = IdAllocator(reserve_message_ids, args.id_block_size, args.id_low_water)
+        message_ids.fill()
+        room_message_ids = IdAllocator(lambda count: reserve_message_ids(count, 'room_messages'),
+                                       args.id_block_size, args.id_low_water)
+        room_message_ids.fill()
+        
+        # Route room messages to members without asking the database who they are
+        rooms.load(load_room_members())
+        logger.info(f"Loaded room memberships: {rooms.stats()}")
+        
+        # Answer get_keys from memory
+        key_directory.load(load_user_keys())
+        logger.info(f"Loaded public keys: {key_directory.stats()}")
+        logger.info(f"Loaded recent history: {history_cache.stats()}")
+        
+        # Drop cached users that db_management deletes or changes
+        listener_thread = threading.Thread(target=listen_for_user_changes)
+        listener_thread.daemon = True
+        listener_thread.start()
+        
+        if messages_partitioned:
+            partition_thread = threading.Thread(target=maintain_partitions)
+            partition_thread.daemon = True
+            partition_thread.start()
+    
+    if stats_interval > 0:
+        stats_thread = threading.Thread(target=report_session_stats)
+        stats_thread.daemon = True
+        stats_thread.start()
+    
+    if args.mode == "asyncio":
+        run_asyncio_server()
+    else:
+        run_threaded_server()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,16 +1,34 @@
 import socket
 import threading
+import time
+import argparse
 import sys
 import datetime
 import logging
 import signal
 import json
+from framing import FrameDecoder, encode_frame, recv_handshake
+from sessions import Session, SessionRegistry
+from presence import PresenceTracker
+from typing_state import TypingTracker
+from outbound import OutboundQueue, fan_out, POLICIES, POLICY_DISCONNECT
 
 # Use IPv4 address instead of IPv6
 host = '127.0.0.1'  # IPv4 localhost
 port = 5054
 listener_limit = 100
 
+# Outbound queue settings (per connection)
+queue_max_messages = 1000  # High-water mark in queued messages
+queue_max_bytes = 4 * 1024 * 1024  # High-water mark in queued bytes
+slow_client_policy = POLICY_DISCONNECT  # What to do when a client falls behind: 'disconnect' or 'drop'
+stats_interval = 0  # Seconds between queue depth reports in the log (0 disables them)
+
+# Presence settings
+presence_window = 0.1  # Seconds to collect joins and leaves into one presence delta
+typing_tick = 0.1  # Seconds to collect typing changes into one typing_state message
+typing_timeout = 3.0  # Seconds after the last TYPING: before the server clears the flag
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -22,195 +40,285 @@ logging.basicConfig(
 )
 logger = logging.getLogger("ChatServer")
 
-active_clients = []  # List of connected clients
-client_usernames = {}  # Dictionary to store client socket: username pairs
+registry = SessionRegistry()  # Connected sessions indexed by client and by username
+user_list_cache = (None, None)  # ((registry version, presence version), encoded user_list message)
 
 # Global flag for server running state
 server_running = True
 
+def send_to_client(client, message):
+    """Queue one message for a client, framing it if the client negotiated framing"""
+    session = registry.get(client)
+    if session is None:
+        raise ConnectionResetError("Client is not connected")
+    if session.framed:
+        message = encode_frame(message)
+    session.outbound.put(message)
+
+def send_to_user(username, message):
+    """Send a message to every session of one user; returns the number of sessions reached"""
+    sessions = registry.sessions_for(username)
+    failed = fan_out(sessions, message)
+    for client in failed:
+        # If sending fails, remove the client
+        remove_client(client)
+    return len(sessions) - len(failed)
+
 def broadcast_message(message, _client):
     """Send message to all connected clients except the sender"""
-    for client in active_clients:
-        if client != _client:
-            try:
-                client.send(message)
-            except:
-                # If sending fails, remove the client
-                remove_client(client)
+    for client in fan_out(registry.sessions(), message, exclude=_client):
+        # If sending fails, remove the client
+        remove_client(client)
 
 def remove_client(client):
-    """Remove a client from the active clients list"""
-    if client in active_clients:
-        username = client_usernames.get(client, "Unknown")
-        active_clients.remove(client)
-        if client in client_usernames:
-            del client_usernames[client]
-        broadcast_message(f"{username} has left the chat!".encode('utf-8'), None)
-        logger.info(f"Client {username} disconnected")
+    """Remove a client from the registry and tell the remaining clients.
+    
+    Clients whose sends fail while announcing the departure are removed in
+    the same loop rather than by recursing back into remove_client.
+    """
+    pending = [client]
+    while pending:
+        session = registry.remove(pending.pop())
+        if session is None:
+            continue
+        session.outbound.close()
+        logger.info(f"Client {session.username} disconnected")
+        
+        pending.extend(fan_out(registry.sessions(), f"{session.username} has left the chat!".encode('utf-8')))
         
-        # Send updated user list to all remaining clients
-        broadcast_user_list()
+        # The remaining clients hear about it in the next presence delta
+        presence.mark_changed(session.username)
+        if not registry.sessions_for(session.username):
+            typing.user_left(session.username)
+
+def user_list_message():
+    """Return the encoded user_list snapshot, rebuilding it only when someone joined or left"""
+    global user_list_cache
+    version = (registry.version, presence.version)
+    cached_version, message = user_list_cache
+    if cached_version != version:
+        user_list_data = {
+            "type": "user_list",
+            "users": registry.usernames(),
+            "version": presence.version
+        }
+        message = json.dumps(user_list_data).encode('utf-8')
+        user_list_cache = (version, message)
+    return message
+
+def publish_presence(delta):
+    """Send a presence delta to framed clients and the full user list to legacy ones"""
+    sessions = registry.sessions()
+    failed = fan_out([s for s in sessions if s.framed], delta)
+    failed += fan_out([s for s in sessions if not s.framed], user_list_message())
+    for client in failed:
+        # If sending fails, remove the client
+        remove_client(client)
+
+presence = PresenceTracker(registry, publish_presence, presence_window)
+
+def publish_typing(message, started, stopped):
+    """Send the typing_state to framed clients and per-user typing updates to legacy ones"""
+    sessions = registry.sessions()
+    failed = fan_out([s for s in sessions if s.framed], message)
+    
+    legacy = [s for s in sessions if not s.framed]
+    if legacy:
+        for username, is_typing in [(u, True) for u in started] + [(u, False) for u in stopped]:
+            typing_data = {
+                "type": "typing",
+                "username": username,
+                "isTyping": is_typing
+            }
+            failed += fan_out(legacy, json.dumps(typing_data).encode('utf-8'))
+    
+    for client in failed:
+        # If sending fails, remove the client
+        remove_client(client)
 
-def broadcast_user_list():
-    """Send updated user list to all clients"""
-    user_list = list(client_usernames.values())
-    user_list_data = {
-        "type": "user_list",
-        "users": user_list
+typing = TypingTracker(publish_typing, typing_tick, typing_timeout)
+
+def register_client(session):
+    """Add a session to the registry and send it the join information"""
+    registry.add(session)
+    client = session.client
+    username = session.username
+    address = session.address
+    
+    # Notify all clients about the new connection
+    join_message = f"{username} has joined the chat!"
+    broadcast_message(join_message.encode('utf-8'), client)
+    logger.info(f"New client {username} connected from {address[0]}:{address[1]}")
+    
+    # Send welcome message to the new client
+    welcome_message = f"Welcome to the chat, {username}!"
+    send_to_client(client, welcome_message.encode('utf-8'))
+    
+    # Send user settings including theme
+    settings_data = {
+        "type": "settings",
+        "theme": session.theme,
+        "username": username
     }
+    send_to_client(client, json.dumps(settings_data).encode('utf-8'))
     
-    message = json.dumps(user_list_data).encode('utf-8')
-    for client in active_clients:
-        try:
-            client.send(message)
-        except:
-            # If sending fails, remove the client
-            remove_client(client)
+    # Send the full user list to the new client; everyone else gets a delta
+    send_to_client(client, user_list_message())
+    presence.mark_changed(username)
 
-def handle_client(client, address):
-    """Handle communication with a single client"""
+def process_message(client, message_bytes):
+    """Route a single message received from a client"""
+    session = registry.get(client)
+    if session is not None:
+        session.messages_received += 1
+        session.bytes_received += len(message_bytes)
+    
+    message_text = message_bytes.decode('utf-8')
+    
+    # Try to parse as JSON for special messages
     try:
-        # Wait for the first message which should contain the username
-        message = client.recv(1024).decode('utf-8')
+        data = json.loads(message_text)
+        message_type = data.get("type", "") if isinstance(data, dict) else ""
         
-        # Extract username from first message
-        if message.startswith("USERNAME:"):
-            username = message[9:]
-            client_usernames[client] = username
-            active_clients.append(client)
-            
-            # Notify all clients about the new connection
-            join_message = f"{username} has joined the chat!"
-            broadcast_message(join_message.encode('utf-8'), client)
-            logger.info(f"New client {username} connected from {address[0]}:{address[1]}")
+        # Handle public key request
+        if message_type == "public_key_request":
+            requester = data.get("requester")
+            target = data.get("target")
             
-            # Send welcome message to the new client
-            welcome_message = f"Welcome to the chat, {username}!"
-            client.send(welcome_message.encode('utf-8'))
+            # Forward the request to the target
+            send_to_user(target, message_bytes)
+            return
+        
+        # Handle public key response
+        elif message_type == "public_key_response":
+            sender = data.get("sender")
+            recipient = data.get("recipient")
             
-            # Send user settings including theme
-            settings_data = {
-                "type": "settings",
-                "theme": "default",
-                "username": username
-            }
-            client.send(json.dumps(settings_data).encode('utf-8'))
+            # Forward the response to the recipient
+            send_to_user(recipient, message_bytes)
+            return
+        
+        # Handle private message
+        elif message_type == "private_message":
+            sender = data.get("sender")
+            recipient = data.get("recipient")
             
-            # Send list of active users to the new client
-            user_list = list(client_usernames.values())
-            user_list_data = {
-                "type": "user_list",
-                "users": user_list
+            # Forward the encrypted message to all of the recipient's sessions only
+            send_to_user(recipient, message_bytes)
+            return
+        
+        # Handle a client whose presence version fell out of step
+        elif message_type == "presence_sync":
+            send_to_client(client, user_list_message())
+            return
+        
+        # Handle a request for older messages; nothing is kept, so the
+        # history is always exhausted
+        elif message_type == "history_request":
+            page = {
+                "type": "history_page",
+                "request_id": data.get("request_id"),
+                "conversation": data.get("conversation", "public"),
+                "messages": [],
+                "final": True,
+                "next_cursor": None
             }
-            client.send(json.dumps(user_list_data).encode('utf-8'))
-            
-            # Send updated user list to all clients
-            broadcast_user_list()
+            send_to_client(client, json.dumps(page).encode('utf-8'))
+            return
         
-        # Main message handling loop
-        while server_running:
-            message_bytes = client.recv(4096)  # Increased buffer size for encrypted messages
-            if not message_bytes:
-                break
-                
-            message_text = message_bytes.decode('utf-8')
-            
-            # Try to parse as JSON for special messages
-            try:
-                data = json.loads(message_text)
-                message_type = data.get("type", "")
-                
-                # Handle public key request
-                if message_type == "public_key_request":
-                    requester = data.get("requester")
-                    target = data.get("target")
-                    
-                    # Find the target client
-                    target_client = None
-                    for c, name in client_usernames.items():
-                        if name == target:
-                            target_client = c
-                            break
-                    
-                    if target_client:
-                        # Forward the request to the target
-                        target_client.send(message_bytes)
-                    continue
-                
-                # Handle public key response
-                elif message_type == "public_key_response":
-                    sender = data.get("sender")
-                    recipient = data.get("recipient")
-                    
-                    # Find the recipient client
-                    recipient_client = None
-                    for c, name in client_usernames.items():
-                        if name == recipient:
-                            recipient_client = c
-                            break
-                    
-                    if recipient_client:
-                        # Forward the response to the recipient
-                        recipient_client.send(message_bytes)
-                    continue
-                
-                # Handle private message
-                elif message_type == "private_message":
-                    sender = data.get("sender")
-                    recipient = data.get("recipient")
-                    
-                    # Find the recipient client
-                    recipient_client = None
-                    for c, name in client_usernames.items():
-                        if name == recipient:
-                            recipient_client = c
-                            break
-                    
-                    if recipient_client:
-                        # Forward the encrypted message to the recipient only
-                        recipient_client.send(message_bytes)
-                    continue
-                
-                # Handle typing indicator
-                elif message_type == "typing":
-                    # Already handled by the existing code
-                    pass
-                    
-            except json.JSONDecodeError:
-                # Not JSON, continue with normal message handling
-                pass
-            
-            # Handle typing indicator
-            if message_text.startswith("TYPING:"):
-                username = message_text[7:]
-                # Create typing indicator message
-                typing_data = {
-                    "type": "typing",
-                    "username": username,
-                    "isTyping": True
-                }
-                # Broadcast typing status to all other clients
-                broadcast_message(json.dumps(typing_data).encode('utf-8'), client)
-                continue
-                
-            # Handle stopped typing indicator
-            if message_text.startswith("STOPPED_TYPING:"):
-                username = message_text[15:]
-                # Create stopped typing indicator message
-                typing_data = {
-                    "type": "typing",
-                    "username": username,
-                    "isTyping": False
-                }
-                # Broadcast typing status to all other clients
-                broadcast_message(json.dumps(typing_data).encode('utf-8'), client)
-                continue
+        # Handle keys published at login; this server keeps no key directory
+        elif message_type == "publish_keys":
+            return
+        
+        # Handle a batch key lookup; with no directory every user is missing,
+        # so clients ask the users themselves with public_key_request
+        elif message_type == "get_keys":
+            usernames = data.get("usernames")
+            if not isinstance(usernames, list):
+                usernames = []
+            reply = {"type": "keys", "keys": {}, "missing": [str(username) for username in usernames]}
+            send_to_client(client, json.dumps(reply).encode('utf-8'))
+            return
+        
+        # Handle typing indicator
+        elif message_type == "typing":
+            # Already handled by the existing code
+            pass
+        
+        # Anything else is a request this server does not know, not chat text
+        else:
+            logger.warning(f"Ignoring unknown message type {message_type!r}")
+            return
             
-            # Extract username from message format "Username: Message"
-            if ": " in message_text:
-                username, content = message_text.split(": ", 1)
-                # Broadcast public message to all clients
-                broadcast_message(message_bytes, client)
+    except json.JSONDecodeError:
+        # Not JSON, continue with normal message handling
+        pass
+    
+    # Handle typing indicator; the change goes out with the next typing_state
+    if message_text.startswith("TYPING:"):
+        username = session.username if session is not None else message_text[7:]
+        typing.set_typing(username, True)
+        return
+        
+    # Handle stopped typing indicator
+    if message_text.startswith("STOPPED_TYPING:"):
+        username = session.username if session is not None else message_text[15:]
+        typing.set_typing(username, False)
+        return
+    
+    # Extract username from message format "Username: Message"
+    if ": " in message_text:
+        username, content = message_text.split(": ", 1)
+        # Broadcast public message to all clients
+        broadcast_message(message_bytes, client)
+
+def session_stats():
+    """Return the receive and outbound queue counters of every connected session"""
+    return {
+        f"{session.username}@{session.address[0]}:{session.address[1]}": dict(
+            session.outbound.stats(),
+            messages_received=session.messages_received,
+            bytes_received=session.bytes_received
+        )
+        for session in registry.sessions()
+    }
+
+def report_session_stats():
+    """Periodically log the outbound queue depth of every connection"""
+    while server_running:
+        time.sleep(stats_interval)
+        for name, stats in session_stats().items():
+            logger.info(f"Session {name}: {stats}")
+        logger.info(f"Typing: {typing.updates} updates, {typing.published} typing_state messages, "
+                    f"{typing.expired} expired")
+
+def handle_client(client, address):
+    """Handle communication with a single client"""
+    try:
+        # Wait for the first message which should contain the username
+        username, framed, remainder, _ = recv_handshake(client)
+        
+        # Extract username from first message
+        if username is not None:
+            outbound = OutboundQueue(client, username, queue_max_messages, queue_max_bytes, slow_client_policy)
+            register_client(Session(client, username, address, None, "default", framed, outbound))
+        
+        if framed:
+            # Framed clients: process every complete frame, however the stream was split
+            decoder = FrameDecoder()
+            decoder.feed(remainder)
+            while server_running:
+                for frame in decoder.frames():
+                    process_message(client, frame)
+                if not decoder.recv_into(client):
+                    break
+        else:
+            # Legacy clients: one recv is treated as one message
+            while server_running:
+                message_bytes = client.recv(4096)  # Increased buffer size for encrypted messages
+                if not message_bytes:
+                    break
+                process_message(client, message_bytes)
             
     except Exception as e:
         logger.error(f"Error handling client {address}: {e}")
@@ -226,17 +334,43 @@ def signal_handler(sig, frame):
     server_running = False
     
     # Close all client connections
-    for client in list(active_clients):
+    for session in registry.sessions():
         try:
-            client.close()
+            session.client.close()
         except:
             pass
     
     sys.exit(0)
 
+def apply_queue_settings(args):
+    """Apply the outbound queue, presence and typing command line options"""
+    global queue_max_messages, queue_max_bytes, slow_client_policy, stats_interval
+    queue_max_messages = args.queue_max_messages
+    queue_max_bytes = args.queue_max_bytes
+    slow_client_policy = args.slow_client_policy
+    stats_interval = args.stats_interval
+    presence.window = args.presence_window
+    typing.set_timeout(args.typing_timeout)
+
 def main():
     global server_running
     
+    parser = argparse.ArgumentParser(description="Chat Server (No Database Mode)")
+    parser.add_argument("--queue-max-messages", type=int, default=queue_max_messages,
+                        help="Messages that may be queued for one client before the slow-client policy applies")
+    parser.add_argument("--queue-max-bytes", type=int, default=queue_max_bytes,
+                        help="Bytes that may be queued for one client before the slow-client policy applies")
+    parser.add_argument("--slow-client-policy", choices=POLICIES, default=slow_client_policy,
+                        help="Disconnect clients that fall behind, or drop the messages they cannot take")
+    parser.add_argument("--stats-interval", type=float, default=stats_interval,
+                        help="Log per-connection queue depth every N seconds (0 disables)")
+    parser.add_argument("--presence-window", type=float, default=presence_window,
+                        help="Seconds to batch joins and leaves into one presence update")
+    parser.add_argument("--typing-timeout", type=float, default=typing_timeout,
+                        help="Seconds without a TYPING: refresh before a typing indicator expires")
+    args = parser.parse_args()
+    apply_queue_settings(args)
+    
     # Register signal handler for Ctrl+C
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
@@ -245,6 +379,11 @@ def main():
     print("Starting chat server (No Database Mode)...")
     print("Note: Messages will not be persisted without a database connection.")
     
+    if stats_interval > 0:
+        stats_thread = threading.Thread(target=report_session_stats)
+        stats_thread.daemon = True
+        stats_thread.start()
+    
     # Create IPv4 socket
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     
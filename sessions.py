@@ -0,0 +1,97 @@
+"""
+Connection registry shared by the chat servers.
+
+Keeps every connected client indexed both by its socket (or asyncio protocol)
+and by username, so routing a message to a user is a dictionary lookup rather
+than a scan over all connections. A username may have several sessions at
+once, e.g. the same user logged in from two devices.
+
+The registry is copy-on-write: joins and leaves build new tuples under a lock
+and swap them in, while readers (broadcasts, routing) just grab the current
+tuple. A broadcast therefore iterates a stable snapshot with no locking, and
+a client leaving mid-broadcast cannot make it skip anyone.
+"""
+
+import threading
+import time
+
+class Session:
+    """A single connected client"""
+
+    __slots__ = (
+        'client', 'username', 'address', 'user_id', 'theme', 'framed', 'outbound',
+        'connected_at', 'messages_received', 'bytes_received',
+    )
+
+    def __init__(self, client, username, address=None, user_id=None, theme='default',
+                 framed=False, outbound=None):
+        self.client = client
+        self.username = username
+        self.address = address
+        self.user_id = user_id
+        self.theme = theme
+        self.framed = framed  # Client negotiated length-prefixed framing
+        self.outbound = outbound  # OutboundQueue or TransportQueue for this client
+
+        # Counters
+        self.connected_at = time.time()
+        self.messages_received = 0
+        self.bytes_received = 0
+
+class SessionRegistry:
+    """Bidirectional index of connected sessions: client -> session and username -> sessions"""
+
+    def __init__(self):
+        self._lock = threading.Lock()  # Serialises writers only
+        self._by_client = {}
+        self._by_username = {}  # username -> tuple of sessions, in join order
+        self._snapshot = ()  # All sessions, in join order
+        self.version = 0  # Incremented whenever a session joins or leaves
+
+    def add(self, session):
+        """Register a newly joined session and return it"""
+        with self._lock:
+            self._by_client[session.client] = session
+            self._by_username[session.username] = self._by_username.get(session.username, ()) + (session,)
+            self._snapshot = self._snapshot + (session,)
+            self.version += 1
+        return session
+
+    def remove(self, client):
+        """Unregister a client; returns its session, or None if it was not registered"""
+        with self._lock:
+            session = self._by_client.pop(client, None)
+            if session is None:
+                return None
+
+            sessions = tuple(s for s in self._by_username.get(session.username, ()) if s is not session)
+            if sessions:
+                self._by_username[session.username] = sessions
+            else:
+                self._by_username.pop(session.username, None)
+            self._snapshot = tuple(s for s in self._snapshot if s is not session)
+            self.version += 1
+        return session
+
+    def get(self, client):
+        """Return the session for a client, or None"""
+        return self._by_client.get(client)
+
+    def sessions_for(self, username):
+        """Return every session logged in as username"""
+        return self._by_username.get(username, ())
+
+    def sessions(self):
+        """Return an immutable snapshot of all connected sessions"""
+        return self._snapshot
+
+    def usernames(self):
+        """Return the distinct usernames currently online, in join order"""
+        with self._lock:
+            return list(self._by_username)
+
+    def __contains__(self, client):
+        return client in self._by_client
+
+    def __len__(self):
+        return len(self._snapshot)
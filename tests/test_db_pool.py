@@ -0,0 +1,76 @@
+import types
+
+import pytest
+
+from db_pool import ConnectionPool, TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+
+INTRANS = 2  # libpq: idle inside a transaction block
+
+class FakeConnection:
+    """Tracks its transaction state the way psycopg2 reports it"""
+
+    def __init__(self):
+        self.info = types.SimpleNamespace(transaction_status=TRANSACTION_STATUS_IDLE)
+        self.closed = False
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.info.transaction_status = TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.info.transaction_status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = True
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, params=None):
+        self.conn.info.transaction_status = INTRANS
+
+    def fetchall(self):
+        return []
+
+@pytest.fixture
+def pool():
+    return ConnectionPool(FakeConnection, min_size=0, max_size=1)
+
+def select_and_return_early(pool):
+    with pool.connection() as conn:
+        conn.cursor().execute("SELECT 1")
+        return conn
+
+def test_early_return_rolls_back(pool):
+    conn = select_and_return_early(pool)
+    assert conn.rollbacks == 1
+    assert conn.info.transaction_status == TRANSACTION_STATUS_IDLE
+    assert pool.stats()['rollbacks'] == 1
+    # The same connection is lent out again, with no transaction left open
+    assert pool.acquire() is conn
+
+def test_committed_connection_is_not_rolled_back(pool):
+    with pool.connection() as conn:
+        conn.cursor().execute("INSERT")
+        conn.commit()
+    assert conn.rollbacks == 0
+
+def test_block_that_raises_is_rolled_back(pool):
+    with pytest.raises(ValueError):
+        with pool.connection() as conn:
+            conn.cursor().execute("SELECT 1")
+            raise ValueError("boom")
+    assert conn.rollbacks == 1
+    assert pool.stats()['idle'] == 1
+
+def test_connection_in_unknown_state_is_discarded(pool):
+    with pool.connection() as conn:
+        conn.info.transaction_status = TRANSACTION_STATUS_UNKNOWN
+    assert conn.closed
+    assert pool.stats()['discarded'] == 1
+    assert pool.acquire() is not conn
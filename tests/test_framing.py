@@ -0,0 +1,87 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from framing import (FrameDecoder, FrameError, HandshakeReader, MAX_HANDSHAKE_SIZE, build_handshake,
+                     encode_frame, recv_handshake)
+
+def one_byte_at_a_time(data):
+    return [data[i:i + 1] for i in range(len(data))]
+
+def test_framed_handshake_fed_byte_by_byte():
+    data = build_handshake("alice", {"SINCE_ID": 1234}) + encode_frame(b"hello") + encode_frame(b"world")
+    reader = HandshakeReader()
+    chunks = one_byte_at_a_time(data)
+    for index, chunk in enumerate(chunks):
+        handshake = reader.feed(chunk)
+        if handshake is not None:
+            break
+    username, framed, remainder, options = handshake
+    assert (username, framed, options) == ("alice", True, {"SINCE_ID": "1234"})
+
+    # Whatever followed the handshake decodes into frames, one byte at a time too
+    decoder = FrameDecoder(initial_size=4)
+    decoder.feed(remainder)
+    frames = list(decoder.frames())
+    for chunk in chunks[index + 1:]:
+        decoder.feed(chunk)
+        frames.extend(decoder.frames())
+    assert frames == [b"hello", b"world"]
+    assert decoder.pending() == 0
+
+def test_legacy_handshake_is_complete_once_nothing_more_arrives():
+    reader = HandshakeReader()
+    for chunk in one_byte_at_a_time(b"USERNAME:bob"):
+        assert reader.feed(chunk) is None
+        assert reader.legacy_possible
+    assert reader.finish() == ("bob", False, b"", {})
+
+def test_other_first_message_is_not_a_handshake():
+    assert HandshakeReader().feed(b"USER") is None
+    assert HandshakeReader().feed(b"hello")[0] is None
+
+def test_handshake_without_framing_line_is_limited():
+    reader = HandshakeReader()
+    reader.feed(b"USERNAME:carol\n")
+    assert not reader.legacy_possible
+    with pytest.raises(FrameError):
+        reader.feed(b"X" * MAX_HANDSHAKE_SIZE)
+
+def send_slowly(sock, data, delay=0.001):
+    for chunk in one_byte_at_a_time(data):
+        sock.sendall(chunk)
+        time.sleep(delay)
+
+def test_recv_handshake_from_a_byte_by_byte_sender():
+    server, client = socket.socketpair()
+    data = build_handshake("alice") + encode_frame(b"hi")
+    sender = threading.Thread(target=send_slowly, args=(client, data))
+    sender.start()
+    try:
+        username, framed, remainder, _ = recv_handshake(server)
+        sender.join()
+        assert (username, framed) == ("alice", True)
+        decoder = FrameDecoder()
+        decoder.feed(remainder)
+        server.settimeout(1.0)
+        while decoder.pending() < len(encode_frame(b"hi")):
+            decoder.recv_into(server)
+        assert list(decoder.frames()) == [b"hi"]
+        assert server.gettimeout() == 1.0
+    finally:
+        server.close()
+        client.close()
+
+def test_recv_handshake_takes_a_legacy_handshake_after_the_wait():
+    server, client = socket.socketpair()
+    try:
+        client.sendall(b"USERNAME:bob")
+        started = time.monotonic()
+        assert recv_handshake(server, wait=0.05) == ("bob", False, b"", {})
+        assert time.monotonic() - started < 1.0
+        assert server.gettimeout() is None
+    finally:
+        server.close()
+        client.close()
@@ -0,0 +1,40 @@
+import datetime
+import json
+
+from history import HistoryCache
+
+NOW = datetime.datetime(2026, 1, 1, 12, 0, 0)
+
+def test_since_returns_only_newer_messages():
+    cache = HistoryCache(limit=10, recent_size=100)
+    for message_id in range(1, 6):
+        cache.add("alice", f"m{message_id}", NOW, message_id=message_id)
+    assert [entry["id"] for entry in cache.since(3)] == [4, 5]
+    assert cache.since(5) == []
+    assert cache.since(6) is None
+
+def test_message_without_id_sends_reconnecting_clients_full_history():
+    cache = HistoryCache(limit=10, recent_size=100)
+    for message_id in range(1, 4):
+        cache.add("alice", f"m{message_id}", NOW, message_id=message_id)
+    cache.add("bob", "no id", NOW, message_id=None)
+    cache.add("alice", "m4", NOW, message_id=4)
+
+    # Anyone who last saw an id from before the id-less message may have missed it
+    assert cache.since(2) is None
+    assert cache.since(3) is None
+    # A client that saw a later message also saw the id-less one
+    assert [entry["id"] for entry in cache.since(4)] == []
+
+def test_full_ring_does_not_lower_the_floor():
+    cache = HistoryCache(limit=10, recent_size=3)
+    for message_id in range(1, 4):
+        cache.add("alice", f"m{message_id}", NOW, message_id=message_id)
+    cache.add("bob", "no id", NOW, message_id=None)
+    cache.add("alice", "m4", NOW, message_id=4)
+    assert cache.since(3) is None
+
+def test_history_message_carries_the_epoch():
+    cache = HistoryCache(limit=10, recent_size=100, epoch="memory-1")
+    cache.add("alice", "m1", NOW, message_id=1)
+    assert json.loads(cache.message())["epoch"] == "memory-1"
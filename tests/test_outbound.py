@@ -0,0 +1,109 @@
+import socket
+import threading
+import time
+
+from outbound import OutboundQueue, SocketWriter
+
+CHUNK = 64 * 1024
+CHUNKS = 200
+
+def test_blocked_socket_is_retried_while_others_are_busy(monkeypatch):
+    writer = SocketWriter()
+    monkeypatch.setattr("outbound.get_shared_writer", lambda: writer)
+
+    busy_server, busy_client = socket.socketpair()
+    slow_server, slow_client = socket.socketpair()
+    busy = OutboundQueue(busy_server, "busy", max_messages=100000, max_bytes=1 << 30)
+    slow = OutboundQueue(slow_server, "slow", max_messages=100000, max_bytes=1 << 30)
+    stop = threading.Event()
+
+    def keep_busy():
+        # A frame every 2 ms keeps the writer's ready list from ever running dry
+        while not stop.is_set():
+            busy.put(b"x" * 100)
+            time.sleep(0.002)
+
+    def drain(sock):
+        sock.settimeout(0.5)
+        while not stop.is_set():
+            try:
+                if not sock.recv(1 << 20):
+                    return
+            except socket.timeout:
+                pass
+
+    threads = [threading.Thread(target=keep_busy), threading.Thread(target=drain, args=(busy_client,))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        # Far more than the socket buffer holds, so the slow queue blocks and has to be retried
+        for _ in range(CHUNKS):
+            slow.put(b"y" * CHUNK)
+
+        received = 0
+        slow_client.settimeout(5.0)
+        deadline = time.monotonic() + 5.0
+        while received < CHUNK * CHUNKS and time.monotonic() < deadline:
+            received += len(slow_client.recv(1 << 20))
+        assert received == CHUNK * CHUNKS
+    finally:
+        stop.set()
+        busy.close()
+        slow.close()
+
+def fill_until_blocked(queue):
+    # Far more than the socket buffers hold
+    for _ in range(CHUNKS):
+        queue.put(b"y" * CHUNK)
+
+def read_all(sock, size, timeout=5.0):
+    received = 0
+    sock.settimeout(timeout)
+    deadline = time.monotonic() + timeout
+    while received < size and time.monotonic() < deadline:
+        received += len(sock.recv(1 << 20))
+    return received
+
+def test_blocked_socket_waits_for_writability_without_polling(monkeypatch):
+    writer = SocketWriter()
+    monkeypatch.setattr("outbound.get_shared_writer", lambda: writer)
+    server, client = socket.socketpair()
+    queue = OutboundQueue(server, "slow", max_messages=100000, max_bytes=1 << 30)
+    calls = []
+    write_pending = queue.write_pending
+    monkeypatch.setattr(queue, "write_pending", lambda: calls.append(1) or write_pending())
+    try:
+        fill_until_blocked(queue)
+        time.sleep(0.05)
+        blocked_calls = len(calls)
+        # Nobody reads, so the socket never becomes writable and is not tried again
+        time.sleep(0.3)
+        assert len(calls) == blocked_calls
+        assert read_all(client, CHUNK * CHUNKS) == CHUNK * CHUNKS
+    finally:
+        queue.close()
+        server.close()
+        client.close()
+
+def test_closed_blocked_socket_does_not_confuse_its_successor(monkeypatch):
+    writer = SocketWriter()
+    monkeypatch.setattr("outbound.get_shared_writer", lambda: writer)
+    server, client = socket.socketpair()
+    queue = OutboundQueue(server, "gone", max_messages=100000, max_bytes=1 << 30)
+    fill_until_blocked(queue)
+    time.sleep(0.05)
+    queue.close()
+    server.close()
+    client.close()
+
+    # The new sockets will usually get the same descriptors back
+    server, client = socket.socketpair()
+    queue = OutboundQueue(server, "next", max_messages=100000, max_bytes=1 << 30)
+    try:
+        fill_until_blocked(queue)
+        assert read_all(client, CHUNK * CHUNKS) == CHUNK * CHUNKS
+    finally:
+        queue.close()
+        server.close()
+        client.close()
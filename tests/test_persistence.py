@@ -0,0 +1,147 @@
+import json
+import threading
+import time
+
+from persistence import IdAllocator, MessageWriter
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_next_block_is_reserved_in_the_background():
+    sequence = iter(range(1, 1000))
+    reserve_calls = []
+
+    def reserve(count):
+        reserve_calls.append(threading.current_thread())
+        return [next(sequence) for _ in range(count)]
+
+    allocator = IdAllocator(reserve, block_size=10)
+    assert allocator.fill()
+    ids = [allocator.next_id() for _ in range(6)]
+    assert ids == [1, 2, 3, 4, 5, 6]
+
+    # Below the low-water mark: the next block arrives without a caller waiting for it
+    assert wait_for(lambda: allocator.stats()['available'] == 14)
+    assert reserve_calls[-1] is not threading.current_thread()
+    assert [allocator.next_id() for _ in range(14)] == list(range(7, 21))
+
+def test_next_id_does_not_wait_for_a_stalled_database():
+    release = threading.Event()
+
+    def reserve(count):
+        release.wait(5.0)
+        return list(range(1, count + 1))
+
+    allocator = IdAllocator(reserve, block_size=10)
+    started = time.perf_counter()
+    assert [allocator.next_id() for _ in range(3)] == [None, None, None]
+    assert time.perf_counter() - started < 0.1
+    assert allocator.stats()['exhausted'] == 3
+
+    release.set()
+    assert wait_for(lambda: allocator.stats()['available'] == 10)
+    assert allocator.next_id() == 1
+
+def test_failed_reservation_is_not_retried_for_every_message():
+    calls = []
+
+    def reserve(count):
+        calls.append(count)
+        raise RuntimeError("database is down")
+
+    allocator = IdAllocator(reserve, block_size=10)
+    assert not allocator.fill()
+    assert [allocator.next_id() for _ in range(50)] == [None] * 50
+    assert len(calls) == 1
+    assert allocator.stats()['failed_refills'] == 1
+
+class DatabaseDown(Exception):
+    pass
+
+class Table:
+    """Stands in for a message table: rejects records marked bad, or everything while down"""
+
+    def __init__(self):
+        self.rows = []
+        self.calls = 0
+        self.down = False
+
+    def insert(self, batch):
+        self.calls += 1
+        if self.down:
+            raise DatabaseDown("connection refused")
+        if any(record[0] == "bad" for record in batch):
+            raise ValueError("bad record")
+        self.rows.extend(batch)
+
+def read_lines(path):
+    with open(path, encoding='utf-8') as lines:
+        return [json.loads(line) for line in lines]
+
+def test_bad_record_is_rejected_and_the_rest_written(tmp_path):
+    table = Table()
+    writer = MessageWriter(table.insert, max_batch=100, flush_interval=60, retryable=(DatabaseDown,),
+                           spill_path=str(tmp_path / "spill"), reject_path=str(tmp_path / "rejected"))
+    records = [("good", i) for i in range(20)]
+    records[13] = ("bad", 13)
+    for record in records:
+        writer.submit(record)
+    writer.close()
+
+    assert sorted(table.rows, key=lambda record: record[1]) == [record for record in records if record[0] == "good"]
+    assert read_lines(tmp_path / "rejected") == [["bad", 13]]
+    assert not (tmp_path / "spill").exists()
+    stats = writer.stats()
+    assert stats['written'] == 19 and stats['rejected'] == 1 and stats['spilled'] == 0
+
+def test_only_unavailable_database_is_spilled_and_replayed(tmp_path):
+    table = Table()
+    table.down = True
+    writer = MessageWriter(table.insert, max_batch=100, flush_interval=0.01, retryable=(DatabaseDown,),
+                           spill_path=str(tmp_path / "spill"), reject_path=str(tmp_path / "rejected"))
+    writer.submit(("good", 1))
+    writer.submit(("bad", 2))
+    assert wait_for(lambda: writer.stats()['spilled'] == 2)
+    assert table.calls == 1
+
+    # Back up: the replay writes the good record and rejects the bad one instead of retrying it forever
+    table.down = False
+    writer._next_replay = 0.0
+    writer.submit(("good", 3))
+    assert wait_for(lambda: writer.stats()['replayed'] == 1)
+    writer.close()
+
+    assert sorted(table.rows) == [("good", 1), ("good", 3)]
+    assert read_lines(tmp_path / "rejected") == [["bad", 2]]
+    assert not (tmp_path / "spill").exists() and not (tmp_path / "spill.replay").exists()
+
+def test_overflow_is_spilled_off_the_callers_thread(tmp_path):
+    release = threading.Event()
+    spill_threads = []
+
+    def stalled_insert(batch):
+        release.wait(5.0)
+
+    writer = MessageWriter(stalled_insert, max_batch=1, flush_interval=60, max_queue=1,
+                           spill_path=str(tmp_path / "spill"))
+    spill = writer._spill
+
+    def slow_spill(records):
+        spill_threads.append(threading.current_thread())
+        time.sleep(0.2)
+        spill(records)
+
+    writer._spill = slow_spill
+    started = time.perf_counter()
+    results = [writer.submit(("good", i)) for i in range(5)]
+    assert time.perf_counter() - started < 0.1
+    assert results.count(False) >= 3
+
+    assert wait_for(lambda: writer.stats()['spilled'] == results.count(False))
+    assert threading.current_thread() not in spill_threads
+    assert len(read_lines(tmp_path / "spill")) == results.count(False)
+    release.set()
+    writer.close()
@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+from keystore import Identity, PeerKey
+from ratchet import MAX_SKIP, REKEY_MESSAGES, SessionError, SessionStore
+
+@pytest.fixture
+def stores():
+    recipient = Identity.generate("x25519")
+    peer_key = PeerKey("x25519", recipient.x25519_key.public_key(), recipient.ed25519_key.public_key())
+    return SessionStore(), SessionStore(recipient), peer_key
+
+def send(sender, peer_key, text):
+    return sender.encrypt("alice", "bob", peer_key, text)
+
+def test_messages_out_of_order_and_replay(stores):
+    sender, receiver, peer_key = stores
+    messages = [send(sender, peer_key, f"m{i}") for i in range(4)]
+    assert receiver.decrypt("alice", "bob", messages[0]) == "m0"
+    assert receiver.decrypt("alice", "bob", messages[3]) == "m3"
+    assert receiver.decrypt("alice", "bob", messages[1]) == "m1"
+    with pytest.raises(SessionError):
+        receiver.decrypt("alice", "bob", messages[1])
+    assert receiver.decrypt("alice", "bob", messages[2]) == "m2"
+
+def test_forged_large_counter_is_refused_quickly(stores):
+    sender, receiver, peer_key = stores
+    assert receiver.decrypt("alice", "bob", send(sender, peer_key, "first")) == "first"
+    genuine = send(sender, peer_key, "second")
+
+    forged = dict(genuine, counter=2000000)
+    started = time.perf_counter()
+    with pytest.raises(SessionError):
+        receiver.decrypt("alice", "bob", forged)
+    assert time.perf_counter() - started < 0.1
+
+    # Within the counter range but beyond MAX_SKIP of the session
+    with pytest.raises(SessionError):
+        receiver.decrypt("alice", "bob", dict(genuine, counter=MAX_SKIP + 10))
+
+    assert receiver.decrypt("alice", "bob", genuine) == "second"
+    assert receiver.decrypt("alice", "bob", send(sender, peer_key, "third")) == "third"
+
+def test_forged_message_does_not_move_the_session(stores):
+    sender, receiver, peer_key = stores
+    receiver.decrypt("alice", "bob", send(sender, peer_key, "first"))
+    genuine = [send(sender, peer_key, f"m{i}") for i in range(3)]
+
+    # Right session and a reachable counter, but a ciphertext that does not authenticate
+    forged = dict(genuine[2], encrypted_message=genuine[0]["encrypted_message"])
+    with pytest.raises(SessionError):
+        receiver.decrypt("alice", "bob", forged)
+
+    assert [receiver.decrypt("alice", "bob", message) for message in genuine] == ["m0", "m1", "m2"]
+
+def test_forged_session_is_not_kept(stores):
+    sender, receiver, peer_key = stores
+    genuine = send(sender, peer_key, "hello")
+    other = Identity.generate("x25519")
+    forged = SessionStore().encrypt("alice", "bob", PeerKey("x25519", other.x25519_key.public_key(), None), "fake")
+    with pytest.raises(SessionError):
+        receiver.decrypt("alice", "bob", forged)
+    assert receiver.stats()['incoming_sessions'] == 0
+    assert receiver.decrypt("alice", "bob", genuine) == "hello"
+
+def test_restarted_receiver_rebuilds_session(stores):
+    sender, receiver, peer_key = stores
+    messages = [send(sender, peer_key, f"m{i}") for i in range(MAX_SKIP + 20)]
+    restarted = SessionStore(receiver.identity)
+    assert restarted.decrypt("alice", "bob", messages[-1]) == f"m{MAX_SKIP + 19}"
+    assert restarted.stats()['incoming_sessions'] == 1
+    with pytest.raises(SessionError):
+        restarted.decrypt("alice", "bob", dict(messages[-1], counter=REKEY_MESSAGES))
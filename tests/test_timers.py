@@ -0,0 +1,27 @@
+import threading
+
+from timers import TimerThread
+
+def test_callbacks_run_in_due_order_on_one_thread():
+    timers = TimerThread()
+    ran = []
+    done = threading.Event()
+    before = threading.active_count()
+
+    timers.schedule(0.3, lambda: ran.append(("late", threading.current_thread())))
+    timers.schedule(0.05, lambda: ran.append(("early", threading.current_thread())))
+    for _ in range(50):
+        timers.schedule(0.15, lambda: ran.append(("middle", threading.current_thread())))
+    timers.schedule(0.35, done.set)
+
+    assert done.wait(2.0)
+    assert [name for name, _ in ran] == ["early"] + ["middle"] * 50 + ["late"]
+    assert len({thread for _, thread in ran}) == 1
+    assert threading.active_count() <= before + 1
+
+def test_failing_callback_does_not_stop_the_timer():
+    timers = TimerThread()
+    done = threading.Event()
+    timers.schedule(0.0, lambda: 1 / 0)
+    timers.schedule(0.01, done.set)
+    assert done.wait(2.0)
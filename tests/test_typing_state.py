@@ -0,0 +1,16 @@
+import time
+
+from typing_state import TypingTracker
+
+def test_typing_timeout_is_changed_in_place():
+    published = []
+    tracker = TypingTracker(lambda message, started, stopped: published.append((started, stopped)),
+                            tick=0.01, timeout=3.0)
+    tracker.set_timeout(0.05)
+    tracker.set_typing("alice", True)
+
+    deadline = time.monotonic() + 2.0
+    while len(published) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert published == [({"alice"}, set()), (set(), {"alice"})]
+    assert tracker.expired == 1
@@ -0,0 +1,54 @@
+"""
+Shared timer thread for the chat servers.
+
+Presence deltas and typing ticks are scheduled every window or tick. In the
+threaded engine a threading.Timer for each would start and tear down a
+thread every time, so they all go to one long-lived thread that keeps the
+pending callbacks in a heap ordered by due time. The asyncio engine
+schedules them with loop.call_later instead.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger("ChatServer")
+
+class TimerThread:
+    """Runs callbacks after a delay on one long-lived thread"""
+
+    def __init__(self, name="timer"):
+        self.name = name
+        self._heap = []  # (due time, sequence, callback)
+        self._sequence = itertools.count()  # Keeps callbacks due at the same time in order
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def schedule(self, delay, callback):
+        """Run callback after delay seconds"""
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._sequence), callback))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, callback = heapq.heappop(self._heap)
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Timer callback failed: {e}")
+
+timers = TimerThread()
+
+def thread_timer(delay, callback):
+    """Run callback after delay seconds on the shared timer thread"""
+    timers.schedule(delay, callback)
@@ -0,0 +1,199 @@
+"""
+Streaming export and import of the chat tables.
+
+Each table is copied with COPY ... TO STDOUT / FROM STDIN in CSV format
+straight between the database and a file, so memory use does not depend on
+the table size and no pg_dump is needed on the host. Files can be gzip or
+zstd compressed (zstd needs the zstandard package), and tables are copied in
+parallel, one connection per worker.
+
+An export directory holds one <table>.csv[.gz|.zst] per table and a
+manifest.json recording the columns, row counts and compression, which
+import reads back. All tables of an export come from one snapshot, so they
+are consistent with each other. Message tables can be limited to a time
+range.
+"""
+
+import concurrent.futures
+import datetime
+import gzip
+import json
+import os
+import time
+
+# Tables in the order they have to be imported; tables of one group do not
+# reference each other and are imported in parallel
+TABLE_GROUPS = (
+    ("chat_users",),
+    ("chat_rooms",),
+    ("chat_messages", "room_messages", "room_members", "user_keys"),
+)
+TABLES = tuple(table for group in TABLE_GROUPS for table in group)
+
+# Tables that can be limited to a time range, by this column
+TIMESTAMP_COLUMNS = {"chat_messages": "timestamp", "room_messages": "timestamp"}
+
+COMPRESSIONS = ("none", "gzip", "zstd")
+EXTENSIONS = {"none": ".csv", "gzip": ".csv.gz", "zstd": ".csv.zst"}
+
+MANIFEST = "manifest.json"
+
+class TransferError(Exception):
+    """Raised when an export or import cannot be carried out"""
+
+def open_file(path, mode, compression):
+    """Open an export file for binary reading ('r') or writing ('w')"""
+    if compression == "gzip":
+        return gzip.open(path, mode + "b", compresslevel=6)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise TransferError("zstd compression needs the zstandard package (pip install zstandard)")
+        raw = open(path, mode + "b")
+        if mode == "w":
+            return zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=True)
+        return zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+    return open(path, mode + "b")
+
+def table_columns(cursor, table):
+    """Return the columns of table that can be copied in, leaving out generated ones"""
+    cursor.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = %s AND table_schema = current_schema() AND is_generated = 'NEVER'
+        ORDER BY ordinal_position
+    """, (table,))
+    return [row[0] for row in cursor.fetchall()]
+
+def export_tables(connect, directory, tables=TABLES, since=None, until=None, compression="none", workers=4):
+    """Export tables into directory and write its manifest; returns the manifest.
+
+    connect opens a new database connection. since and until limit the
+    message tables to [since, until).
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    # Hold one snapshot open so every worker sees the same data
+    coordinator = connect()
+    try:
+        coordinator.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        cursor = coordinator.cursor()
+        cursor.execute("SELECT pg_export_snapshot()")
+        snapshot = cursor.fetchone()[0]
+        columns = {table: table_columns(cursor, table) for table in tables}
+
+        def export_one(table):
+            conn = connect()
+            try:
+                conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+                table_cursor = conn.cursor()
+                table_cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+                conditions, params = [], []
+                column = TIMESTAMP_COLUMNS.get(table)
+                if column and since:
+                    conditions.append(f"{column} >= %s")
+                    params.append(since)
+                if column and until:
+                    conditions.append(f"{column} < %s")
+                    params.append(until)
+                query = f"SELECT {', '.join(columns[table])} FROM {table}"
+                if conditions:
+                    query += " WHERE " + " AND ".join(conditions)
+                query = table_cursor.mogrify(query, params).decode('utf-8')
+
+                started = time.monotonic()
+                with open_file(os.path.join(directory, table + EXTENSIONS[compression]), "w", compression) as out:
+                    table_cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", out)
+                rows = table_cursor.rowcount
+                conn.rollback()
+                return rows, time.monotonic() - started
+            finally:
+                conn.close()
+
+        manifest = {
+            "created": datetime.datetime.now().isoformat(),
+            "since": since.isoformat() if since else None,
+            "until": until.isoformat() if until else None,
+            "compression": compression,
+            "tables": {},
+        }
+        for table, (rows, seconds) in run_parallel(export_one, tables, workers):
+            manifest["tables"][table] = {"file": table + EXTENSIONS[compression],
+                                         "columns": columns[table], "rows": rows}
+            print(f"Exported {rows} rows of {table} in {seconds:.1f} s ({rows / max(seconds, 1e-6):.0f} rows/sec)")
+        coordinator.rollback()
+    finally:
+        coordinator.close()
+
+    with open(os.path.join(directory, MANIFEST), "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+def import_tables(connect, directory, tables=None, merge=False, workers=4):
+    """Import the tables of an export directory; returns {table: rows}.
+
+    Tables are loaded group by group so referenced rows exist first. With
+    merge, rows go through a temporary table and rows whose key already
+    exists are skipped; otherwise they are copied straight in, and the
+    target tables must not already hold them. Each table is loaded in its
+    own transaction.
+    """
+    with open(os.path.join(directory, MANIFEST), encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    compression = manifest["compression"]
+    wanted = [table for table in (tables or TABLES) if table in manifest["tables"]]
+    unknown = set(tables or ()) - set(manifest["tables"])
+    if unknown:
+        raise TransferError(f"Not in this export: {', '.join(sorted(unknown))}")
+
+    def import_one(table):
+        entry = manifest["tables"][table]
+        column_list = ", ".join(entry["columns"])
+        conn = connect()
+        try:
+            cursor = conn.cursor()
+            started = time.monotonic()
+            with open_file(os.path.join(directory, entry["file"]), "r", compression) as source:
+                if merge:
+                    staging = f"import_{table}"
+                    cursor.execute(f"CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+                    cursor.copy_expert(f"COPY {staging} ({column_list}) FROM STDIN WITH (FORMAT csv, HEADER)", source)
+                    cursor.execute(f"""
+                        INSERT INTO {table} ({column_list})
+                        SELECT {column_list} FROM {staging}
+                        ON CONFLICT DO NOTHING
+                    """)
+                else:
+                    cursor.copy_expert(f"COPY {table} ({column_list}) FROM STDIN WITH (FORMAT csv, HEADER)", source)
+                rows = cursor.rowcount
+
+            # Keep new ids clear of the imported ones
+            if "id" in entry["columns"]:
+                cursor.execute(f"""
+                    SELECT setval(pg_get_serial_sequence(%s, 'id'), GREATEST(MAX(id), 1))
+                    FROM {table}
+                """, (table,))
+            conn.commit()
+            return rows, time.monotonic() - started
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    imported = {}
+    for group in TABLE_GROUPS:
+        group_tables = [table for table in group if table in wanted]
+        for table, (rows, seconds) in run_parallel(import_one, group_tables, workers):
+            imported[table] = rows
+            print(f"Imported {rows} rows of {table} in {seconds:.1f} s ({rows / max(seconds, 1e-6):.0f} rows/sec)")
+    return imported
+
+def run_parallel(work, tables, workers):
+    """Run work(table) for every table on up to workers threads; yields (table, result)"""
+    if not tables:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(tables)))) as executor:
+        futures = {executor.submit(work, table): table for table in tables}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
@@ -0,0 +1,140 @@
+"""
+Typing indicators for the chat servers.
+
+Clients send TYPING:<name> while the user types and STOPPED_TYPING:<name>
+when they stop. Instead of turning each of those into its own broadcast, the
+server keeps one typing flag per user and, once per tick, publishes the set
+of users currently typing as a single frame:
+
+    {"type": "typing_state", "typing": ["alice", "bob"]}
+
+Repeated TYPING messages only push the flag's expiry back, a start and stop
+within the same tick cancel out, and a flag that is not refreshed expires on
+the server, so a client that disconnects mid-sentence does not leave the
+others staring at "... is typing" forever.
+"""
+
+import json
+import threading
+
+from timers import thread_timer
+
+class TimerWheel:
+    """Hashed timer wheel for many short, frequently rescheduled timeouts.
+
+    Timeouts are rounded up to whole ticks and kept in one bucket per tick,
+    so scheduling, rescheduling and cancelling are O(1) and each tick only
+    looks at the bucket that expires.
+    """
+
+    def __init__(self, tick, max_delay):
+        self.tick = tick
+        self._buckets = [set() for _ in range(int(round(max_delay / tick)) + 2)]
+        self._cursor = 0
+        self._where = {}  # key -> index of the bucket it is in
+
+    def schedule(self, key, delay):
+        """Expire key after delay seconds, replacing any earlier timeout"""
+        self.cancel(key)
+        ticks = min(max(1, -(-delay // self.tick)), len(self._buckets) - 1)
+        index = (self._cursor + int(ticks)) % len(self._buckets)
+        self._buckets[index].add(key)
+        self._where[key] = index
+
+    def cancel(self, key):
+        """Forget key's timeout, if it has one"""
+        index = self._where.pop(key, None)
+        if index is not None:
+            self._buckets[index].discard(key)
+
+    def advance(self):
+        """Move forward one tick and return the keys that expired"""
+        self._cursor = (self._cursor + 1) % len(self._buckets)
+        expired = self._buckets[self._cursor]
+        self._buckets[self._cursor] = set()
+        for key in expired:
+            del self._where[key]
+        return expired
+
+    def __len__(self):
+        return len(self._where)
+
+class TypingTracker:
+    """Per-user typing flags, published as one typing_state frame per tick"""
+
+    def __init__(self, publish, tick=0.1, timeout=3.0, schedule=thread_timer):
+        self.publish = publish  # Called with (encoded typing_state, started, stopped)
+        self.tick = tick
+        self.timeout = timeout
+        self.schedule = schedule  # schedule(delay, callback); replaced by the asyncio engine
+
+        # Reentrant: publishing can drop a dead client, which clears its typing flag
+        self._lock = threading.RLock()
+        self._wheel = TimerWheel(tick, timeout)
+        self._typing = set()     # Users typing now
+        self._published = set()  # Users typing as of the last typing_state
+        self._ticking = False
+
+        # Counters
+        self.updates = 0    # TYPING/STOPPED_TYPING messages received
+        self.published = 0  # typing_state frames published
+        self.expired = 0    # Flags cleared by the server-side timeout
+
+    def set_typing(self, username, is_typing):
+        """Record a TYPING (True) or STOPPED_TYPING (False) message from a user"""
+        with self._lock:
+            self.updates += 1
+            if is_typing:
+                self._typing.add(username)
+                self._wheel.schedule(username, self.timeout)
+            elif username in self._typing:
+                self._typing.discard(username)
+                self._wheel.cancel(username)
+            else:
+                return
+            self._start_ticking()
+
+    def set_timeout(self, timeout):
+        """Change how long a flag lasts without a refresh; flags set now get it from now"""
+        with self._lock:
+            self.timeout = timeout
+            self._wheel = TimerWheel(self.tick, timeout)
+            for username in self._typing:
+                self._wheel.schedule(username, timeout)
+
+    def user_left(self, username):
+        """Clear the typing flag of a user whose last session has gone"""
+        self.set_typing(username, False)
+
+    def typing_message(self):
+        """Return the encoded typing_state for the users typing right now"""
+        with self._lock:
+            return self._encode(self._typing)
+
+    def _encode(self, users):
+        return json.dumps({"type": "typing_state", "typing": sorted(users)}).encode('utf-8')
+
+    def _start_ticking(self):
+        if not self._ticking:
+            self._ticking = True
+            self.schedule(self.tick, self._on_tick)
+
+    def _on_tick(self):
+        with self._lock:
+            for username in self._wheel.advance():
+                if username in self._typing:
+                    self._typing.discard(username)
+                    self.expired += 1
+
+            if self._typing != self._published:
+                started = self._typing - self._published
+                stopped = self._published - self._typing
+                self._published = set(self._typing)
+                self.published += 1
+                # Publish under the lock so frames always go out in order
+                self.publish(self._encode(self._published), started, stopped)
+
+            # Keep ticking only while there are flags left to expire
+            self._ticking = bool(self._wheel)
+            if self._ticking:
+                self.schedule(self.tick, self._on_tick)
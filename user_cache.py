@@ -0,0 +1,149 @@
+"""
+User identity cache for the chat server.
+
+A username is resolved to its (user_id, theme) row once and then served from
+an LRU cache, so neither logins of known users nor message writes need an
+identity query. Entries are dropped when the cache is full, or explicitly
+through invalidate() when a user is deleted or their theme changes.
+
+last_seen is not written on every login or message either: LastSeenBatcher
+remembers the latest time per user and writes them all in one batched
+UPDATE every interval seconds.
+"""
+
+import collections
+import datetime
+import logging
+import threading
+
+logger = logging.getLogger("ChatServer")
+
+# Defaults
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_LAST_SEEN_INTERVAL = 30.0
+
+class UserCache:
+    """Thread-safe LRU map of username -> (user_id, theme)"""
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, username):
+        """Return (user_id, theme) for a cached user, or None"""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return entry
+
+    def put(self, username, user_id, theme):
+        """Cache a user's identity, evicting the least recently used entry if full"""
+        with self._lock:
+            self._entries[username] = (user_id, theme)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, username):
+        """Forget a user, e.g. after it was deleted or its theme changed"""
+        with self._lock:
+            if self._entries.pop(username, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        """Forget every user"""
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        """Return a snapshot of the cache counters"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+class LastSeenBatcher:
+    """Coalesces last_seen updates and writes them periodically in one batch"""
+
+    def __init__(self, flush_batch, interval=DEFAULT_LAST_SEEN_INTERVAL):
+        self.flush_batch = flush_batch  # Called with a list of (user_id, timestamp); raises on failure
+        self.interval = interval
+        self._pending = {}  # user_id -> latest timestamp
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        # Counters
+        self.touches = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+        self._thread = threading.Thread(target=self._run, name="last-seen-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def touch(self, user_id, timestamp=None):
+        """Record that a user was seen now (or at timestamp)"""
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+        with self._lock:
+            self.touches += 1
+            if self._pending.get(user_id, timestamp) <= timestamp:
+                self._pending[user_id] = timestamp
+
+    def flush(self):
+        """Write every pending last_seen now; failed updates are kept for the next flush"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        try:
+            self.flush_batch(list(pending.items()))
+        except Exception as e:
+            logger.error(f"Failed to update last_seen for {len(pending)} users: {e}")
+            with self._lock:
+                for user_id, timestamp in pending.items():
+                    if self._pending.get(user_id, timestamp) <= timestamp:
+                        self._pending[user_id] = timestamp
+            return
+
+        with self._lock:
+            self.flushes += 1
+            self.rows_written += len(pending)
+
+    def close(self):
+        """Stop the periodic writer and flush what is pending"""
+        self._stop.set()
+        self._thread.join(self.interval)
+        self.flush()
+
+    def stats(self):
+        """Return a snapshot of the batcher counters"""
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'touches': self.touches,
+                'flushes': self.flushes,
+                'rows_written': self.rows_written,
+            }
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()